@@ -0,0 +1,245 @@
+"""社團報名 HTTP API (不經過 Streamlit，可與網頁同時執行)
+
+    python club_api.py --port 8502
+
+自助報名機或程式可以直接報名，不必每次點擊都重跑整個 Streamlit 頁面。
+與網頁共用同一份資料、同一把報名鎖，以及相同的「鎖定社團 / 校隊」規則與報名時段
+(自助報名機不經過網頁的排隊閘門)。
+
+    GET  /api/clubs[?class=701&seat=01&student_id=...&identity=校隊學生]
+                        社團名額；帶學生資料時只列出該生可報名的社團
+    POST /api/verify    {"class": "701", "seat": "01", "student_id": "1140001"}
+    POST /api/register  {"class": "701", "seat": "01", "student_id": "1140001", "club": "極地探險社"[, "waitlist": true]}
+                        waitlist 為 true 時額滿改列備取 (回傳 waitlisted 與候補序號)
+    POST /api/preferences {"class": "701", "seat": "01", "student_id": "1140001", "choices": ["極地探險社", ...]}
+                        志願序分發模式用，截止前可重複送出覆蓋
+    GET  /metrics       Prometheus 指標
+    GET  /healthz
+"""
+import argparse
+import json
+import os
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytz
+
+from club_core import (ConfigStore, RegistrationLedger, RegistrationLock, RosterCache, eligible_clubs,
+                       locked_club_of, metrics, open_storage, registration_phase, reserve_seat, submit_preferences)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MAX_BODY = 64 * 1024
+TAIPEI = pytz.timezone("Asia/Taipei")
+
+# 與 confirm_submission 相同的提示文字
+MESSAGES = {
+    "ok": "🎊 恭喜！您已成功報名！",
+    "waitlisted": "📋 該社團已額滿，已列入候補，有名額釋出時會依順序自動遞補。",
+    "duplicate": "⚠️ 寫入失敗：系統發現您剛剛已經完成報名了！",
+    "full": "😭 來晚了一步！該社團剛剛瞬間額滿了。",
+    "unknown_club": "❌ 該社團設定已被移除。",
+    "not_eligible": "🔒 您不能報名這個社團。",
+    "verify_failed": "學號錯誤",
+    "before": "⏰ 報名尚未開放。",
+    "closed": "🔔 報名已截止。",
+    "ranked_mode": "🎯 本次採志願序分發，請改為填寫志願。",
+    "fcfs_mode": "本次採先搶先贏，請直接報名社團。",
+    "empty": "請至少填寫一個志願。",
+    "too_many": "志願數超過上限。",
+}
+STATUS = {"ok": 200, "waitlisted": 202, "duplicate": 409, "full": 409, "unknown_club": 404, "not_eligible": 403, "verify_failed": 401,
+          "before": 403, "closed": 403, "ranked_mode": 409, "fcfs_mode": 409, "empty": 400, "too_many": 400}
+
+
+class RegistrationService:
+    """API 用的共用資源：與 club_app 的 cache_resource 對應，檔案路徑也相同"""
+
+    def __init__(self, base_dir=BASE_DIR, storage_kind=None):
+        storage_kind = storage_kind or os.environ.get("CLUB_STORAGE", "csv").lower()
+        self.config_store = ConfigStore(os.path.join(base_dir, "club_config.json"))
+        self.storage = open_storage(storage_kind, os.path.join(base_dir, "club_registrations.csv"),
+                                    os.path.join(base_dir, "students.xlsx"), os.path.join(base_dir, "club_data.db"))
+        self.ledger = RegistrationLedger(self.storage)
+        self.lock = RegistrationLock(os.path.join(base_dir, "club_registrations.lock"))
+        self.roster = RosterCache(self.storage)
+
+    def config(self):
+        """設定檔有變動才重新讀取 (管理員在網頁後台修改後立即生效)；回傳共用快取，請勿修改"""
+        return self.config_store.peek()
+
+    def student(self, cls, seat, student_id):
+        """學號驗證，成功回傳名冊資料，失敗回傳 None"""
+        row = self.roster.get().get(str(cls), str(seat).zfill(2))
+        if row is None or not student_id or str(row["學號"]) != str(student_id):
+            return None
+        return row
+
+    def clubs(self, row=None, identity=None):
+        """各社團名額；有學生資料時只列出可報名的社團"""
+        clubs = self.config()["clubs"]
+        self.ledger.refresh()
+        names = eligible_clubs(row, clubs, identity) if row is not None else list(clubs)
+        out = []
+        for name in names:
+            count, limit = self.ledger.count(name), clubs[name]["limit"]
+            out.append({"club": name, "category": clubs[name].get("category", ""), "limit": limit,
+                        "count": count, "remaining": max(0, limit - count), "full": count >= limit,
+                        "waitlist": self.ledger.waitlist_size(name)})
+        return out
+
+    def verify(self, cls, seat, student_id):
+        row = self.student(cls, seat, student_id)
+        if row is None:
+            return "verify_failed", {}
+        self.ledger.refresh()
+        reg = self.ledger.lookup(row["班級"], row["座號"])
+        return "ok", {
+            "class": row["班級"], "seat": row["座號"], "name": row["姓名"], "identity": row.get("身分", "一般生"),
+            "locked_club": locked_club_of(row, self.config()["clubs"]),
+            "registration": {"club": reg["社團"], "status": reg["狀態"],
+                             "waitlist_position": self.ledger.waitlist_position(row["班級"], row["座號"])}
+                            if reg is not None else None,
+        }
+
+    def register(self, cls, seat, student_id, club, waitlist=False):
+        """與 confirm_submission 相同：檢查名額 + 寫入在報名鎖內一次完成"""
+        row = self.student(cls, seat, student_id)
+        if row is None:
+            return "verify_failed"
+        config = self.config()
+        now = datetime.now(TAIPEI).replace(tzinfo=None)
+        phase = registration_phase(config, now)
+        if phase != "open":
+            return phase
+        if config["mode"] == "ranked":
+            return "ranked_mode"
+        clubs = config["clubs"]
+        if club not in clubs:
+            return "unknown_club"
+        if club not in eligible_clubs(row, clubs):
+            return "not_eligible"
+        record = {
+            "班級": row["班級"], "座號": row["座號"], "姓名": row["姓名"], "社團": club,
+            "報名時間": now.strftime("%Y-%m-%d %H:%M:%S"), "狀態": "正取",
+        }
+        result = reserve_seat(self.ledger, self.lock, record, clubs[club]["limit"], waitlist)
+        metrics.inc("submissions_total", result=result, source="api")
+        return result
+
+    def submit_preferences(self, cls, seat, student_id, choices):
+        """志願序分發模式：儲存 (覆蓋) 學生志願"""
+        row = self.student(cls, seat, student_id)
+        if row is None:
+            return "verify_failed"
+        config = self.config()
+        now = datetime.now(TAIPEI).replace(tzinfo=None)
+        phase = registration_phase(config, now)
+        if phase != "open":
+            return phase
+        if config["mode"] != "ranked":
+            return "fcfs_mode"
+        result = submit_preferences(self.ledger, self.lock, row, choices, config["clubs"], config["max_choices"],
+                                    now.strftime("%Y-%m-%d %H:%M:%S"))
+        metrics.inc("preferences_total", result=result, source="api")
+        return result
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    service = None  # 由 make_server 指定
+    server_version = "ClubAPI/1.0"
+
+    def log_message(self, fmt, *args):  # 尖峰時段不要把每個請求都印到終端機
+        pass
+
+    def send_json(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length <= 0 or length > MAX_BODY:
+            raise ValueError("請求內容為空或過大")
+        body = json.loads(self.rfile.read(length).decode("utf-8"))
+        if not isinstance(body, dict):
+            raise ValueError("請求內容必須是 JSON 物件")
+        return body
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/healthz":
+            return self.send_json(200, {"ok": True, "registrations": len(self.service.ledger)})
+        if url.path == "/metrics":
+            data = metrics.prometheus_text(gauges={"registrations": len(self.service.ledger)}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        if url.path == "/api/clubs":
+            with metrics.timer("api_clubs"):
+                q = {k: v[0] for k, v in parse_qs(url.query).items()}
+                row = None
+                if "class" in q or "student_id" in q:
+                    row = self.service.student(q.get("class", ""), q.get("seat", ""), q.get("student_id"))
+                    if row is None:
+                        return self.send_json(401, {"result": "verify_failed", "message": MESSAGES["verify_failed"]})
+                return self.send_json(200, {"clubs": self.service.clubs(row, q.get("identity"))})
+        self.send_json(404, {"result": "not_found"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path not in ("/api/verify", "/api/register", "/api/preferences"):
+            return self.send_json(404, {"result": "not_found"})
+        try:
+            body = self.read_json()
+            cls, seat, student_id = str(body["class"]), str(body["seat"]), str(body["student_id"])
+        except (ValueError, KeyError, TypeError) as e:
+            return self.send_json(400, {"result": "bad_request", "message": f"格式錯誤：{e}"})
+        if url.path == "/api/verify":
+            with metrics.timer("api_verify"):
+                result, data = self.service.verify(cls, seat, student_id)
+                return self.send_json(STATUS[result], dict(data, result=result, message="" if result == "ok" else MESSAGES[result]))
+        if url.path == "/api/preferences":
+            with metrics.timer("api_preferences"):
+                choices = body.get("choices")
+                if not isinstance(choices, list):
+                    return self.send_json(400, {"result": "bad_request", "message": "格式錯誤：choices 必須是陣列"})
+                result = self.service.submit_preferences(cls, seat, student_id, choices)
+                return self.send_json(STATUS[result], {"result": result, "message": MESSAGES[result]})
+        with metrics.timer("api_register"):
+            result = self.service.register(cls, seat, student_id, str(body.get("club", "")), body.get("waitlist") is True)
+            data = {"result": result, "message": MESSAGES[result]}
+            if result == "waitlisted":
+                data["waitlist_position"] = self.service.ledger.waitlist_position(cls, str(seat).zfill(2))
+            self.send_json(STATUS[result], data)
+
+
+def make_server(host="127.0.0.1", port=8502, service=None):
+    handler = type("BoundApiHandler", (ApiHandler,), {"service": service or RegistrationService()})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="社團報名 HTTP API")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8502)
+    ap.add_argument("--storage", choices=["csv", "sqlite"], default=None, help="預設讀取 CLUB_STORAGE 環境變數")
+    args = ap.parse_args(argv)
+    server = make_server(args.host, args.port, RegistrationService(storage_kind=args.storage))
+    print(f"社團報名 API：http://{args.host}:{args.port}/api/clubs")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,11 +2,14 @@ import streamlit as st
 import sys
 import os
 import time
+import bisect
 import io
 import json
-import re
+import hashlib
+import threading
+import uuid
+import importlib.util
 import pandas as pd
-import zipfile
 from datetime import datetime
 import pytz
 
@@ -27,24 +30,18 @@ if __name__ == '__main__':
     except ImportError:
         pass
 
-# 嘗試匯入必要套件
-try:
-    from docx import Document
-    from PIL import Image, ImageDraw, ImageFont
-    import openpyxl
-
-    # Word 相關套件
-    from docx.shared import Pt
-    from docx.enum.text import WD_ALIGN_PARAGRAPH
-    from docx.enum.table import WD_TABLE_ALIGNMENT
-    from docx.oxml.ns import qn
-    from docx.oxml import OxmlElement
-
-except ImportError as e:
-    st.error(f"⚠️ 系統缺少必要套件：{e}")
-    st.info("請確認 requirements.txt 包含：python-docx, Pillow, openpyxl")
+# 確認必要套件已安裝 (只查找不匯入；PIL 等到畫圖、openpyxl 等到讀寫 Excel 時才真正載入)
+missing_packages = [name for name in ("PIL", "openpyxl") if importlib.util.find_spec(name) is None]
+if missing_packages:
+    st.error(f"⚠️ 系統缺少必要套件：{', '.join(missing_packages)}")
+    st.info("請確認 requirements.txt 包含：Pillow, openpyxl")
     st.stop()
 
+from club_core import (DEFAULT_CONFIG, REG_COLUMNS, AdmissionGate, CapacityError, ConfigStore, RegistrationLedger, RegistrationLock, RosterCache, bulk_mutate,
+                       eligible_clubs, is_team_club, leave_waitlist, locked_club_of, metrics, open_storage,
+                       merge_brochure, parse_config_time, plan_roster_import, preference_choices, promote_waitlist,
+                       read_brochure, registration_phase, reserve_seat, run_allocation, submit_preferences)
+
 # ==========================================
 # 1. 系統路徑與設定
 # ==========================================
@@ -52,8 +49,16 @@ except ImportError as e:
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 CONFIG_FILE = os.path.join(BASE_DIR, "club_config.json")
 REG_FILE = os.path.join(BASE_DIR, "club_registrations.csv")
+REG_LOCK_FILE = os.path.join(BASE_DIR, "club_registrations.lock")
 STUDENT_LIST_FILE = os.path.join(BASE_DIR, "students.xlsx")
+DB_FILE = os.path.join(BASE_DIR, "club_data.db")
+# 效能指標 (Prometheus 文字格式，node_exporter textfile collector 可直接讀取)
+METRICS_FILE = os.path.join(BASE_DIR, "club_metrics.prom")
+# 儲存方式："csv" (CSV + XLSX，預設) 或 "sqlite" (WAL 模式，首次啟動自動匯入現有檔案)
+STORAGE_BACKEND = os.environ.get("CLUB_STORAGE", "csv").lower()
 IMAGES_DIR = os.path.join(BASE_DIR, "club_images")
+# PDF 用的中文字型子集 (依原字型與用字快取)
+FONT_CACHE_DIR = os.path.join(BASE_DIR, "club_fonts")
 
 if not os.path.exists(IMAGES_DIR):
     os.makedirs(IMAGES_DIR)
@@ -76,22 +81,51 @@ def get_chinese_font_path():
     return None
 
 FONT_PATH = get_chinese_font_path()
+# 圖片樣式一改就把版本號加一，讓 club_images/ 裡的舊快取失效
+IMAGE_STYLE_VERSION = 1
+
+@st.cache_resource(show_spinner=False)
+def get_font(font_path, size):
+    """每個 (字型, 字級) 只載入一次，中文字型檔很大，重複載入很耗時"""
+    from PIL import ImageFont
+    try:
+        if font_path: return ImageFont.truetype(font_path, size)
+    except: pass
+    return ImageFont.load_default()
+
+def cached_png(kind, args, render):
+    """圖片磁碟快取：先找 club_images/，沒有才繪製並寫入"""
+    key = json.dumps([IMAGE_STYLE_VERSION, FONT_PATH, kind, *args], ensure_ascii=False)
+    path = os.path.join(IMAGES_DIR, f"{kind}_{hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]}.png")
+    try:
+        with open(path, "rb") as f: data = f.read()
+        metrics.cache("png", True)
+        return data
+    except OSError: pass
+    metrics.cache("png", False)
+    data = render(*args)
+    try:
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f: f.write(data)
+        os.replace(tmp_path, path)
+    except OSError: pass
+    return data
 
 # ------------------------------------------
 # [核心 1] 社團名稱轉圖片
 # ------------------------------------------
+@st.cache_data(max_entries=256, show_spinner=False)
 def generate_text_image(text):
+    return cached_png("title", (text,), render_text_image)
+
+def render_text_image(text):
+    from PIL import Image, ImageDraw
     width, height = 400, 45
     background_color = (255, 255, 255)
     text_color = (30, 58, 138)
     img = Image.new('RGB', (width, height), color=background_color)
     draw = ImageDraw.Draw(img)
-    try:
-        if FONT_PATH:
-            font = ImageFont.truetype(FONT_PATH, 24)
-        else:
-            font = ImageFont.load_default()
-    except: font = ImageFont.load_default()
+    font = get_font(FONT_PATH, 24)
 
     bbox = draw.textbbox((0, 0), text, font=font)
     text_h = bbox[3] - bbox[1]
@@ -103,23 +137,20 @@ def generate_text_image(text):
 # ------------------------------------------
 # [核心 2] 步驟標題轉圖片
 # ------------------------------------------
+@st.cache_data(max_entries=64, show_spinner=False)
 def generate_step_image(num, text):
+    return cached_png("step", (num, text), render_step_image)
+
+def render_step_image(num, text):
+    from PIL import Image, ImageDraw
     width, height = 350, 40
     bg_color = (255, 255, 255)
     box_color = (0, 120, 212)
     text_color = (50, 50, 50)
     img = Image.new('RGB', (width, height), color=bg_color)
     draw = ImageDraw.Draw(img)
-    try:
-        if FONT_PATH:
-            font_num = ImageFont.truetype(FONT_PATH, 22)
-            font_text = ImageFont.truetype(FONT_PATH, 24)
-        else:
-            font_num = ImageFont.load_default()
-            font_text = ImageFont.load_default()
-    except:
-        font_num = ImageFont.load_default()
-        font_text = ImageFont.load_default()
+    font_num = get_font(FONT_PATH, 22)
+    font_text = get_font(FONT_PATH, 24)
 
     box_size = 32
     box_x, box_y = 0, (height - box_size) // 2
@@ -141,148 +172,208 @@ def get_taiwan_now():
     tw_tz = pytz.timezone('Asia/Taipei')
     return datetime.now(tw_tz).replace(tzinfo=None)
 
+# 全程序共用的設定快取：設定檔有變動才重新讀取
+@st.cache_resource
+def get_config_store():
+    return ConfigStore(CONFIG_FILE)
+
+@metrics.timed("load_config")
 def load_config():
-    """讀取設定檔，如果沒有則回傳預設值"""
-    if os.path.exists(CONFIG_FILE):
-        with open(CONFIG_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            for c in data.get("clubs", {}):
-                if "category" not in data["clubs"][c]: data["clubs"][c]["category"] = "綜合"
-            if "start_time" not in data: data["start_time"] = "2026-02-09 08:00:00"
-            if "end_time" not in data: data["end_time"] = "2026-02-09 17:00:00"
-            if "admin_password" not in data: data["admin_password"] = "0000"
-            return data
-    return {
-        "clubs": {"極地探險社": {"limit": 30, "category": "體育"}},
-        "start_time": "2026-02-09 08:00:00",
-        "end_time": "2026-02-09 17:00:00",
-        "admin_password": "0000"
-    }
+    """取得設定 (記憶體快取的副本)，沒有設定檔則回傳預設值"""
+    return get_config_store().get()
 
 def save_config(config):
-    """將設定檔存成 json"""
-    with open(CONFIG_FILE, "w", encoding="utf-8") as f:
-        json.dump(config, f, ensure_ascii=False, indent=4)
+    """寫回設定檔 (暫存檔 + 替換，版本號加一)；一次操作只呼叫一次"""
+    return get_config_store().save(config)
 
 config_data = load_config()
 
+@st.cache_resource(show_spinner=False)
+def prerender_club_titles(club_names):
+    """社團清單一改變，就在背景把所有社團標題圖先畫好存進 club_images/"""
+    worker = threading.Thread(target=lambda: [cached_png("title", (c,), render_text_image) for c in club_names], daemon=True)
+    worker.start()
+    return worker
+
+prerender_club_titles(tuple(config_data["clubs"]))
+
+# 全程序共用的儲存層 (報名資料 + 學生名冊)
+@st.cache_resource
+def get_storage():
+    return open_storage(STORAGE_BACKEND, REG_FILE, STUDENT_LIST_FILE, DB_FILE)
+
+@metrics.timed("load_registrations")
 def load_registrations():
     """讀取報名資料"""
-    if os.path.exists(REG_FILE):
-        return pd.read_csv(REG_FILE, dtype={"班級": str, "座號": str})
-    else:
-        return pd.DataFrame(columns=["班級", "座號", "姓名", "社團", "報名時間", "狀態"])
+    df = get_storage().load_registrations()
+    metrics.inc("rows_read_total", len(df), source="load_registrations")
+    return df
+
+# 全程序共用的報名帳本：只在啟動時讀一次檔，之後由每次寫入就地更新
+@st.cache_resource
+def get_registration_ledger():
+    return RegistrationLedger(get_storage())
+
+# 報名寫入鎖 (作業系統檔案鎖，多程序部署時同樣有效)
+@st.cache_resource
+def get_registration_lock():
+    return RegistrationLock(REG_LOCK_FILE)
+
+def sync_registration_ledger():
+    """管理員整檔改寫報名資料後，讓帳本重新載入"""
+    get_registration_ledger().refresh()
 
-# 防禦 300 人同時查詢的快取牆，生存時間設為 1 秒
-@st.cache_data(ttl=1)
-def get_live_registrations():
-    return load_registrations()
+# 名冊快取：名冊檔案 (或資料庫) 有異動才重新讀取並重建索引
+@st.cache_resource
+def get_roster_cache():
+    return RosterCache(get_storage())
 
-reg_df = load_registrations()
+def get_roster():
+    """取得名冊索引 (年級/班級/座號選單與身分驗證用，唯讀)"""
+    return get_roster_cache().get()
 
+@metrics.timed("load_students_with_identity")
 def load_students_with_identity():
     """載入學生名單並自動補齊缺失的欄位"""
-    if not os.path.exists(STUDENT_LIST_FILE):
-        return pd.DataFrame(columns=["班級", "座號", "姓名", "學號", "身分", "鎖定社團"])
-    df = pd.read_excel(STUDENT_LIST_FILE, dtype={"班級": str, "座號": str, "學號": str, "鎖定社團": str})
-    df["座號"] = df["座號"].apply(lambda x: str(x).zfill(2))
-    
-    changed = False
-    if "身分" not in df.columns:
-        df["身分"] = "一般生"
-        changed = True
-    if "鎖定社團" not in df.columns:
-        df["鎖定社團"] = ""
-        changed = True
-
-    df["身分"] = df["身分"].fillna("一般生")
-    df["鎖定社團"] = df["鎖定社團"].fillna("")
-
-    if changed:
-        df.to_excel(STUDENT_LIST_FILE, index=False)
-    return df
+    return get_roster().df.copy()
 
 # --- [Word 生成函式] ---
-def generate_merged_docx(data_dict):
-    """將資料轉換成 Word 格式"""
-    doc = Document()
-    style = doc.styles['Normal']
-    style.font.name = '標楷體'
-    style._element.rPr.rFonts.set(qn('w:eastAsia'), '標楷體')
-    style.font.size = Pt(12)
-
-    keys = list(data_dict.keys())
-    for i, title in enumerate(keys):
-        df = data_dict[title]
-        title_para = doc.add_paragraph()
-        title_para.alignment = WD_ALIGN_PARAGRAPH.CENTER
-        title_run = title_para.add_run(title)
-        title_run.font.size = Pt(18)
-        title_run.font.bold = True
-        title_run.font.name = '標楷體'
-        title_run._element.rPr.rFonts.set(qn('w:eastAsia'), '標楷體')
-
-        time_para = doc.add_paragraph()
-        time_run = time_para.add_run(f"列印時間: {datetime.now().strftime('%Y-%m-%d %H:%M')}")
-        time_run.font.size = Pt(10)
-        time_run.font.name = '標楷體'
-        time_run._element.rPr.rFonts.set(qn('w:eastAsia'), '標楷體')
-
-        table = doc.add_table(rows=1 + len(df), cols=len(df.columns))
-        table.style = 'Table Grid'
-        table.alignment = WD_TABLE_ALIGNMENT.CENTER
-
-        for j, col_name in enumerate(df.columns):
-            cell = table.rows[0].cells[j]
-            cell.text = ''
-            p = cell.paragraphs[0]
-            p.alignment = WD_ALIGN_PARAGRAPH.CENTER
-            run = p.add_run(str(col_name))
-            run.font.bold = True
-            run.font.size = Pt(11)
-            run.font.name = '標楷體'
-            run._element.rPr.rFonts.set(qn('w:eastAsia'), '標楷體')
-            shading = OxmlElement('w:shd')
-            shading.set(qn('w:fill'), 'D9D9D9')
-            cell._element.get_or_add_tcPr().append(shading)
-
-        for row_idx, (_, row) in enumerate(df.iterrows()):
-            for col_idx, item in enumerate(row):
-                cell = table.rows[row_idx + 1].cells[col_idx]
-                cell.text = ''
-                p = cell.paragraphs[0]
-                p.alignment = WD_ALIGN_PARAGRAPH.CENTER
-                run = p.add_run(str(item))
-                run.font.size = Pt(11)
-                run.font.name = '標楷體'
-                run._element.rPr.rFonts.set(qn('w:eastAsia'), '標楷體')
-
-        if i < len(keys) - 1:
-            doc.add_page_break()
-
-    buffer = io.BytesIO()
-    doc.save(buffer)
-    return buffer.getvalue()
-
-def create_batch_zip(data_dict, file_type="Excel"):
-    """將多份 Excel 檔案打包成 ZIP"""
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zf:
-        for file_name, df in data_dict.items():
-            if file_type == "Excel":
-                excel_buffer = io.BytesIO()
-                with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
-                    df.to_excel(writer, index=False)
-                zf.writestr(f"{file_name}.xlsx", excel_buffer.getvalue())
-    return zip_buffer.getvalue()
+@metrics.timed("export_docx")
+def generate_merged_docx(data_dict, out):
+    """將資料轉換成 Word 格式寫入 out (直接產生 WordprocessingML，共用樣式取代逐格設定)"""
+    from club_export import write_roster_docx
+    write_roster_docx(data_dict, out, datetime.now().strftime('%Y-%m-%d %H:%M'))
+    metrics.inc("bytes_written_total", out.tell(), kind="docx")
+
+@metrics.timed("export_zip")
+def create_batch_zip(data_dict, out, pool=None, progress=None):
+    """將多份 Excel 檔案逐一產生並串流打包成 ZIP 寫入 out，回傳 pool 是否仍可用"""
+    from club_export import write_batch_zip
+    pool_ok = write_batch_zip(data_dict, out, executor=pool, progress=progress)
+    metrics.inc("bytes_written_total", out.tell(), kind="zip")
+    return pool_ok
+
+@metrics.timed("export_pdf")
+def generate_pdf(data_dict, out, sign_in=False, as_zip=False, pool=None, progress=None):
+    """PDF 名單/簽到表寫入 out：中文字型只裁一次子集並快取；ZIP 模式每班/社一檔，邊產生邊寫入 ZIP"""
+    from club_export import write_pdf_zip, write_roster_pdf
+    if not FONT_PATH:
+        raise RuntimeError("找不到中文字型，請將 custom_font.ttf 放在程式資料夾")
+    printed_at = datetime.now().strftime('%Y-%m-%d %H:%M')
+    pool_ok = True
+    if as_zip:
+        pool_ok = write_pdf_zip(data_dict, out, printed_at, FONT_PATH, FONT_CACHE_DIR, sign_in, executor=pool, progress=progress)
+    else:
+        write_roster_pdf(data_dict, out, printed_at, FONT_PATH, FONT_CACHE_DIR, sign_in)
+    metrics.inc("bytes_written_total", out.tell(), kind="pdf")
+    return pool_ok
+
+# 列印格式 -> (副檔名, MIME)
+EXPORT_FORMATS = {
+    "Word (合併列印)": ("docx", "application/vnd.openxmlformats-officedocument.wordprocessingml.document"),
+    "PDF (合併列印)": ("pdf", "application/pdf"),
+    "PDF (ZIP，每班/社一檔)": ("zip", "application/zip"),
+    "Excel (ZIP壓縮)": ("zip", "application/zip"),
+}
+
+def build_export(data_map, fmt, sign_in, out, progress, pool):
+    """依列印格式把報表寫入 out (在報表背景執行緒執行，不可呼叫 Streamlit)，回傳 pool 是否仍可用"""
+    if "Word" in fmt: return generate_merged_docx(data_map, out)
+    if "PDF" in fmt: return generate_pdf(data_map, out, sign_in, "ZIP" in fmt, pool, progress)
+    return create_batch_zip(data_map, out, pool, progress)
+
+# 報表背景工作 (整個伺服器共用，完成的檔案依內容位址快取)
+@st.cache_resource
+def get_export_jobs():
+    from club_export import ExportJobs
+    return ExportJobs()
+
+def render_export_job(key, build, label, file_name, mime):
+    """顯示報表工作狀態；相同資料版本與選取項目只產生一次，之後直接提供下載"""
+    jobs = get_export_jobs()
+    job = jobs.get(key)
+    metrics.cache("export", job is not None)
+    job = job or jobs.submit(key, build)
+    was_running = job["status"] == "running"
+
+    @get_fragment_decorator(1 if was_running else None)
+    def export_job_status():
+        job = jobs.get(key)
+        if job is None or (was_running and job["status"] != "running"): st.rerun()
+        if job["status"] == "running":
+            done, total = job["progress"]
+            st.progress(done / total if total else 0.0, text=f"⏳ 背景產生中… ({done}/{total})" if total else "⏳ 背景產生中…")
+        elif job["status"] == "error":
+            st.error(f"❌ 產生失敗：{job['error']}")
+            if st.button("🔁 重新產生", key=f"retry_{key}"): jobs.submit(key, build); st.rerun()
+        else:
+            st.download_button(label, lambda: jobs.read(job), file_name, mime, type="primary", key=f"dl_{key}")
+
+    export_job_status()
 
 # 局部更新 Fragment 裝飾器
-def get_fragment_decorator():
-    if hasattr(st, "fragment"): return st.fragment(run_every=1)
-    if hasattr(st, "experimental_fragment"): return st.experimental_fragment(run_every=1)
+def get_fragment_decorator(run_every=1):
+    if hasattr(st, "fragment"): return st.fragment(run_every=run_every)
+    if hasattr(st, "experimental_fragment"): return st.experimental_fragment(run_every=run_every)
     return lambda f: f
 
-auto_refresh_fragment = get_fragment_decorator()
+# 社團卡片重新讀取報名資料的間隔 (秒)：有人報名時每秒讀取，連續沒有變化就逐步拉長
+# 卡片區塊固定每秒執行一次 (改 run_every 必須整頁重跑)，沒輪到的那幾次只用記憶體裡的帳本重畫
+CLUB_REFRESH_MIN = 1
+CLUB_REFRESH_MAX = 8
+CLUB_IDLE_TICKS = 3
+
+def club_refresh_due():
+    """這一次是否要重新讀取報名資料 (以 session_state 計數，不需要整頁重跑)"""
+    state = st.session_state
+    state.club_tick = state.get("club_tick", 0) + 1
+    if state.club_tick < state.get("club_refresh_interval", CLUB_REFRESH_MIN): return False
+    state.club_tick = 0
+    return True
+
+def track_club_refresh(version):
+    """比對帳本版本號，調整本連線的讀取間隔：版本改變時回到每秒，連續沒有變化就加倍"""
+    state = st.session_state
+    if version != state.get("club_view_version"):
+        state.club_view_version = version
+        state.club_idle_ticks = 0
+        state.club_refresh_interval = CLUB_REFRESH_MIN
+        return
+    state.club_idle_ticks = state.get("club_idle_ticks", 0) + 1
+    interval = state.get("club_refresh_interval", CLUB_REFRESH_MIN)
+    if state.club_idle_ticks >= CLUB_IDLE_TICKS and interval < CLUB_REFRESH_MAX:
+        state.club_refresh_interval = min(CLUB_REFRESH_MAX, interval * 2)
+        state.club_idle_ticks = 0
+
+# 虛擬等候室 (整個伺服器共用)
+@st.cache_resource
+def get_admission_gate():
+    return AdmissionGate(config_data["admit_rate"], config_data["max_active"])
+
+def gate_ticket():
+    """本連線的排隊號碼牌 (存在 session_state，重新整理頁面會重新排隊)"""
+    if "gate_ticket" not in st.session_state: st.session_state.gate_ticket = uuid.uuid4().hex
+    return st.session_state.gate_ticket
+
+def export_metrics():
+    """定期寫出 Prometheus 指標檔；只在已讀取報名資料的畫面呼叫 (等候畫面不讀報名資料)"""
+    try:
+        metrics.write_prometheus(METRICS_FILE, gauges=lambda: {"registrations": len(get_registration_ledger())})
+    except OSError: pass
+
+def renew_gate_ticket():
+    """社團卡片每次局部更新 (含按鈕) 都不會整頁重跑，要在這裡延長排隊名額；名額已過期就整頁重跑回到等候室"""
+    if st.session_state.get("is_admin", False) or st.session_state.get("gate_done", False): return
+    if not get_admission_gate().poll(gate_ticket())[0]: st.rerun()
+
+def current_session_id():
+    """目前連線的 session id (效能監控用，取不到時回傳 "-")"""
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        ctx = get_script_run_ctx()
+        return ctx.session_id if ctx else "-"
+    except Exception:
+        return "-"
 
 # ==========================================
 # 2. 介面設定
@@ -296,6 +387,8 @@ except:
 if "id_verified" not in st.session_state: st.session_state.id_verified = False
 if "last_student" not in st.session_state: st.session_state.last_student = ""
 
+metrics.session_event(current_session_id(), "rerun")
+
 with st.sidebar:
     st.title("🏫 功能選單")
     page = st.radio("前往頁面", ["📝 學生報名", "🔍 查詢報名", "🛠️ 管理員後台"])
@@ -305,43 +398,126 @@ with st.sidebar:
 # ==========================================
 # 3. 彈窗與邏輯
 # ==========================================
+def render_admission_gate():
+    """報名時段與排隊控管：尚未開放、已截止或還在排隊時只顯示等候畫面 (不讀名冊與報名資料) 並停止執行"""
+    if st.session_state.get("is_admin", False) or st.session_state.get("gate_done", False): return
+    phase = registration_phase(config_data, get_taiwan_now())
+    if phase == "before":
+        start = parse_config_time(config_data["start_time"])
+        first_left = (start - get_taiwan_now()).total_seconds()
+
+        # 倒數最後一分鐘每秒更新，之前每 5 秒更新一次
+        @get_fragment_decorator(1 if first_left <= 60 else 5)
+        def holding_countdown():
+            left = (start - get_taiwan_now()).total_seconds()
+            if left <= 0 or (left <= 60 < first_left): st.rerun()
+            h, rem = divmod(int(left), 3600)
+            st.markdown(f"<div style='text-align: center; padding: 40px;'><h3>⏰ 報名將於 {config_data['start_time']} 開放</h3>"
+                        f"<h1 style='font-size: 64px;'>{h:02d}:{rem // 60:02d}:{rem % 60:02d}</h1>"
+                        f"<p>時間到會自動進入報名，請勿重新整理頁面</p></div>", unsafe_allow_html=True)
+
+        holding_countdown(); st.stop()
+    if phase == "closed":
+        st.markdown(f"<div style='text-align: center; padding: 40px;'><h3>🔔 報名已於 {config_data['end_time']} 截止</h3>"
+                    f"<p>請至左側「🔍 查詢報名」查看結果</p></div>", unsafe_allow_html=True)
+        st.stop()
+
+    gate = get_admission_gate()
+    gate.configure(config_data["admit_rate"], config_data["max_active"])
+    if gate.poll(gate_ticket())[0]: return
+
+    @get_fragment_decorator(2)
+    def waiting_room():
+        admitted, ahead, eta = gate.poll(gate_ticket(), interact=False)
+        if admitted: st.rerun()
+        st.markdown(f"<div style='text-align: center; padding: 40px;'><h3>⏳ 目前報名人數眾多，正在排隊</h3>"
+                    f"<h1 style='font-size: 56px;'>前面約 {ahead} 人</h1>"
+                    f"<p>預計等待 {int(eta) + 1} 秒，輪到您會自動進入，請勿重新整理頁面</p></div>", unsafe_allow_html=True)
+
+    waiting_room(); st.stop()
+
 @st.dialog("📋 報名資訊最後確認")
-def confirm_submission(sel_class, sel_seat, name, club):
+@metrics.timed("confirm_submission")
+def confirm_submission(sel_class, sel_seat, name, club, waitlist=False):
     st.write(f"親愛的 {name} 同學：")
     img_data = generate_text_image(club)
     st.image(img_data, use_container_width=True)
-    st.info("系統將在您按下按鈕的瞬間，再次確認剩餘名額。")
-    if st.button("✅ 我確認無誤，送出報名", use_container_width=True, type="primary"):
-        # 關鍵安全防護：防超賣，同時確保寫入後清空快取
-        current_df = load_registrations()
-        if not current_df[(current_df["班級"] == sel_class) & (current_df["座號"] == sel_seat)].empty:
-            st.error("⚠️ 寫入失敗：系統發現您剛剛已經完成報名了！")
-            time.sleep(2); st.rerun(); return
+    if waitlist: st.warning("此社團目前額滿，送出後將列入候補 (備取)，有名額釋出時依順序自動遞補為正取。")
+    else: st.info("系統將在您按下按鈕的瞬間，再次確認剩餘名額。")
+    if st.button("✅ 我確認無誤，送出" + ("候補" if waitlist else "報名"), use_container_width=True, type="primary"):
+        # 關鍵安全防護：防超賣，「檢查名額 + 寫入」在檔案鎖內一次完成
         if club not in config_data["clubs"]:
             st.error("❌ 該社團設定已被移除。"); return
-        limit = config_data["clubs"][club]["limit"]
-        current_count = len(current_df[current_df["社團"] == club])
-        if current_count >= limit:
+        if registration_phase(config_data, get_taiwan_now()) != "open":
+            st.error("⏰ 目前不在報名時段內。"); return
+        record = {
+            "班級": sel_class, "座號": sel_seat, "姓名": name,
+            "社團": club, "報名時間": get_taiwan_now().strftime('%Y-%m-%d %H:%M:%S'),
+            "狀態": "正取"
+        }
+        result = reserve_seat(get_registration_ledger(), get_registration_lock(), record, config_data["clubs"][club]["limit"], waitlist)
+        metrics.inc("submissions_total", result=result, source="web")
+        if result == "duplicate":
+            st.error("⚠️ 寫入失敗：系統發現您剛剛已經完成報名了！")
+            time.sleep(2); st.rerun(); return
+        if result == "full":
             st.error(f"😭 來晚了一步！該社團剛剛瞬間額滿了。"); return
-        new_row = pd.DataFrame({
-            "班級": [sel_class], "座號": [sel_seat], "姓名": [name],
-            "社團": [club], "報名時間": [get_taiwan_now().strftime('%Y-%m-%d %H:%M:%S')],
-            "狀態": ["正取"]
-        })
-        new_row.to_csv(REG_FILE, mode='a', index=False, header=not os.path.exists(REG_FILE), encoding="utf-8-sig")
-        st.cache_data.clear() # 更新快取
-        st.success(f"🎊 恭喜！您已成功報名！")
+        if result == "waitlisted":
+            st.success(f"📋 已列入候補：目前第 {get_registration_ledger().waitlist_position(sel_class, sel_seat)} 位")
+        elif waitlist: st.success(f"🎊 剛好有名額釋出，您已直接正取！")
+        else: st.success(f"🎊 恭喜！您已成功報名！")
+        get_admission_gate().release(gate_ticket())
+        st.session_state.gate_done = True
         st.balloons(); time.sleep(2); st.rerun()
 
+PREFERENCE_MESSAGES = {
+    "empty": "請至少填寫一個志願。",
+    "too_many": "志願數超過上限。",
+    "not_eligible": "🔒 志願中有您不能報名的社團。",
+    "duplicate": "⚠️ 您已經有報名資料，不需要再填志願。",
+}
+
+def render_preference_form(row, clubs_to_show, identity):
+    """志願序分發模式：學生在報名時段內填寫 (可修改) 志願，截止後由管理員一次分發"""
+    ledger = get_registration_ledger(); ledger.refresh()
+    my_reg = ledger.lookup(row["班級"], row["座號"])
+    if my_reg is not None:
+        st.info(f"✅ 分發結果：{my_reg['社團']} ({my_reg['狀態']})"); return
+    mine = get_storage().find_preference(row["班級"], row["座號"])
+    saved = preference_choices(mine["志願"]) if mine else []
+    if saved:
+        st.success(f"📝 已於 {mine['填寫時間']} 送出志願：{' → '.join(saved)} (截止前可修改)")
+    n = min(int(config_data["max_choices"]), len(clubs_to_show))
+    options = ["(不填)"] + clubs_to_show
+    with st.form("preferences"):
+        st.write(f"🎯 本次採志願序分發：請依喜好填寫最多 {n} 個志願，截止後依抽籤順位統一分發")
+        picks = []
+        for i in range(n):
+            default = options.index(saved[i]) if i < len(saved) and saved[i] in options else 0
+            picks.append(st.selectbox(f"第 {i + 1} 志願", options, index=default, key=f"pref_{i}",
+                                      format_func=lambda c: c if c == "(不填)" else f"{c} (名額 {config_data['clubs'][c]['limit']})"))
+        if st.form_submit_button("📨 送出志願", type="primary", use_container_width=True):
+            if registration_phase(config_data, get_taiwan_now()) != "open":
+                st.error("⏰ 目前不在報名時段內。"); return
+            result = submit_preferences(ledger, get_registration_lock(), row, [p for p in picks if p != "(不填)"],
+                                        config_data["clubs"], config_data["max_choices"],
+                                        get_taiwan_now().strftime('%Y-%m-%d %H:%M:%S'), identity)
+            metrics.inc("preferences_total", result=result, source="web")
+            if result != "ok":
+                st.error(PREFERENCE_MESSAGES[result]); return
+            get_admission_gate().release(gate_ticket())
+            st.session_state.gate_done = True
+            st.success("✅ 志願已送出！"); time.sleep(1); st.rerun()
+
 @st.dialog("🧨 清空報名資料確認")
 def confirm_clear_data():
-    st.error("⚠️ 確定要清除所有「報名紀錄」嗎？")
+    st.error("⚠️ 確定要清除所有「報名紀錄」與「志願」嗎？")
     if st.button("🧨 確定清除", type="primary"):
-        if os.path.exists(REG_FILE):
-            os.remove(REG_FILE)
-            pd.DataFrame(columns=["班級", "座號", "姓名", "社團", "報名時間", "狀態"]).to_csv(REG_FILE, index=False, encoding="utf-8-sig")
-            st.cache_data.clear()
-            st.success("✅ 資料已清空！"); time.sleep(1); st.rerun()
+        with get_registration_lock().hold():
+            get_storage().clear_registrations()
+            get_storage().clear_preferences()
+            sync_registration_ledger()
+        st.success("✅ 資料已清空！"); time.sleep(1); st.rerun()
 
 @st.dialog("🧨 清空社團清單確認")
 def confirm_clear_clubs():
@@ -354,17 +530,26 @@ def confirm_factory_reset():
     st.markdown("<h3 style='color: red;'>⚠️ 警告：破壞性操作</h3><p>將刪除所有名冊、報名與設定。</p>", unsafe_allow_html=True)
     check = st.checkbox("我已備份資料")
     if st.button("💀 確定重置", type="primary", disabled=not check):
-        if os.path.exists(REG_FILE): os.remove(REG_FILE)
-        if os.path.exists(STUDENT_LIST_FILE): os.remove(STUDENT_LIST_FILE)
-        if os.path.exists(CONFIG_FILE): os.remove(CONFIG_FILE)
-        default_config = {"clubs": {"極地探險社": {"limit": 30, "category": "體育"}}, "start_time": "2026-02-09 08:00:00", "end_time": "2026-02-09 17:00:00", "admin_password": "0000"}
-        with open(CONFIG_FILE, "w", encoding="utf-8") as f: json.dump(default_config, f, ensure_ascii=False, indent=4)
+        with get_registration_lock().hold():
+            get_storage().clear_registrations()
+            get_storage().clear_preferences()
+        get_storage().clear_students()
+        save_config(json.loads(json.dumps(DEFAULT_CONFIG)))  # 覆寫為預設值，版本號照常遞增
         st.cache_data.clear()
+        sync_registration_ledger()
         st.success("✅ 系統已重置！"); time.sleep(2); st.rerun()
 
-def render_health_bar(limit, current):
+# 名額血條樣式："bar" 固定大小的比例條 (預設)；"blocks" 每個名額一格 (舊版，大社團 HTML 會很長)
+HEALTH_BAR_MODE = "bar"
+
+def render_health_bar(limit, current, mode=None):
     """繪製名額血條"""
     remain = limit - current
+    if (mode or HEALTH_BAR_MODE) == "bar":
+        pct = max(0, min(100, round(remain * 100 / limit))) if limit else 0
+        return (f'<div style="height:12px; background-color:#E5E7EB; border-radius:3px; overflow:hidden; margin-bottom:5px;">'
+                f'<div style="width:{pct}%; height:100%; background-color:#22C55E;"></div></div>'
+                f'<div style="font-size:12px; font-weight:bold; color:gray;">剩餘: {remain} / {limit}</div>')
     blocks_html = ""
     for i in range(limit):
         color = "#22C55E" if i < remain else "#E5E7EB"
@@ -381,94 +566,187 @@ def render_health_bar(limit, current):
     return container_html
 
 # --- 管理員邏輯 ---
-def admin_batch_action(action, selected_rows, target_club=None):
-    current_df = load_registrations()
-    targets = set((r['班級'], r['座號']) for r in selected_rows)
+def run_bulk_mutation(op, keys, target=None):
+    """把勾選的 (班級, 座號) 交給批次異動引擎 (一次解析、一次檢查名額、一次寫入)，回傳 (異動人數, 遞補人數)"""
+    limits = {c: cfg["limit"] for c, cfg in config_data["clubs"].items()}
+    return bulk_mutate(get_registration_ledger(), get_registration_lock(), get_roster(), op, keys, target,
+                       limits=limits, timestamp=get_taiwan_now().strftime('%Y-%m-%d %H:%M:%S'))
+
+def admin_batch_action(action, selected_keys, target_club=None):
+    try:
+        count, promoted = run_bulk_mutation(action, selected_keys, target_club)
+    except CapacityError as e:
+        st.error(f"❌ 空間不足：{e}"); return
+    if promoted: st.toast(f"📋 備取遞補 {promoted} 人", icon="⬆️")
     if action == "delete":
-        new_df = current_df[~current_df.apply(lambda x: (x['班級'], x['座號']) in targets, axis=1)]
-        new_df.to_csv(REG_FILE, index=False, encoding="utf-8-sig")
-        st.cache_data.clear()
-        st.toast(f"✅ 踢除 {len(selected_rows)} 人", icon="🗑️"); time.sleep(1); st.rerun()
+        st.toast(f"✅ 踢除 {count} 人", icon="🗑️"); time.sleep(1); st.rerun()
     elif action == "move":
-        c_limit = config_data["clubs"][target_club]["limit"]
-        c_current = len(current_df[current_df["社團"] == target_club])
-        if c_current + len(selected_rows) > c_limit: st.error("❌ 空間不足"); return
-        new_df = current_df[~current_df.apply(lambda x: (x['班級'], x['座號']) in targets, axis=1)]
-        new_records = [{"班級": r['班級'], "座號": r['座號'], "姓名": r['姓名'], "社團": target_club, "報名時間": get_taiwan_now().strftime('%Y-%m-%d %H:%M:%S'), "狀態": "正取"} for r in selected_rows]
-        final_df = pd.concat([new_df, pd.DataFrame(new_records)], ignore_index=True)
-        final_df.to_csv(REG_FILE, index=False, encoding="utf-8-sig")
-        st.cache_data.clear()
-        st.toast(f"✅ 轉移 {len(selected_rows)} 人", icon="🔄"); time.sleep(1); st.rerun()
-
-def admin_batch_add(selected_rows, target_club):
-    current_df = load_registrations()
-    c_limit = config_data["clubs"][target_club]["limit"]
-    c_current = len(current_df[current_df["社團"] == target_club])
-    if c_current + len(selected_rows) > c_limit: st.error("❌ 空間不足"); return
-    new_records = [{"班級": r['班級'], "座號": r['座號'], "姓名": r['姓名'], "社團": target_club, "報名時間": get_taiwan_now().strftime('%Y-%m-%d %H:%M:%S'), "狀態": "正取"} for r in selected_rows]
-    final_df = pd.concat([current_df, pd.DataFrame(new_records)], ignore_index=True)
-    final_df.to_csv(REG_FILE, index=False, encoding="utf-8-sig")
-    st.cache_data.clear()
+        st.toast(f"✅ 轉移 {count} 人", icon="🔄"); time.sleep(1); st.rerun()
+
+def admin_batch_add(selected_keys, target_club):
+    try:
+        run_bulk_mutation("add", selected_keys, target_club)
+    except CapacityError as e:
+        st.error(f"❌ 空間不足：{e}"); return
     st.toast("✅ 強制報名成功", icon="➕"); time.sleep(1); st.rerun()
 
-def admin_batch_remove_students(selected_rows):
-    all_std = load_students_with_identity()
-    targets = set((r['班級'], r['座號']) for r in selected_rows)
-    new_std = all_std[~all_std.apply(lambda x: (x['班級'], x['座號']) in targets, axis=1)]
-    new_std.to_excel(STUDENT_LIST_FILE, index=False)
+def admin_batch_remove_students(selected_keys):
+    run_bulk_mutation("remove_student", selected_keys)
     st.toast("✅ 已移除名冊", icon="🗑️"); time.sleep(1); st.rerun()
 
 def admin_add_student_manual(cls, seat, name, sid):
-    all_std = load_students_with_identity()
-    if not all_std[(all_std["班級"] == cls) & (all_std["座號"] == seat)].empty: st.error("❌ 學生已存在"); return
-    new_row = pd.DataFrame({"班級": [cls], "座號": [seat], "姓名": [name], "學號": [sid], "身分": ["一般生"], "鎖定社團": [""]})
-    final_std = pd.concat([all_std, new_row], ignore_index=True)
-    try: final_std = final_std.sort_values(by=["班級", "座號"])
-    except: pass
-    final_std.to_excel(STUDENT_LIST_FILE, index=False)
+    if get_roster().get(cls, seat) is not None: st.error("❌ 學生已存在"); return
+    get_storage().add_students([{"班級": cls, "座號": seat, "姓名": name, "學號": sid, "身分": "一般生", "鎖定社團": ""}])
     st.success("✅ 新增成功"); time.sleep(1); st.rerun()
 
 def admin_transfer_student(old_c, old_s, new_c, new_s):
-    all_std = load_students_with_identity()
-    if not all_std[(all_std["班級"] == new_c) & (all_std["座號"] == new_s)].empty: st.error("❌ 目標位置有人"); return
-    mask = (all_std["班級"] == old_c) & (all_std["座號"] == old_s)
-    if all_std[mask].empty: st.error("❌ 找不到原學生"); return
-    all_std.loc[mask, "班級"] = new_c
-    all_std.loc[mask, "座號"] = new_s
-    all_std.to_excel(STUDENT_LIST_FILE, index=False)
-    reg_df = load_registrations()
-    reg_mask = (reg_df["班級"] == old_c) & (reg_df["座號"] == old_s)
-    if not reg_df[reg_mask].empty:
-        reg_df.loc[reg_mask, "班級"] = new_c
-        reg_df.loc[reg_mask, "座號"] = new_s
-        reg_df.to_csv(REG_FILE, index=False, encoding="utf-8-sig")
-        st.cache_data.clear()
+    roster = get_roster()
+    if roster.get(new_c, new_s) is not None: st.error("❌ 目標位置有人"); return
+    if roster.get(old_c, old_s) is None: st.error("❌ 找不到原學生"); return
+    ledger = get_registration_ledger()
+    with get_registration_lock().hold():
+        ledger.refresh()
+        # 目標位置可能留有已不在名冊的學生的報名資料，直接改 key 會重複 (SQLite 會違反主鍵)
+        if ledger.lookup(new_c, new_s) is not None:
+            st.error(f"❌ 目標位置 {new_c}-{new_s} 已有報名資料，請先刪除該筆報名"); return
+        get_storage().rekey_student((old_c, old_s), (new_c, new_s))
+        old_reg = ledger.lookup(old_c, old_s)
+        if old_reg is not None:
+            get_storage().rekey_registration((old_c, old_s), (new_c, new_s))
+            ledger.apply_changes([(old_c, old_s)], [{**old_reg, "班級": new_c, "座號": new_s}])
     st.success("✅ 轉班成功"); time.sleep(1.5); st.rerun()
 
-def admin_batch_update_identity(selected_rows, new_identity):
-    all_std = load_students_with_identity()
-    targets = set((r['班級'], r['座號']) for r in selected_rows)
-    mask = all_std.apply(lambda x: (x['班級'], x['座號']) in targets, axis=1)
-    if mask.any():
-        all_std.loc[mask, "身分"] = new_identity
-        all_std.to_excel(STUDENT_LIST_FILE, index=False)
-        st.toast(f"✅ 更新 {mask.sum()} 人為 {new_identity}", icon="🏷️"); time.sleep(1); st.rerun()
-
-def admin_batch_update_locked_club(selected_rows, target_club, action="lock"):
-    all_std = load_students_with_identity()
-    targets = set((r['班級'], r['座號']) for r in selected_rows)
-    mask = all_std.apply(lambda x: (x['班級'], x['座號']) in targets, axis=1)
-    if mask.any():
+def admin_batch_update_identity(selected_keys, new_identity):
+    updated, _ = run_bulk_mutation("set_identity", selected_keys, new_identity)
+    if updated:
+        st.toast(f"✅ 更新 {updated} 人為 {new_identity}", icon="🏷️"); time.sleep(1); st.rerun()
+
+def admin_batch_update_locked_club(selected_keys, target_club, action="lock"):
+    updated, _ = run_bulk_mutation(action, selected_keys, target_club)
+    if updated:
         if action == "lock":
-            all_std.loc[mask, "鎖定社團"] = target_club
-            st.toast(f"✅ 已將 {mask.sum()} 人鎖定至 {target_club}", icon="🔒")
+            st.toast(f"✅ 已將 {updated} 人鎖定至 {target_club}", icon="🔒")
         else:
-            all_std.loc[mask, "鎖定社團"] = ""
-            st.toast(f"✅ 已解除 {mask.sum()} 人的社團鎖定", icon="🔓")
-        all_std.to_excel(STUDENT_LIST_FILE, index=False)
+            st.toast(f"✅ 已解除 {updated} 人的社團鎖定", icon="🔓")
         time.sleep(1)
         st.rerun()
 
+def render_roster_import(data):
+    """名冊匯入：同一份檔案 (SHA-256) 對同一版名冊只解析、比對一次，確認後整份一次替換"""
+    storage, roster = get_storage(), get_roster()
+    digest = hashlib.sha256(data).hexdigest()
+    plan = st.session_state.get("roster_import")
+    if plan is None or plan["digest"] != digest or plan["signature"] != storage.students_signature():
+        ledger = get_registration_ledger(); ledger.refresh()
+        plan = plan_roster_import(data, roster.df, ledger)
+        plan.update(digest=digest, signature=storage.students_signature())
+        st.session_state.roster_import = plan
+
+    for w in plan["warnings"]: st.warning(w)
+    if plan["errors"]:
+        st.error("名冊有誤，請修正後重新上傳：\n\n" + "\n".join(f"- {e}" for e in plan["errors"])); return
+    if not (plan["added"] or plan["removed"] or plan["changed"]):
+        st.info("✅ 名冊內容與目前相同，不需更新"); return
+
+    m1, m2, m3, m4 = st.columns(4)
+    m1.metric("新增", len(plan["added"])); m2.metric("移除", len(plan["removed"]))
+    m3.metric("資料變更", len(plan["changed"])); m4.metric("已報名被移除", len(plan["orphaned"]))
+    if plan["orphaned"]:
+        st.warning(f"⚠️ 有 {len(plan['orphaned'])} 位已報名的學生不在新名冊中，匯入後報名資料仍會保留，請至看板確認是否踢除")
+    with st.expander("🔍 查看差異 (每類最多列出 50 人)"):
+        new_by_key = plan["df"].set_index(["班級", "座號"], drop=False)
+        for label, keys in (("新增", plan["added"]), ("資料變更 (新資料)", plan["changed"]), ("移除", plan["removed"])):
+            if keys:
+                st.write(f"**{label}**：{len(keys)} 人")
+                rows = pd.DataFrame([roster.get(*k) for k in keys[:50]]) if label == "移除" else new_by_key.loc[keys[:50]]
+                st.dataframe(rows, hide_index=True)
+    if st.button("✅ 確認匯入名冊", type="primary", key="apply_roster"):
+        storage.replace_students(plan["df"])
+        metrics.inc("roster_imports_total")
+        st.session_state.roster_import = None
+        st.toast(f"✅ 名冊已更新：新增 {len(plan['added'])} 人、移除 {len(plan['removed'])} 人、變更 {len(plan['changed'])} 人", icon="👥")
+        time.sleep(1); st.rerun()
+
+def render_brochure_import(data, kind):
+    """社團簡章匯入：同一份檔案 (SHA-256) 只解析一次，預覽合併結果，按下「開始匯入」才一次寫入設定"""
+    digest = hashlib.sha256(data).hexdigest()
+    parsed = st.session_state.get("brochure_import")
+    if parsed is None or parsed["digest"] != digest:
+        try:
+            entries = read_brochure(data, kind)
+        except Exception as e:
+            st.error(f"❌ 無法讀取簡章：{e}"); return
+        parsed = st.session_state.brochure_import = {"digest": digest, "entries": entries}
+
+    ledger = get_registration_ledger(); ledger.refresh()
+    clubs, report = merge_brochure(config_data["clubs"], parsed["entries"], ledger.counts())
+    for w in report["warnings"]: st.warning(w)
+    if report["errors"]:
+        st.error("簡章有誤，請修正後重新上傳：\n\n" + "\n".join(f"- {e}" for e in report["errors"])); return
+    st.caption(f"新增 {len(report['added'])} 個｜更新 {len(report['updated'])} 個｜不變 {len(report['unchanged'])} 個")
+    if not (report["added"] or report["updated"]):
+        st.info("✅ 簡章內容與目前設定相同，不需匯入"); return
+    with st.expander("🔍 預覽異動", expanded=True):
+        changes = [{"異動": label, "社團": n, "類別": clubs[n]["category"], "名額": clubs[n]["limit"]}
+                   for label, names in (("新增", report["added"]), ("更新", report["updated"])) for n in names]
+        st.dataframe(pd.DataFrame(changes), hide_index=True)
+
+    if st.button("📥 開始匯入", type="primary"):
+        old = config_data["clubs"]
+        config_data["clubs"] = clubs
+        save_config(config_data)  # 整份簡章只寫一次設定檔
+        for n in report["updated"]:  # 「編輯個別社團設定」的輸入框還留著舊值，清掉以免下次重跑又寫回去
+            for k in (f"n_{n}", f"cat_{n}", f"l_{n}"): st.session_state.pop(k, None)
+        prerender_club_titles(tuple(clubs))  # 新社團的標題圖在背景先畫好
+        if any(clubs[n]["limit"] > old[n]["limit"] for n in report["updated"]):
+            n_promoted = promote_waitlist(get_registration_ledger(), get_registration_lock(), {k: v["limit"] for k, v in clubs.items()})
+            if n_promoted: st.toast(f"📋 備取遞補 {n_promoted} 人", icon="⬆️")
+        metrics.inc("brochure_imports_total")
+        st.toast(f"✅ 已匯入簡章：新增 {len(report['added'])} 個、更新 {len(report['updated'])} 個社團", icon="📋")
+        time.sleep(1); st.rerun()
+
+# --- 分頁勾選表格 ---
+ADMIN_PAGE_SIZE = 50
+
+def _in_sorted(keys, key):
+    i = bisect.bisect_left(keys, key)
+    return i < len(keys) and keys[i] == key
+
+def render_paged_editor(name, keys, fetch, columns, page_size=ADMIN_PAGE_SIZE):
+    """分頁勾選表格：只把目前這一頁組成表格送到瀏覽器，勾選狀態以 (班級, 座號) 集合跨頁保留
+
+    keys 須依 (班級, 座號) 排序，fetch(page_keys) 回傳該頁的資料列 (dict)。
+    「全選 / 清除」只操作 key 集合，不組出資料列；回傳已勾選的 (班級, 座號)，依序排列。
+    """
+    ss = st.session_state
+    selected = ss.setdefault(f"{name}_sel", set())
+    # 換了篩選條件或已被刪除的勾選不再有效 (二分搜尋，只和勾選筆數有關)
+    selected.difference_update([k for k in selected if not _in_sorted(keys, k)])
+    pages = max(1, -(-len(keys) // page_size))
+    if ss.get(f"{name}_page", 1) > pages: ss[f"{name}_page"] = pages
+    # 表格 key 綁定本頁的學生與 nonce：換頁、資料增刪或程式改變勾選 (全選/清除) 時，丟掉前端殘留的勾選異動
+    nonce = ss.setdefault(f"{name}_nonce", 0)
+
+    c_info, c_page, c_all, c_clear = st.columns([3, 1, 1, 1])
+    page = c_page.number_input("頁次", min_value=1, max_value=pages, step=1, key=f"{name}_page", label_visibility="collapsed")
+    if c_all.button(f"全選 {len(keys)} 筆", key=f"{name}_all", use_container_width=True):
+        selected.update(keys); ss[f"{name}_nonce"] = nonce = nonce + 1
+    if c_clear.button("清除勾選", key=f"{name}_clear", use_container_width=True):
+        selected.clear(); ss[f"{name}_nonce"] = nonce = nonce + 1
+
+    start = (page - 1) * page_size
+    rows = fetch(keys[start:start + page_size])
+    page_keys = [(str(r["班級"]), str(r["座號"])) for r in rows]
+    page_df = pd.DataFrame(rows, columns=columns)
+    page_df.insert(0, "選取", [k in selected for k in page_keys])
+    edited = st.data_editor(page_df, column_config={"選取": st.column_config.CheckboxColumn(default=False)},
+                            disabled=list(columns), hide_index=True, key=f"{name}_{nonce}_{hash(tuple(page_keys))}")
+    for k, checked in zip(page_keys, edited["選取"]):
+        if checked: selected.add(k)
+        else: selected.discard(k)
+    c_info.caption(f"共 {len(keys)} 筆｜第 {page}/{pages} 頁｜已勾選 {len(selected)} 筆")
+    return sorted(selected)
+
 # ==========================================
 # 5. 管理員後台
 # ==========================================
@@ -485,35 +763,39 @@ if page == "🛠️ 管理員後台":
                     else: st.error("❌ 密碼錯誤")
     else:
         if st.sidebar.button("🚪 管理員登出"): st.session_state.is_admin = False; st.rerun()
+        export_metrics()
 
-        tab_monitor, tab_student, tab_config, tab_export = st.tabs([
-            "📊 實時看板", "👥 學生管理", "⚙️ 系統設定", "🖨️ 報表輸出"
-        ])
+        # st.tabs 每次重跑都會執行全部分頁 (各自讀取報名與名冊)；改成只執行目前選取的分頁
+        admin_tab = st.radio("後台分頁", ["📊 實時看板", "👥 學生管理", "⚙️ 系統設定", "🖨️ 報表輸出", "⚡ 效能監控"],
+                             horizontal=True, label_visibility="collapsed", key="admin_tab")
 
-        with tab_monitor:
-            df = load_registrations()
-            all_students_df = load_students_with_identity()
+        if admin_tab == "📊 實時看板":
+            # 看板數字與名單都取自帳本就地維護的彙總，不必每次重讀報名檔、掃過整份名冊
+            ledger = get_registration_ledger(); ledger.refresh()
+            roster = get_roster(); ledger.track_roster(roster)
 
-            if not df.empty:
-                m1, m2, m3 = st.columns(3)
-                m1.metric("已報名人數", f"{len(df)} 人")
-                m2.metric("正取", f"{len(df[df['狀態']=='正取'])} 人")
-                m3.metric("報名率", f"{int(len(df)/len(all_students_df)*100) if not all_students_df.empty else 0} %")
+            if len(ledger):
+                status_counts = ledger.status_counts()
+                m1, m2, m3, m4 = st.columns(4)
+                m1.metric("已報名人數", f"{len(ledger)} 人")
+                m2.metric("正取", f"{status_counts.get('正取', 0)} 人")
+                m3.metric("備取", f"{status_counts.get('備取', 0)} 人")
+                m4.metric("報名率", f"{int((len(roster) - ledger.unregistered_count()) * 100 / len(roster)) if len(roster) else 0} %")
+
+                lock_stats = get_registration_lock().stats()
+                st.caption(f"🔐 報名鎖等待 (本程序)：共 {lock_stats['count']} 次｜平均 {lock_stats['avg_ms']:.1f} ms｜p95 {lock_stats['p95_ms']:.1f} ms｜最長 {lock_stats['max_ms']:.1f} ms")
 
                 with st.expander("📊 查看社團報名長條圖", expanded=False):
-                    st.bar_chart(df['社團'].value_counts())
+                    st.bar_chart(pd.Series(ledger.club_totals(), name="count").sort_values(ascending=False))
 
                 view_tabs = st.tabs(["🏆 依社團", "🏫 依班級", "⚠️ 未選社"])
 
                 with view_tabs[0]:
-                    clubs_list = sorted(df["社團"].unique())
+                    clubs_list = sorted(ledger.club_totals())
                     if clubs_list:
                         sel_club_view = st.selectbox("選擇社團", ["全部"] + clubs_list, key="v_club")
                         if sel_club_view != "全部":
-                            sub_df = df[df["社團"]==sel_club_view].sort_values(by=["班級", "座號"])
-                            sub_df.insert(0, "選取", False)
-                            edited = st.data_editor(sub_df, column_config={"選取": st.column_config.CheckboxColumn(default=False)}, hide_index=True, key="ed_c")
-                            sel_rows = edited[edited["選取"]].to_dict('records')
+                            sel_rows = render_paged_editor("ed_c", ledger.keys_where(club=sel_club_view), ledger.records_of, REG_COLUMNS)
                             if sel_rows:
                                 c_act1, c_act2 = st.columns([1, 1])
                                 with c_act1:
@@ -524,13 +806,10 @@ if page == "🛠️ 管理員後台":
                     else: st.info("尚無資料")
 
                 with view_tabs[1]:
-                    classes = sorted(df["班級"].unique()) if not df.empty else []
+                    classes = sorted(ledger.class_counts())
                     if classes:
                         sel_cls_view = st.selectbox("選擇班級", classes, key="v_cls")
-                        c_reg = df[df["班級"]==sel_cls_view].sort_values(by="座號")
-                        c_reg.insert(0, "選取", False)
-                        edited_c = st.data_editor(c_reg, hide_index=True, key="ed_cls")
-                        sel_rows_c = edited_c[edited_c["選取"]].to_dict('records')
+                        sel_rows_c = render_paged_editor("ed_cls", ledger.keys_where(cls=sel_cls_view), ledger.records_of, REG_COLUMNS)
                         if sel_rows_c:
                             c_act_cls1, c_act_cls2 = st.columns([1, 1])
                             with c_act_cls1:
@@ -543,17 +822,13 @@ if page == "🛠️ 管理員後台":
                     else: st.info("尚無資料")
 
                 with view_tabs[2]:
-                    if not all_students_df.empty:
-                        reg_set = set(zip(df["班級"], df["座號"]))
-                        unreg = all_students_df[~all_students_df.apply(lambda x: (x["班級"], x["座號"]) in reg_set, axis=1)]
-                        if not unreg.empty:
-                            st.write(f"共 {len(unreg)} 人未報名")
-                            u_cls = sorted(unreg["班級"].unique())
-                            sel_u_c = st.selectbox("篩選班級", ["全部"] + u_cls)
-                            target_u = unreg if sel_u_c == "全部" else unreg[unreg["班級"] == sel_u_c]
-                            target_u.insert(0, "選取", False)
-                            ed_u = st.data_editor(target_u, hide_index=True, key="ed_u")
-                            s_u = ed_u[ed_u["選取"]].to_dict('records')
+                    if len(roster):
+                        n_unreg = ledger.unregistered_count()
+                        if n_unreg:
+                            st.write(f"共 {n_unreg} 人未報名")
+                            sel_u_c = st.selectbox("篩選班級", ["全部"] + ledger.unregistered_classes())
+                            s_u = render_paged_editor("ed_u", ledger.unregistered(None if sel_u_c == "全部" else sel_u_c),
+                                                      lambda keys: [roster.get(*k) for k in keys], list(roster.df.columns))
                             if s_u:
                                 t_add = st.selectbox("強制報名至", list(config_data["clubs"].keys()))
                                 if st.button("執行"): admin_batch_add(s_u, t_add)
@@ -561,24 +836,24 @@ if page == "🛠️ 管理員後台":
                     else: st.warning("請先匯入名冊")
             else: st.info("目前尚無報名資料")
 
-        with tab_student:
-            all_std = load_students_with_identity()
-            if not all_std.empty:
+        elif admin_tab == "👥 學生管理":
+            # 名單一律取自名冊索引的單班座號，只組出目前這一頁，不複製整份名冊
+            roster = get_roster()
+            fetch_students = lambda keys: [roster.get(*k) for k in keys]
+            if len(roster):
                 st.write("##### 🏅 1. 學生身分設定 (校隊/一般)")
                 c_s1, c_s2 = st.columns([1, 2])
                 with c_s1:
-                    sel_admin_cls = st.selectbox("選擇班級", sorted(all_std["班級"].unique()), key="id_cls_sel")
+                    sel_admin_cls = st.selectbox("選擇班級", roster.classes, key="id_cls_sel")
 
-                sub_std = all_std[all_std["班級"] == sel_admin_cls].sort_values(by="座號")
+                cls_keys = [(sel_admin_cls, s) for s in roster.seats(sel_admin_cls)]
                 col_btn1, col_btn2 = st.columns(2)
                 if col_btn1.button(f"⚡ {sel_admin_cls}班 全設為校隊", use_container_width=True):
-                    admin_batch_update_identity(sub_std.to_dict('records'), "校隊學生")
+                    admin_batch_update_identity(cls_keys, "校隊學生")
                 if col_btn2.button(f"🔙 {sel_admin_cls}班 全設為一般", use_container_width=True):
-                    admin_batch_update_identity(sub_std.to_dict('records'), "一般生")
+                    admin_batch_update_identity(cls_keys, "一般生")
 
-                sub_std.insert(0, "選取", False)
-                ed_id = st.data_editor(sub_std, hide_index=True, disabled=["班級","姓名","學號","鎖定社團"], key="ed_id_table")
-                sel_id = ed_id[ed_id["選取"]].to_dict('records')
+                sel_id = render_paged_editor("ed_id_table", cls_keys, fetch_students, list(roster.df.columns))
                 if sel_id:
                     c_b1, c_b2 = st.columns(2)
                     if c_b1.button("設為校隊", key="btn_team"): admin_batch_update_identity(sel_id, "校隊學生")
@@ -612,19 +887,16 @@ if page == "🛠️ 管理員後台":
                             else: st.error("欄位不全")
             
             st.divider()
-            if not all_std.empty:
+            if len(roster):
                 st.write("##### 🔒 4. 學生社團綁定與鎖定")
-                st.info("💡 被綁定的學生，登入後「只會看到」被指定的社團，無法選擇其他社團。可點選表格左上角的核取方塊「全選」，或單獨勾選進行「個別/批次鎖定」。")
+                st.info("💡 被綁定的學生，登入後「只會看到」被指定的社團，無法選擇其他社團。可按「全選」勾選全班，或單獨勾選進行「個別/批次鎖定」。")
                 
                 c_l1, _ = st.columns([1, 2])
                 with c_l1:
-                    sel_lock_cls = st.selectbox("選擇班級 (綁定專用)", sorted(all_std["班級"].unique()), key="lock_cls_sel")
+                    sel_lock_cls = st.selectbox("選擇班級 (綁定專用)", roster.classes, key="lock_cls_sel")
 
-                sub_lock_std = all_std[all_std["班級"] == sel_lock_cls].sort_values(by="座號")
-                sub_lock_std.insert(0, "選取", False)
-                
-                ed_lock = st.data_editor(sub_lock_std, hide_index=True, disabled=["班級","姓名","學號","身分","鎖定社團"], key="ed_lock_table")
-                sel_lock_id = ed_lock[ed_lock["選取"]].to_dict('records')
+                sel_lock_id = render_paged_editor("ed_lock_table", [(sel_lock_cls, s) for s in roster.seats(sel_lock_cls)],
+                                                  fetch_students, list(roster.df.columns))
 
                 if sel_lock_id:
                     c_act1, c_act2, c_act3 = st.columns([2, 1, 1])
@@ -636,36 +908,73 @@ if page == "🛠️ 管理員後台":
                     if c_act3.button("🔓 解除鎖定", use_container_width=True):
                         admin_batch_update_locked_club(sel_lock_id, "", "unlock")
 
-        with tab_config:
+        elif admin_tab == "⚙️ 系統設定":
             with st.container(border=True):
                 st.write("⏰ 時間與密碼設定")
                 c_conf1, c_conf2, c_conf3 = st.columns(3)
                 new_start = c_conf1.text_input("開始時間", config_data["start_time"])
                 new_end = c_conf2.text_input("結束時間", config_data["end_time"])
                 new_pwd = c_conf3.text_input("管理員密碼", config_data["admin_password"], type="password")
+                c_conf4, c_conf5, c_conf6 = st.columns(3)
+                new_rate = c_conf4.number_input("每秒放行人數 (排隊)", min_value=1, value=int(config_data["admit_rate"]))
+                new_active = c_conf5.number_input("同時報名人數上限", min_value=1, value=int(config_data["max_active"]))
+                gate_stats = get_admission_gate().stats()
+                c_conf6.caption(f"🚦 排隊中 {gate_stats['waiting']} 人｜報名中 {gate_stats['active']} 人｜已放行 {gate_stats['admitted']} 人")
+                c_conf7, c_conf8, c_conf9 = st.columns(3)
+                mode_labels = {"fcfs": "先搶先贏", "ranked": "志願序分發"}
+                new_mode = c_conf7.radio("報名方式", list(mode_labels), format_func=mode_labels.get, horizontal=True,
+                                         index=list(mode_labels).index(config_data["mode"]) if config_data["mode"] in mode_labels else 0)
+                new_choices = c_conf8.number_input("志願數上限", min_value=1, value=int(config_data["max_choices"]))
+                new_seed = c_conf9.number_input("抽籤種子", min_value=0, value=int(config_data["lottery_seed"]),
+                                                help="相同種子重新分發會得到相同結果")
                 if st.button("💾 儲存設定"):
-                    config_data.update({"start_time": new_start, "end_time": new_end, "admin_password": new_pwd})
+                    if not parse_config_time(new_start) or not parse_config_time(new_end):
+                        st.error("時間格式需為 YYYY-MM-DD HH:MM:SS"); st.stop()
+                    config_data.update({"start_time": new_start, "end_time": new_end, "admin_password": new_pwd,
+                                        "admit_rate": int(new_rate), "max_active": int(new_active), "mode": new_mode,
+                                        "max_choices": int(new_choices), "lottery_seed": int(new_seed)})
                     save_config(config_data); st.success("已更新"); time.sleep(1); st.rerun()
 
+            if config_data["mode"] == "ranked":
+                with st.container(border=True):
+                    st.write("🎯 志願序分發")
+                    n_prefs = len(get_storage().load_preferences())
+                    st.caption(f"已收到 {n_prefs} 份志願｜抽籤種子 {config_data['lottery_seed']}｜重新分發會覆蓋上次分發結果，手動加入的報名保留並佔名額")
+                    if registration_phase(config_data, get_taiwan_now()) == "open":
+                        st.warning("⚠️ 報名仍在進行中，分發後仍可能有學生繼續送出志願")
+                    if st.button("🎲 執行分發", type="primary"):
+                        with st.spinner("分發中..."):
+                            stats = run_allocation(get_registration_ledger(), get_registration_lock(), get_roster(),
+                                                   config_data["clubs"], config_data["lottery_seed"],
+                                                   get_taiwan_now().strftime('%Y-%m-%d %H:%M:%S'))
+                        st.session_state.allocation_stats = stats
+                    if st.session_state.get("allocation_stats"):
+                        stats = st.session_state.allocation_stats
+                        st.success(f"✅ 分發完成：{stats.get('參與人數', 0)} 人參與，正取 {stats.get('正取', 0)} 人，"
+                                   f"備取 {stats.get('備取', 0)} 人，未分發 {stats.get('未分發', 0)} 人")
+                        st.bar_chart(pd.Series({k: v for k, v in stats.items() if k.endswith("志願")}, name="人數"))
+
             c_imp1, c_imp2 = st.columns(2)
             with c_imp1:
                 with st.container(border=True):
                     st.write("📋 匯入社團簡章")
                     if st.button("🧨 清空社團"): confirm_clear_clubs()
+                    st.caption("表格需有「社團」欄，可另有「類別」、「名額」欄 (Excel 每個工作表、Word 每個表格都會讀取)")
                     f_club = st.file_uploader("上傳 Excel/Word", type=["xlsx", "docx"], key="up_c")
-                    if f_club and st.button("📥 開始匯入"):
-                        pass # 保持原樣省略
+                    if f_club: render_brochure_import(f_club.getvalue(), f_club.name.rsplit(".", 1)[-1].lower())
 
             with c_imp2:
                 with st.container(border=True):
                     st.write("👥 匯入學生名冊")
+                    if get_storage().kind == "sqlite":
+                        st.caption(f"目前儲存方式：SQLite ({os.path.basename(DB_FILE)})，CSV/XLSX 僅作匯入匯出")
                     st.caption("請上傳 students.xlsx")
                     f_std = st.file_uploader("上傳 Excel", type=["xlsx"], key="up_s")
-                    if f_std:
-                        pd.read_excel(f_std, dtype=str).to_excel(STUDENT_LIST_FILE, index=False)
-                        st.success("名冊已更新")
+                    if f_std: render_roster_import(f_std.getvalue())
 
             with st.expander("📝 編輯個別社團設定"):
+                # 同一次重跑裡所有社團的修改合併成一次寫入
+                clubs_changed, limit_raised = False, False
                 for c, cfg in list(config_data["clubs"].items()):
                     cc1, cc2, cc3, cc4 = st.columns([2, 1, 1, 0.5])
                     nn = cc1.text_input("名稱", c, key=f"n_{c}")
@@ -675,7 +984,13 @@ if page == "🛠️ 管理員後台":
                     if nn != c or nl != cfg['limit'] or cat != cfg.get("category", "綜合"):
                         config_data["clubs"][nn] = {"limit": int(nl), "category": cat}
                         if nn != c: del config_data["clubs"][c]
-                        save_config(config_data)
+                        clubs_changed, limit_raised = True, limit_raised or nl > cfg['limit']
+                if clubs_changed:
+                    save_config(config_data)
+                    if limit_raised:  # 名額調高：空出的位置讓備取依序遞補
+                        n_promoted = promote_waitlist(get_registration_ledger(), get_registration_lock(),
+                                                      {k: v["limit"] for k, v in config_data["clubs"].items()})
+                        if n_promoted: st.toast(f"📋 備取遞補 {n_promoted} 人", icon="⬆️")
                 if st.button("➕ 新增社團"): config_data["clubs"]["新社團"] = {"limit": 30, "category": "綜合"}; save_config(config_data); st.rerun()
 
             with st.expander("🧨 危險操作區 (慎用)", expanded=False):
@@ -684,12 +999,18 @@ if page == "🛠️ 管理員後台":
                 if d1.button("🗑️ 清空報名資料", use_container_width=True): confirm_clear_data()
                 if d2.button("☢️ 恢復原廠設定", type="primary", use_container_width=True): confirm_factory_reset()
 
-        with tab_export:
+        elif admin_tab == "🖨️ 報表輸出":
+            from club_export import export_job_key
+            reg_version = get_storage().registrations_signature()
+            df = load_registrations()
             st.subheader("🖨️ 批次列印與下載中心")
             c_type, c_content = st.columns([1, 3])
             with c_type:
                 st.info("選擇格式")
-                fmt = st.radio("格式", ["Word (合併列印)", "Excel (ZIP壓縮)"], label_visibility="collapsed")
+                fmt = st.radio("格式", list(EXPORT_FORMATS), label_visibility="collapsed")
+                sign_in = "PDF" in fmt and st.checkbox("簽到表 (加上簽名欄)", key="exp_sign_in")
+                ext, mime = EXPORT_FORMATS[fmt]
+                doc_name = "簽到表" if sign_in else "名單"
 
             with c_content:
                 tab_dl_cls, tab_dl_club = st.tabs(["🏫 按班級列印", "🏆 按社團列印"])
@@ -697,33 +1018,29 @@ if page == "🛠️ 管理員後台":
                 with tab_dl_cls:
                     if not df.empty:
                         all_cls = sorted(df["班級"].unique())
-                        sel_cls = st.multiselect("選擇班級", all_cls)
-                        if st.button("全選班級"): sel_cls = all_cls
+                        sel_cls = st.multiselect("選擇班級", all_cls, key="exp_cls")
+                        st.button("全選班級", on_click=lambda: st.session_state.update(exp_cls=all_cls))
 
                         if sel_cls:
-                            data_map = {f"{c}班_名單": df[df["班級"]==c].sort_values("座號")[["班級","座號","姓名","社團"]] for c in sel_cls}
-                            if "Word" in fmt:
-                                out = generate_merged_docx(data_map)
-                                st.download_button(f"⬇️ 下載 Word ({len(sel_cls)} 班)", out, "班級名單.docx", "application/vnd.openxmlformats-officedocument.wordprocessingml.document", type="primary")
-                            else:
-                                out = create_batch_zip(data_map)
-                                st.download_button(f"⬇️ 下載 ZIP ({len(sel_cls)} 班)", out, "班級名單.zip", "application/zip", type="primary")
+                            def build_cls_export(out, progress, pool, df=df, sel_cls=list(sel_cls), fmt=fmt, sign_in=sign_in, doc_name=doc_name):
+                                data_map = {f"{c}班_{doc_name}": df[df["班級"]==c].sort_values("座號")[["班級","座號","姓名","社團","狀態"]] for c in sel_cls}
+                                return build_export(data_map, fmt, sign_in, out, progress, pool)
+                            job_key = export_job_key(reg_version, "class", sel_cls, fmt + (" 簽到表" if sign_in else ""))
+                            render_export_job(job_key, build_cls_export, f"⬇️ 下載 {ext.upper()} ({len(sel_cls)} 班)", f"班級{doc_name}.{ext}", mime)
                     else: st.info("無資料")
 
                 with tab_dl_club:
                     if not df.empty:
                         all_club = sorted(df["社團"].unique())
-                        sel_club = st.multiselect("選擇社團", all_club)
-                        if st.button("全選社團"): sel_club = all_club
+                        sel_club = st.multiselect("選擇社團", all_club, key="exp_club")
+                        st.button("全選社團", on_click=lambda: st.session_state.update(exp_club=all_club))
 
                         if sel_club:
-                            data_map = {f"{c}_名單": df[df["社團"]==c].sort_values(["班級","座號"])[["班級","座號","姓名","狀態"]] for c in sel_club}
-                            if "Word" in fmt:
-                                out = generate_merged_docx(data_map)
-                                st.download_button(f"⬇️ 下載 Word ({len(sel_club)} 社)", out, "社團名單.docx", "application/vnd.openxmlformats-officedocument.wordprocessingml.document", type="primary")
-                            else:
-                                out = create_batch_zip(data_map, file_type="Excel")
-                                st.download_button(f"⬇️ 下載 ZIP ({len(sel_club)} 社)", out, "社團名單.zip", "application/zip", type="primary")
+                            def build_club_export(out, progress, pool, df=df, sel_club=list(sel_club), fmt=fmt, sign_in=sign_in, doc_name=doc_name):
+                                data_map = {f"{c}_{doc_name}": df[df["社團"]==c].sort_values(["班級","座號"])[["班級","座號","姓名","狀態"]] for c in sel_club}
+                                return build_export(data_map, fmt, sign_in, out, progress, pool)
+                            job_key = export_job_key(reg_version, "club", sel_club, fmt + (" 簽到表" if sign_in else ""))
+                            render_export_job(job_key, build_club_export, f"⬇️ 下載 {ext.upper()} ({len(sel_club)} 社)", f"社團{doc_name}.{ext}", mime)
                     else: st.info("無資料")
 
             st.divider()
@@ -731,19 +1048,69 @@ if page == "🛠️ 管理員後台":
             dl1, dl2 = st.columns(2)
             if not df.empty:
                 dl1.download_button("📥 總表 CSV", df.to_csv(index=False).encode("utf-8-sig"), "registrations.csv", "text/csv")
-            if os.path.exists(STUDENT_LIST_FILE):
-                with open(STUDENT_LIST_FILE, "rb") as f:
-                    dl2.download_button("📥 學生名冊 Excel", f, "students.xlsx")
+            if not load_students_with_identity().empty:
+                dl2.download_button("📥 學生名冊 Excel", get_storage().export_students_xlsx(), "students.xlsx")
+
+        elif admin_tab == "⚡ 效能監控":
+            st.subheader("⚡ 效能監控 (本程序)")
+            c_win, c_btn = st.columns([3, 1])
+            window_label = c_win.radio("統計區間", ["1 分鐘", "5 分鐘", "15 分鐘"], index=1, horizontal=True)
+            c_btn.button("🔄 重新整理", use_container_width=True)
+            window_s = int(window_label.split()[0]) * 60
+
+            timers = metrics.timer_summary(since=window_s)
+            sessions = metrics.session_rates(window=min(window_s, 300))
+            lock_row = timers.get("lock_wait", {})
+            p1, p2, p3, p4 = st.columns(4)
+            p1.metric("線上連線", f"{len(sessions)}")
+            p2.metric("整頁重跑 / 分", f"{sum(s.get('rerun', 0) for s in sessions.values()):.1f}")
+            p3.metric("名額刷新 / 分", f"{sum(s.get('fragment', 0) for s in sessions.values()):.1f}")
+            p4.metric("搶鎖 p95", f"{lock_row.get('p95_ms', 0):.1f} ms")
+
+            st.markdown("##### ⏱️ 熱點耗時 (毫秒)")
+            if timers:
+                st.dataframe(pd.DataFrame([
+                    {"項目": name, "區間內次數": row["recent"], "p50": row["p50_ms"], "p95": row["p95_ms"], "p99": row["p99_ms"],
+                     "平均": row["avg_ms"], "累計次數": row["count"]}
+                    for name, row in timers.items()
+                ]).round(2), hide_index=True, use_container_width=True)
+            else: st.info("尚無資料")
+
+            c_cache, c_count = st.columns(2)
+            with c_cache:
+                st.markdown("##### 🎯 快取命中率")
+                rates = metrics.cache_hit_rates()
+                if rates:
+                    st.dataframe(pd.DataFrame([
+                        {"快取": name, "命中": hit, "未命中": miss, "命中率": f"{hit / (hit + miss):.1%}" if hit + miss else "-"}
+                        for name, (hit, miss) in sorted(rates.items())
+                    ]), hide_index=True, use_container_width=True)
+            with c_count:
+                st.markdown("##### 🔢 計數器")
+                counters = [{"指標": name, "標籤": ", ".join(f"{k}={v}" for k, v in labels), "數值": value}
+                            for (name, labels), value in sorted(metrics.counters().items()) if name != "cache_requests_total"]
+                if counters: st.dataframe(pd.DataFrame(counters), hide_index=True, use_container_width=True)
+
+            st.markdown("##### 👥 各連線重跑頻率 (次/分)")
+            if sessions:
+                st.dataframe(pd.DataFrame([
+                    {"連線": sid[:8], "整頁重跑": s.get("rerun", 0.0), "名額刷新": s.get("fragment", 0.0), "閒置秒數": s["last_seen"]}
+                    for sid, s in sorted(sessions.items(), key=lambda kv: -kv[1].get("rerun", 0))
+                ]).round(1), hide_index=True, use_container_width=True)
+
+            prom_text = metrics.prometheus_text(gauges={"registrations": len(get_registration_ledger())})
+            st.download_button("📥 下載 Prometheus 指標", prom_text.encode("utf-8"), "club_metrics.prom", "text/plain")
+            st.caption(f"每 10 秒自動寫入：{METRICS_FILE}")
 
 # ==========================================
 # 6. 學生報名
 # ==========================================
 elif page == "📝 學生報名":
-    if os.path.exists(STUDENT_LIST_FILE):
-        std_df = load_students_with_identity()
-        all_classes = sorted(std_df["班級"].unique())
-
-        st.markdown("<h2 style='text-align: center; color: #1E3A8A;'>📝 學生社團報名</h2>", unsafe_allow_html=True)
+    st.markdown("<h2 style='text-align: center; color: #1E3A8A;'>📝 學生社團報名</h2>", unsafe_allow_html=True)
+    render_admission_gate()
+    export_metrics()
+    roster = get_roster()
+    if len(roster):
 
         qp = st.query_params
         q_cls = qp.get("c")
@@ -762,14 +1129,14 @@ elif page == "📝 學生報名":
             sel_grade = c_grade.selectbox("年級", ["七年級", "八年級", "九年級"], index=default_grade_idx)
             
             prefix = "7" if sel_grade == "七年級" else "8" if sel_grade == "八年級" else "9"
-            target_classes = [c for c in all_classes if str(c).startswith(prefix)]
+            target_classes = roster.classes_for_grade(prefix)
             
             idx_class = target_classes.index(q_cls) if q_cls in target_classes else 0
             sel_class = c_class.selectbox("班級", target_classes, index=idx_class) if target_classes else None
 
             sel_seat = None
             if sel_class:
-                seats = sorted(std_df[std_df["班級"] == sel_class]["座號"].unique())
+                seats = roster.seats(sel_class)
                 idx_seat = seats.index(q_seat) if q_seat in seats else 0
                 sel_seat = c_seat.selectbox("座號", seats, index=idx_seat)
 
@@ -777,10 +1144,11 @@ elif page == "📝 學生報名":
             current_key = f"{sel_class}_{sel_seat}"
             if st.session_state.last_student != current_key:
                 st.session_state.id_verified = False
+                st.session_state.gate_done = False  # 換人就要重新排隊 (共用電腦)
                 st.session_state.last_student = current_key
                 st.query_params.clear()
 
-            row = std_df[(std_df["班級"] == sel_class) & (std_df["座號"] == sel_seat)].iloc[0]
+            row = roster.get(sel_class, sel_seat)
 
             if not st.session_state.id_verified:
                 with st.form("verify"):
@@ -795,17 +1163,23 @@ elif page == "📝 學生報名":
                             st.rerun()
                         else: st.error("學號錯誤")
             else:
+                # 已經報名過的同學只是來查看結果，不佔用等候室名額
+                if not st.session_state.get("gate_done", False):
+                    ledger = get_registration_ledger(); ledger.refresh()
+                    if ledger.lookup(sel_class, sel_seat) is not None:
+                        get_admission_gate().release(gate_ticket()); st.session_state.gate_done = True
                 c1, c2 = st.columns([3, 1])
                 with c1: st.success(f"👋 歡迎：{row['姓名']}")
                 with c2:
                     if st.button("🚪 登出", use_container_width=True):
                         st.session_state.id_verified = False
+                        st.session_state.gate_done = False
                         st.session_state.last_student = ""
                         st.query_params.clear()
                         st.rerun()
 
-                locked_club = str(row.get("鎖定社團", "")).strip()
-                is_locked_to_club = bool(locked_club and locked_club.lower() != "nan" and locked_club in config_data["clubs"])
+                locked_club = locked_club_of(row, config_data["clubs"])
+                is_locked_to_club = locked_club is not None
 
                 admin_set_identity = row.get("身分", "一般生")
                 is_locked = (admin_set_identity == "校隊學生")
@@ -814,25 +1188,38 @@ elif page == "📝 學生報名":
                 c_id_info.info(f"系統身分：{admin_set_identity}")
                 student_identity = c_id_sel.radio("身分", ["一般生", "校隊學生"], index=1 if is_locked else 0, disabled=is_locked, horizontal=True)
 
-                school_team_clubs = [c for c, data in config_data["clubs"].items() if "校隊" in str(data.get("category", ""))]
+                school_team_clubs = [c for c, data in config_data["clubs"].items() if is_team_club(data)]
                 if student_identity == "校隊學生" and not is_locked_to_club:
                     st.warning(f"🏅 僅顯示校隊社團：{', '.join(school_team_clubs)}")
 
                 if is_locked_to_club:
                     st.error(f"🔒 管理員已為您強制綁定：**{locked_club}**，您僅能選擇此社團。")
-                    clubs_to_show = [locked_club]
-                else:
-                    clubs_to_show = []
-                    for c, cfg in config_data["clubs"].items():
-                        is_team = "校隊" in str(cfg.get("category", ""))
-                        if student_identity == "校隊學生" and not is_team: continue
-                        clubs_to_show.append(c)
+                # 與 club_api 共用同一套規則
+                clubs_to_show = eligible_clubs(row, config_data["clubs"], student_identity)
 
-                @auto_refresh_fragment
+                # 只有帳本版本號改變時才維持每秒讀取，閒置分頁會自動拉長讀取間隔
+                @get_fragment_decorator(CLUB_REFRESH_MIN)
+                @metrics.timed("render_dynamic_clubs")
                 def render_dynamic_clubs():
-                    live = get_live_registrations()
-                    my_reg = live[(live["班級"]==sel_class) & (live["座號"]==sel_seat)]
-                    if not my_reg.empty: st.info(f"✅ 已報名：{my_reg.iloc[0]['社團']}")
+                    metrics.session_event(current_session_id(), "fragment")
+                    renew_gate_ticket()
+                    ledger = get_registration_ledger()
+                    if club_refresh_due():
+                        # 管理員改了社團或名額 (設定版本號改變)：整頁重跑以套用新設定
+                        if get_config_store().version != config_data["version"]: st.rerun()
+                        ledger.refresh()
+                        track_club_refresh(ledger.version)
+                    # 截止時間到了就不再提供報名按鈕 (送出時也會再檢查一次)
+                    phase = registration_phase(config_data, get_taiwan_now())
+                    if phase == "closed": st.warning(f"🔔 報名已於 {config_data['end_time']} 截止")
+                    elif phase != "open": st.warning("⏰ 目前不在報名時段內")
+                    my_reg = ledger.lookup(sel_class, sel_seat)
+                    if my_reg is not None and my_reg["狀態"] == "備取":
+                        c_w1, c_w2 = st.columns([3, 1])
+                        c_w1.info(f"📋 候補中：{my_reg['社團']}，目前第 {ledger.waitlist_position(sel_class, sel_seat)} 位 (有名額會自動遞補)")
+                        if c_w2.button("退出候補", use_container_width=True):
+                            leave_waitlist(ledger, get_registration_lock(), sel_class, sel_seat); st.rerun()
+                    elif my_reg is not None: st.info(f"✅ 已報名：{my_reg['社團']}")
 
                     for i in range(0, len(clubs_to_show), 2):
                         cols = st.columns(2)
@@ -841,27 +1228,41 @@ elif page == "📝 學生報名":
                                 c_name = clubs_to_show[i+j]
                                 cfg = config_data["clubs"][c_name]
                                 with cols[j].container(border=True):
-                                    current = len(live[live["社團"]==c_name])
+                                    current = ledger.count(c_name)
                                     limit = cfg["limit"]
                                     st.write(f"{c_name} ({cfg.get('category','')})")
                                     st.markdown(render_health_bar(limit, current), unsafe_allow_html=True)
-                                    if current >= limit: st.button("已滿", key=f"btn_{c_name}", disabled=True, use_container_width=True)
+                                    if current >= limit:
+                                        n_wait = ledger.waitlist_size(c_name)
+                                        if my_reg is None and phase == "open":
+                                            if st.button(f"已滿｜候補 ({n_wait} 人排隊)", key=f"btn_{c_name}", use_container_width=True):
+                                                confirm_submission(sel_class, sel_seat, row['姓名'], c_name, waitlist=True)
+                                        elif my_reg is not None and my_reg['社團'] == c_name and my_reg['狀態'] == "備取":
+                                            st.button("📋 候補中", key=f"btn_{c_name}", disabled=True, use_container_width=True)
+                                        else: st.button("已滿", key=f"btn_{c_name}", disabled=True, use_container_width=True)
                                     else:
-                                        if my_reg.empty:
+                                        if my_reg is None and phase == "open":
                                             if st.button("報名", key=f"btn_{c_name}", type="primary", use_container_width=True):
                                                 confirm_submission(sel_class, sel_seat, row['姓名'], c_name)
-                                        elif my_reg.iloc[0]['社團'] == c_name:
+                                        elif my_reg is None:
+                                            st.button("已截止", key=f"btn_{c_name}", disabled=True, use_container_width=True)
+                                        elif my_reg['社團'] == c_name:
                                             st.button("✅ 已選", key=f"btn_{c_name}", disabled=True, use_container_width=True)
                                         else:
                                             st.button("鎖定", key=f"btn_{c_name}", disabled=True, use_container_width=True)
                 
-                render_dynamic_clubs()
+                if config_data["mode"] == "ranked": render_preference_form(row, clubs_to_show, student_identity)
+                else:
+                    st.session_state.club_tick = CLUB_REFRESH_MAX  # 整頁重跑時一定重新讀取
+                    render_dynamic_clubs()
     else: st.error("請先匯入學生名冊")
 
 elif page == "🔍 查詢報名":
     st.markdown("<h2 style='text-align: center;'>🔍 查詢報名結果</h2>", unsafe_allow_html=True)
-    q = st.text_input("輸入姓名搜尋", placeholder="按 Enter 查詢")
+    q = st.text_input("輸入姓名或班級座號搜尋", placeholder="例如：陳景昇、陳、70102，按 Enter 查詢")
     if q:
-        res = reg_df[reg_df["姓名"] == q]
-        if not res.empty: st.table(res[["班級", "座號", "社團", "狀態"]])
+        ledger = get_registration_ledger()
+        ledger.refresh()
+        res = ledger.search(q)
+        if res: st.table(pd.DataFrame(res)[["班級", "座號", "姓名", "社團", "狀態", "比對"]])
         else: st.warning("查無資料")
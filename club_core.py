@@ -0,0 +1,1798 @@
+"""社團報名系統核心資料結構 (不依賴 Streamlit，可被其他程序共用)"""
+import bisect
+import copy
+import functools
+import hashlib
+import io
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import zipfile
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime
+
+import pandas as pd
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+REG_COLUMNS = ["班級", "座號", "姓名", "社團", "報名時間", "狀態", "順位"]
+PREF_COLUMNS = ["班級", "座號", "姓名", "志願", "填寫時間"]
+STUDENT_COLUMNS = ["班級", "座號", "姓名", "學號", "身分", "鎖定社團"]
+DEFAULT_CONFIG = {
+    "clubs": {"極地探險社": {"limit": 30, "category": "體育"}},
+    "start_time": "2026-02-09 08:00:00",
+    "end_time": "2026-02-09 17:00:00",
+    "admin_password": "0000",
+    "admit_rate": 5,
+    "max_active": 200,
+    "mode": "fcfs",
+    "max_choices": 3,
+    "lottery_seed": 0,
+    "version": 0
+}
+
+
+def read_config(path):
+    """讀取設定檔並補齊缺少的欄位，沒有檔案時回傳預設值"""
+    if not os.path.exists(path):
+        return copy.deepcopy(DEFAULT_CONFIG)
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    for c in data.get("clubs", {}):
+        if "category" not in data["clubs"][c]: data["clubs"][c]["category"] = "綜合"
+    for key in ("start_time", "end_time", "admin_password", "admit_rate", "max_active", "mode", "max_choices",
+                "lottery_seed", "version"):
+        if key not in data: data[key] = DEFAULT_CONFIG[key]
+    return data
+
+
+def write_config(path, config):
+    """整檔改寫設定檔：先寫暫存檔再替換，讀取端不會讀到寫一半的 JSON"""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, path)
+
+
+class ConfigStore:
+    """設定檔的記憶體快取：檔案簽章 (修改時間, 大小) 改變才重新讀取
+
+    每次 save 版本號 ("version") 加一並寫入檔案，下游快取 (社團卡片、標題圖、API) 以版本號判斷是否失效；
+    其他程序改寫設定檔時，下一次 get 就會讀到新版本。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._signature = object()
+        self._config = None
+
+    def peek(self):
+        """目前設定 (共用的快取物件，唯讀；要修改請用 get)"""
+        sig = file_signature(self.path)
+        hit = sig == self._signature
+        if not hit:
+            with self._lock:
+                if sig != self._signature:
+                    self._config = read_config(self.path)
+                    self._signature = sig
+        metrics.cache("config", hit)
+        return self._config
+
+    def get(self):
+        """目前設定的副本 (呼叫端可自由修改，改完以 save 寫回)"""
+        return copy.deepcopy(self.peek())
+
+    @property
+    def version(self):
+        return int(self.peek()["version"])
+
+    def save(self, config):
+        """寫回設定並把版本號加一 (以檔案上的版本為基準，多程序也不會倒退)，回傳新版本號"""
+        with self._lock:
+            on_disk = read_config(self.path)["version"] if os.path.exists(self.path) else 0
+            config["version"] = max(int(config.get("version", 0)), int(on_disk)) + 1
+            write_config(self.path, config)
+            self._config = copy.deepcopy(config)
+            self._signature = file_signature(self.path)
+        metrics.inc("config_writes_total")
+        return config["version"]
+
+
+def parse_config_time(text):
+    """設定檔的時間字串 ("2026-02-09 08:00:00")，格式錯誤回傳 None"""
+    try:
+        return datetime.strptime(str(text).strip(), "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        return None
+
+
+def registration_phase(config, now):
+    """報名時段："before" (尚未開放)、"open" 或 "closed" (已截止)；時間格式錯誤的一端視為不限制"""
+    start, end = parse_config_time(config.get("start_time")), parse_config_time(config.get("end_time"))
+    if start is not None and now < start:
+        return "before"
+    if end is not None and now >= end:
+        return "closed"
+    return "open"
+
+
+def is_team_club(cfg):
+    return "校隊" in str(cfg.get("category", ""))
+
+
+def locked_club_of(row, clubs):
+    """管理員為學生強制綁定、且仍存在的社團，沒有時回傳 None"""
+    locked = str(row.get("鎖定社團", "")).strip()
+    return locked if locked and locked.lower() != "nan" and locked in clubs else None
+
+
+def eligible_clubs(row, clubs, identity=None):
+    """學生可報名的社團：管理員鎖定社團 > 校隊學生只列校隊社團 > 全部
+
+    identity 為學生在頁面上自選的身分；管理員設定為校隊學生時不可改回一般生。
+    """
+    locked = locked_club_of(row, clubs)
+    if locked:
+        return [locked]
+    if row.get("身分", "一般生") == "校隊學生":
+        identity = "校隊學生"
+    return [c for c, cfg in clubs.items() if identity != "校隊學生" or is_team_club(cfg)]
+
+
+def file_signature(path):
+    """以 (修改時間, 檔案大小) 判斷檔案是否被改寫"""
+    try:
+        info = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (info.st_mtime_ns, info.st_size)
+
+
+def read_registrations_csv(path):
+    """讀取報名 CSV，檔案不存在 (或剛建立還沒寫入) 時回傳空表"""
+    if os.path.exists(path):
+        try:
+            return pd.read_csv(path, dtype={"班級": str, "座號": str, "順位": str})
+        except pd.errors.EmptyDataError:
+            pass
+    return pd.DataFrame(columns=REG_COLUMNS)
+
+
+def write_registrations_csv(path, df):
+    """整檔改寫報名 CSV：先寫暫存檔再替換，其他程序不會讀到寫一半的檔案"""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    df.to_csv(tmp_path, index=False, encoding="utf-8-sig")
+    os.replace(tmp_path, path)
+
+
+def append_registrations_csv(path, records):
+    """把報名資料附加到 CSV 尾端；舊版檔案 (表頭沒有「順位」欄) 先整檔改寫成新欄位"""
+    exists = os.path.exists(path) and os.path.getsize(path) > 0
+    if exists:
+        with open(path, encoding="utf-8-sig") as fh:
+            header = fh.readline().strip().split(",")
+        if header != REG_COLUMNS:
+            df = read_registrations_csv(path).reindex(columns=REG_COLUMNS)
+            write_registrations_csv(path, pd.concat([df, pd.DataFrame(records, columns=REG_COLUMNS)], ignore_index=True))
+            return
+    pd.DataFrame(records, columns=REG_COLUMNS).to_csv(
+        path, mode="a", index=False, header=not exists, encoding="utf-8-sig")
+
+
+def read_preferences_csv(path):
+    """讀取志願 CSV (同一位學生改填會附加新的一列，只保留最後一次)，檔案不存在時回傳空表"""
+    if path and os.path.exists(path):
+        try:
+            df = pd.read_csv(path, dtype=str).fillna("")
+            return df.drop_duplicates(["班級", "座號"], keep="last").reset_index(drop=True)
+        except pd.errors.EmptyDataError:
+            pass
+    return pd.DataFrame(columns=PREF_COLUMNS)
+
+
+def preference_choices(value):
+    """志願欄位 (JSON 字串) 轉成社團清單"""
+    try:
+        choices = json.loads(value) if isinstance(value, str) else value
+    except ValueError:
+        return []
+    return [str(c) for c in choices] if isinstance(choices, list) else []
+
+
+def normalize_students(df):
+    """補齊名冊欄位並把座號補成兩位數，回傳 (名冊, 是否有補欄位)"""
+    changed = False
+    if "身分" not in df.columns:
+        df["身分"] = "一般生"
+        changed = True
+    if "鎖定社團" not in df.columns:
+        df["鎖定社團"] = ""
+        changed = True
+    df["座號"] = df["座號"].astype(str).str.zfill(2)
+    df["身分"] = df["身分"].fillna("一般生")
+    df["鎖定社團"] = df["鎖定社團"].fillna("")
+    return df, changed
+
+
+def key_mask(df, keys):
+    """向量化比對 (班級, 座號)，回傳布林遮罩"""
+    keys = list(keys)
+    if df.empty or not keys:
+        return pd.Series(False, index=df.index)
+    wanted = pd.MultiIndex.from_tuples([(str(c), str(s)) for c, s in keys])
+    return pd.Series(pd.MultiIndex.from_arrays([df["班級"].astype(str), df["座號"].astype(str)]).isin(wanted), index=df.index)
+
+
+# ------------------------------------------
+# [核心 8] 效能監控
+# ------------------------------------------
+def _label_text(labels):
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}" if labels else ""
+
+
+class Metrics:
+    """程序內的效能計數：計時 (保留最近的樣本算滾動百分位)、計數器、各連線的重跑次數
+
+    只用標準函式庫，可輸出 Prometheus 文字格式給 node_exporter textfile collector 讀取。
+    """
+
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self, window=2000, session_ttl=600):
+        self.window = window
+        self.session_ttl = session_ttl
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._timers = {}      # name -> {"samples": deque[(時間, 秒)], "count", "sum"}
+        self._counters = {}    # (name, labels) -> 累計值
+        self._sessions = {}    # session id -> {kind: deque[時間]}
+        self._last_export = 0.0
+
+    # --- 記錄 ---
+    def observe(self, name, seconds):
+        with self._lock:
+            timer = self._timers.get(name)
+            if timer is None:
+                timer = self._timers[name] = {"samples": deque(maxlen=self.window), "count": 0, "sum": 0.0}
+            timer["samples"].append((time.time(), seconds))
+            timer["count"] += 1
+            timer["sum"] += seconds
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t0)
+
+    def timed(self, name):
+        """函式裝飾器：記錄每次呼叫耗時 (st.rerun 等例外也照常記錄)"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def cache(self, name, hit):
+        self.inc("cache_requests_total", cache=name, result="hit" if hit else "miss")
+
+    def session_event(self, session_id, kind="rerun"):
+        """記錄某連線的一次整頁重跑 / fragment 刷新"""
+        now = time.time()
+        with self._lock:
+            events = self._sessions.setdefault(session_id, {})
+            events.setdefault(kind, deque(maxlen=600)).append(now)
+
+    # --- 讀取 ---
+    def timer_summary(self, since=None):
+        """各計時項目：最近 since 秒內的 p50/p95/p99 (毫秒) 與累計次數"""
+        cutoff = time.time() - since if since else 0
+        with self._lock:
+            timers = {n: ([s for t, s in v["samples"] if t >= cutoff], v["count"], v["sum"]) for n, v in self._timers.items()}
+        out = {}
+        for name, (samples, count, total) in sorted(timers.items()):
+            samples.sort()
+            row = {"count": count, "recent": len(samples), "sum_s": total, "avg_ms": total / count * 1000 if count else 0.0}
+            for q in self.QUANTILES:
+                row[f"p{int(q * 100)}_ms"] = samples[min(len(samples) - 1, int(len(samples) * q))] * 1000 if samples else 0.0
+            out[name] = row
+        return out
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def cache_hit_rates(self):
+        """各快取的命中率 {名稱: (命中, 未命中)}"""
+        rates = {}
+        for (name, labels), value in self.counters().items():
+            if name == "cache_requests_total":
+                labels = dict(labels)
+                hit, miss = rates.get(labels["cache"], (0, 0))
+                rates[labels["cache"]] = (hit + value, miss) if labels["result"] == "hit" else (hit, miss + value)
+        return rates
+
+    def session_rates(self, window=60):
+        """各連線最近 window 秒內每分鐘的重跑次數；閒置超過 session_ttl 的連線會被清掉"""
+        now = time.time()
+        out = {}
+        with self._lock:
+            for sid in list(self._sessions):
+                events = self._sessions[sid]
+                last = max((d[-1] for d in events.values() if d), default=0)
+                if now - last > self.session_ttl:
+                    del self._sessions[sid]
+                    continue
+                out[sid] = {kind: sum(1 for t in d if t >= now - window) * 60 / window for kind, d in events.items()}
+                out[sid]["last_seen"] = now - last
+        return out
+
+    # --- 輸出 ---
+    def prometheus_text(self, prefix="club", gauges=None):
+        """Prometheus text exposition format；gauges 可額外放入 {名稱: 數值} 的即時量表"""
+        lines = []
+        for name, row in self.timer_summary().items():
+            metric = f"{prefix}_{name}_seconds"
+            lines.append(f"# TYPE {metric} summary")
+            for q in self.QUANTILES:
+                lines.append(f'{metric}{{quantile="{q}"}} {row[f"p{int(q * 100)}_ms"] / 1000:.6f}')
+            lines.append(f"{metric}_sum {row['sum_s']:.6f}")
+            lines.append(f"{metric}_count {row['count']}")
+        typed = set()
+        for (name, labels), value in sorted(self.counters().items()):
+            metric = f"{prefix}_{name}"
+            if metric not in typed:
+                lines.append(f"# TYPE {metric} counter")
+                typed.add(metric)
+            lines.append(f"{metric}{_label_text(labels)} {value}")
+        sessions = self.session_rates()
+        gauges = dict(gauges or {}, active_sessions=len(sessions),
+                      uptime_seconds=round(time.time() - self.started, 1))
+        for name, value in sorted(gauges.items()):
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            lines.append(f"{prefix}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path, interval=10, gauges=None):
+        """每 interval 秒最多寫一次 Prometheus 文字檔 (先寫暫存檔再替換)，回傳是否有寫入
+
+        gauges 可傳函式，只在真的要寫檔時才呼叫 (避免每次都計算)。
+        """
+        now = time.time()
+        with self._lock:
+            if now - self._last_export < interval:
+                return False
+            self._last_export = now
+        if callable(gauges): gauges = gauges()
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text(gauges=gauges))
+        os.replace(tmp_path, path)
+        return True
+
+
+# 全程序共用 (club_core 只會被匯入一次，Streamlit 每次重跑主程式也不會重建)
+metrics = Metrics()
+
+
+# ------------------------------------------
+# [核心 4] 跨程序報名鎖
+# ------------------------------------------
+class RegistrationLock:
+    """以作業系統檔案鎖保護「檢查名額 + 寫入」，多個 Streamlit 程序也共用同一把鎖
+
+    每次取得鎖都會記錄等待時間，供後台觀察 08:00 開放時的搶鎖狀況。
+    """
+
+    def __init__(self, lock_path, history=2000):
+        self.lock_path = lock_path
+        self._stats_lock = threading.Lock()
+        self._waits = deque(maxlen=history)
+        self._count = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    @contextmanager
+    def hold(self):
+        """取得獨佔鎖，離開 with 區塊時釋放"""
+        t0 = time.perf_counter()
+        with open(self.lock_path, "a+b") as fh:
+            if fcntl is not None:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+            else:
+                fh.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(fh.fileno(), msvcrt.LK_NBLCK, 1)
+                        break
+                    except OSError:
+                        time.sleep(0.005)
+            self._record_wait(time.perf_counter() - t0)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+                else:
+                    fh.seek(0)
+                    msvcrt.locking(fh.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def _record_wait(self, seconds):
+        metrics.observe("lock_wait", seconds)
+        with self._stats_lock:
+            self._waits.append(seconds)
+            self._count += 1
+            self._total_wait += seconds
+            self._max_wait = max(self._max_wait, seconds)
+
+    def stats(self):
+        """回傳本程序的鎖等待統計 (毫秒)"""
+        with self._stats_lock:
+            recent = sorted(self._waits)
+            count, total, longest = self._count, self._total_wait, self._max_wait
+        p95 = recent[min(len(recent) - 1, int(len(recent) * 0.95))] if recent else 0.0
+        return {
+            "count": count,
+            "avg_ms": total / count * 1000 if count else 0.0,
+            "p95_ms": p95 * 1000,
+            "max_ms": longest * 1000,
+        }
+
+
+# ------------------------------------------
+# [核心 2] 報名搜尋索引
+# ------------------------------------------
+_CLASS_SEAT_QUERY = re.compile(r"(\d{3})\s*[-_ ]?\s*(\d{1,2})?")
+_char_sounds = {}
+_pinyin = None  # pypinyin 載入要 0.3 秒，第一次做同音比對時才匯入
+
+
+def _lazy_pinyin():
+    global _pinyin
+    if _pinyin is None:
+        try:
+            from pypinyin import lazy_pinyin as _pinyin
+        except ImportError:  # 沒安裝 pypinyin 時略過同音字比對
+            _pinyin = False
+    return _pinyin
+
+
+def name_sound(name):
+    """姓名的無聲調拼音 (同音字比對用)，逐字快取"""
+    lazy_pinyin = _lazy_pinyin()
+    if not lazy_pinyin:
+        return None
+    parts = []
+    for ch in name:
+        sound = _char_sounds.get(ch)
+        if sound is None:
+            sound = _char_sounds[ch] = lazy_pinyin(ch)[0]
+        parts.append(sound)
+    return " ".join(parts)
+
+
+class RegistrationSearchIndex:
+    """報名資料搜尋索引，隨帳本增刪即時維護
+
+    支援：姓名完全比對、姓名開頭、班級 (701) 或班級座號 (70105 / 701-05)、
+    同音字 (需 pypinyin) 與一個字的錯字/漏字/多字。
+    同音索引在第一次搜尋時才建立，只報名不查詢的程序不會載入 pypinyin。
+    """
+
+    MATCH_LABELS = {"exact": "完全符合", "seat": "班級座號", "prefix": "開頭符合", "sound": "同音", "typo": "相似"}
+
+    def __init__(self):
+        self._by_name = {}
+        self._names = []
+        self._by_class = {}
+        self._variants = {}
+        self._by_sound = None
+
+    def add(self, name, key):
+        keys = self._by_name.get(name)
+        if keys is None:
+            keys = self._by_name[name] = set()
+            bisect.insort(self._names, name)
+            self._index_name(name, add=True)
+        keys.add(key)
+        self._by_class.setdefault(key[0], set()).add(key)
+
+    def discard(self, name, key):
+        keys = self._by_name.get(name)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_name[name]
+                del self._names[bisect.bisect_left(self._names, name)]
+                self._index_name(name, add=False)
+        cls_keys = self._by_class.get(key[0])
+        if cls_keys is not None:
+            cls_keys.discard(key)
+            if not cls_keys:
+                del self._by_class[key[0]]
+
+    def _index_name(self, name, add):
+        buckets = [(self._variants, (i, name[:i] + name[i + 1:])) for i in range(len(name))]
+        sound = name_sound(name) if self._by_sound is not None else None
+        if sound:
+            buckets.append((self._by_sound, sound))
+        for table, bucket_key in buckets:
+            if add:
+                table.setdefault(bucket_key, set()).add(name)
+            else:
+                names = table.get(bucket_key)
+                if names is not None:
+                    names.discard(name)
+                    if not names:
+                        del table[bucket_key]
+
+    def names(self, name):
+        """完全符合的 (班級, 座號)"""
+        return sorted(self._by_name.get(name, ()))
+
+    def search(self, query, limit=50):
+        """回傳 [(比對方式, (班級, 座號))]，依 完全符合 > 班級座號 > 開頭 > 同音 > 相似 排序"""
+        query = query.strip()
+        if not query:
+            return []
+        found, seen = [], set()
+
+        def take(kind, keys):
+            for k in keys:
+                if k not in seen and len(found) < limit:
+                    seen.add(k)
+                    found.append((kind, k))
+
+        def keys_of(names):
+            return [k for n in sorted(names) for k in sorted(self._by_name.get(n, ()))]
+
+        take("exact", self.names(query))
+        m = _CLASS_SEAT_QUERY.fullmatch(query)
+        if m:
+            cls_keys = self._by_class.get(m.group(1), set())
+            if m.group(2):
+                key = (m.group(1), m.group(2).zfill(2))
+                take("seat", [key] if key in cls_keys else [])
+            else:
+                take("seat", sorted(cls_keys))
+        start = bisect.bisect_left(self._names, query)
+        prefixed = []
+        for n in self._names[start:]:
+            if not n.startswith(query) or len(prefixed) >= limit:
+                break
+            prefixed.append(n)
+        take("prefix", keys_of(prefixed))
+        if self._by_sound is None:
+            self._by_sound = {}
+            for n in self._names:
+                s = name_sound(n)
+                if s:
+                    self._by_sound.setdefault(s, set()).add(n)
+        sound = name_sound(query)
+        if sound:
+            take("sound", keys_of(self._by_sound.get(sound, ())))
+        typos = set()
+        for i in range(len(query) + 1):
+            typos |= self._variants.get((i, query), set())          # 漏打一個字
+        for i in range(len(query)):
+            shorter = query[:i] + query[i + 1:]
+            if shorter in self._by_name:
+                typos.add(shorter)                                   # 多打一個字
+            if len(query) >= 3:
+                typos |= self._variants.get((i, shorter), set())     # 打錯一個字
+        take("typo", keys_of(typos))
+        return found
+
+
+# ------------------------------------------
+# [核心 3] 報名帳本
+# ------------------------------------------
+def waitlist_order(rec):
+    """備取遞補順序：有分發順位的依順位，其次依報名 (候補) 時間，最後依班級、座號"""
+    rank = str(rec.get("順位", "")).strip()
+    return (int(rank) if rank.isdigit() else float("inf"), str(rec["報名時間"]), str(rec["班級"]), str(rec["座號"]))
+
+
+class RegistrationLedger:
+    """常駐記憶體的報名帳本：社團人數計數 + (班級, 座號) 索引 + 姓名索引 + 各社團備取佇列
+
+    帳本只在第一次建立、或偵測到檔案被其他程序改寫時才重新讀檔；
+    本程序成功寫入後以 apply_added / apply_removed 就地更新。
+    看板用的彙總 (各社團/班級名單、狀態人數、未報名學生) 也隨每筆增刪就地維護；
+    分頁表格用的已排序 key 串列則在所屬群組有異動時才丟棄、下次取用再排序。
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.version = 0
+        self._lock = threading.RLock()
+        self._signature = object()
+        self._records = {}
+        self._counts = {}
+        self._waitlists = {}  # 社團 -> 依 waitlist_order 排序的串列 (bisect 維護)
+        self._club_keys, self._class_keys, self._status_counts = {}, {}, Counter()
+        self._roster, self._unregistered = None, {}  # 班級 -> 未報名座號 (track_roster 指定名冊後才維護)
+        self._sorted = {}  # ("club"/"class"/"unreg", 名稱) -> 已排序的 (班級, 座號)；("unreg", None) 為全部班級
+        self._search = RegistrationSearchIndex()
+        self.refresh()
+
+    def refresh(self):
+        """儲存層簽章改變時重建帳本，回傳是否有重新讀檔"""
+        sig = self.storage.registrations_signature()
+        if sig == self._signature:
+            metrics.cache("ledger", True)
+            return False
+        with self._lock:
+            if sig == self._signature:
+                metrics.cache("ledger", True)
+                return False
+            metrics.cache("ledger", False)
+            df = self.storage.load_registrations()
+            metrics.inc("rows_read_total", len(df), source="ledger")
+            self._rebuild(df)
+            # 讀檔途中被其他程序附加資料 (可能讀到半行)：不記下簽章，下次刷新再讀一次
+            self._signature = sig if self.storage.registrations_signature() == sig else object()
+            self.version += 1
+        return True
+
+    def _rebuild(self, df):
+        self._records, self._counts, self._waitlists, self._search = {}, {}, {}, RegistrationSearchIndex()
+        self._club_keys, self._class_keys, self._status_counts, self._unregistered = {}, {}, Counter(), {}
+        self._sorted = {}
+        if not df.empty:
+            df = df.reindex(columns=REG_COLUMNS).fillna("")
+            for rec in df.to_dict("records"):
+                self._insert(rec)
+        self._index_unregistered()
+
+    def _index_unregistered(self):
+        self._unregistered = {}
+        self._sorted = {g: keys for g, keys in self._sorted.items() if g[0] != "unreg"}
+        if self._roster is None:
+            return
+        for cls in self._roster.classes:
+            seats = {s for s in self._roster.seats(cls) if (cls, s) not in self._records}
+            if seats:
+                self._unregistered[cls] = seats
+
+    def _insert(self, rec):
+        key = (str(rec["班級"]), str(rec["座號"]))
+        rec.setdefault("順位", "")
+        old = self._records.get(key)
+        if old is not None:
+            self._delete(key)
+        self._records[key] = rec
+        if rec["狀態"] == "正取":
+            self._counts[rec["社團"]] = self._counts.get(rec["社團"], 0) + 1
+        elif rec["狀態"] == "備取":
+            bisect.insort(self._waitlists.setdefault(rec["社團"], []), waitlist_order(rec))
+        self._club_keys.setdefault(rec["社團"], set()).add(key)
+        self._class_keys.setdefault(key[0], set()).add(key)
+        self._touch(rec["社團"], key[0])
+        self._status_counts[rec["狀態"]] += 1
+        seats = self._unregistered.get(key[0])
+        if seats is not None:
+            seats.discard(key[1])
+            if not seats:
+                del self._unregistered[key[0]]
+        self._search.add(str(rec["姓名"]), key)
+
+    def _delete(self, key):
+        rec = self._records.pop(key, None)
+        if rec is None:
+            return
+        if rec["狀態"] == "正取":
+            self._counts[rec["社團"]] -= 1
+            if self._counts[rec["社團"]] <= 0:
+                del self._counts[rec["社團"]]
+        elif rec["狀態"] == "備取":
+            queue = self._waitlists[rec["社團"]]
+            del queue[bisect.bisect_left(queue, waitlist_order(rec))]
+            if not queue:
+                del self._waitlists[rec["社團"]]
+        for table, group in ((self._club_keys, rec["社團"]), (self._class_keys, key[0])):
+            table[group].discard(key)
+            if not table[group]:
+                del table[group]
+        self._status_counts[rec["狀態"]] -= 1
+        self._touch(rec["社團"], key[0])
+        if self._roster is not None and key in self._roster:
+            self._unregistered.setdefault(key[0], set()).add(key[1])
+        self._search.discard(str(rec["姓名"]), key)
+
+    def _touch(self, club, cls):
+        for group in (("club", club), ("class", cls), ("unreg", cls), ("unreg", None)):
+            self._sorted.pop(group, None)
+
+    def _sorted_keys(self, group, keys):
+        out = self._sorted.get(group)
+        if out is None:
+            out = self._sorted[group] = sorted(keys)
+        return out
+
+    def apply_changes(self, remove_keys=(), add_records=()):
+        """本程序寫入成功後，就地套用「先刪除、再新增」的異動"""
+        with self._lock:
+            for key in remove_keys:
+                self._delete((str(key[0]), str(key[1])))
+            for rec in add_records:
+                self._insert(dict(rec))
+            self._signature = self.storage.registrations_signature()
+            self.version += 1
+
+    def apply_added(self, records):
+        """本程序寫入成功後，把新報名資料加入帳本"""
+        self.apply_changes(add_records=records)
+
+    def apply_removed(self, keys):
+        """本程序寫入成功後，從帳本移除指定 (班級, 座號)"""
+        self.apply_changes(remove_keys=keys)
+
+    def count(self, club):
+        """社團目前正取人數 O(1) (備取不佔名額)"""
+        return self._counts.get(club, 0)
+
+    def counts(self):
+        """所有社團正取人數的快照"""
+        with self._lock:
+            return dict(self._counts)
+
+    def waitlist(self, club, n=None):
+        """社團備取名單 (依遞補順序) 的前 n 位 (班級, 座號)"""
+        with self._lock:
+            return [entry[-2:] for entry in self._waitlists.get(club, [])[:n]]
+
+    def waitlist_size(self, club):
+        return len(self._waitlists.get(club, ()))
+
+    def waitlisted_clubs(self):
+        with self._lock:
+            return list(self._waitlists)
+
+    def waitlist_position(self, cls, seat):
+        """學生的備取序號 (第幾位，二分搜尋 O(log n))，不是備取時回傳 None"""
+        with self._lock:
+            rec = self._records.get((str(cls), str(seat)))
+            if rec is None or rec["狀態"] != "備取":
+                return None
+            return bisect.bisect_left(self._waitlists[rec["社團"]], waitlist_order(rec)) + 1
+
+    def lookup(self, cls, seat):
+        """查詢某位學生的報名資料，未報名回傳 None"""
+        return self._records.get((str(cls), str(seat)))
+
+    def records(self):
+        """所有報名資料的快照"""
+        with self._lock:
+            return list(self._records.values())
+
+    # --- 看板彙總 (與名冊、報名總數無關，只和顯示的筆數有關) ---
+    def track_roster(self, roster):
+        """指定名冊快照 (RosterIndex)；名冊換新時重建未報名索引 O(N)，之後隨報名增刪就地更新"""
+        with self._lock:
+            if roster is not self._roster:
+                self._roster = roster
+                self._index_unregistered()
+
+    def status_counts(self):
+        """{狀態: 人數}"""
+        with self._lock:
+            return {s: n for s, n in self._status_counts.items() if n}
+
+    def club_totals(self):
+        """各社團報名人數 (含備取)"""
+        with self._lock:
+            return {c: len(keys) for c, keys in self._club_keys.items()}
+
+    def class_counts(self):
+        """各班報名人數"""
+        with self._lock:
+            return {c: len(keys) for c, keys in self._class_keys.items()}
+
+    def keys_where(self, club=None, cls=None):
+        """某社團或某班的 (班級, 座號)，依班級、座號排序 (共用快取，請勿修改)"""
+        with self._lock:
+            if club is not None:
+                return self._sorted_keys(("club", club), self._club_keys.get(club, ()))
+            return self._sorted_keys(("class", str(cls)), self._class_keys.get(str(cls), ()))
+
+    def records_where(self, club=None, cls=None):
+        """某社團或某班的報名資料，依班級、座號排序"""
+        with self._lock:
+            return [self._records[k] for k in self.keys_where(club, cls)]
+
+    def records_of(self, keys):
+        """依序取出指定 (班級, 座號) 的報名資料 (分頁表格只組目前這一頁)，已不存在的略過"""
+        with self._lock:
+            return [self._records[k] for k in keys if k in self._records]
+
+    def unregistered_count(self):
+        """名冊中尚未報名的人數 (需先 track_roster)"""
+        with self._lock:
+            return sum(len(seats) for seats in self._unregistered.values())
+
+    def unregistered_classes(self):
+        with self._lock:
+            return sorted(self._unregistered)
+
+    def unregistered(self, cls=None):
+        """未報名學生的 (班級, 座號)，可只取某一班；回傳快取的清單，呼叫端不可修改"""
+        with self._lock:
+            if cls is not None:
+                cls = str(cls)
+                return self._sorted_keys(("unreg", cls), ((cls, s) for s in self._unregistered.get(cls, ())))
+            out = self._sorted.get(("unreg", None))
+            if out is None:
+                out = []
+                for c in sorted(self._unregistered):
+                    out += self._sorted_keys(("unreg", c), ((c, s) for s in self._unregistered[c]))
+                self._sorted[("unreg", None)] = out
+            return out
+
+    def find_by_name(self, name):
+        """依姓名查詢報名資料"""
+        with self._lock:
+            return [self._records[k] for k in self._search.names(name)]
+
+    def search(self, query, limit=50):
+        """姓名/開頭/班級座號/同音/錯字搜尋，回傳報名資料 (多一個「比對」欄位)"""
+        with self._lock:
+            return [{**self._records[k], "比對": RegistrationSearchIndex.MATCH_LABELS[kind]}
+                    for kind, k in self._search.search(query, limit)]
+
+    def __len__(self):
+        return len(self._records)
+
+
+# ------------------------------------------
+# [核心 5] 名冊快取與索引
+# ------------------------------------------
+class RosterIndex:
+    """名冊的唯讀快照：欄位陣列 + 年級 → 班級、班級 → 座號、(班級, 座號) → 列 三組索引"""
+
+    def __init__(self, df):
+        self.df = df
+        self._columns = {c: df[c].to_numpy() for c in df.columns}
+        valid = df[df["班級"].notna() & df["座號"].notna()]
+        self._positions = {
+            (str(c), str(s)): i
+            for c, s, i in zip(valid["班級"], valid["座號"], df.index.get_indexer(valid.index))
+        }
+        self._class_seats = {
+            str(c): sorted(str(s) for s in seats.unique())
+            for c, seats in valid.groupby("班級", sort=True)["座號"]
+        }
+        self.classes = sorted(self._class_seats)
+        self._grade_classes = {}
+        for c in self.classes:
+            self._grade_classes.setdefault(c[:1], []).append(c)
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def classes_for_grade(self, prefix):
+        """年級代碼 (7/8/9) 底下的班級"""
+        return self._grade_classes.get(str(prefix), [])
+
+    def seats(self, cls):
+        """某班的座號清單"""
+        return self._class_seats.get(str(cls), [])
+
+    def get(self, cls, seat):
+        """以 (班級, 座號) 取得學生資料 dict，找不到回傳 None"""
+        pos = self._positions.get((str(cls), str(seat)))
+        if pos is None:
+            return None
+        return {c: values[pos] for c, values in self._columns.items()}
+
+
+class RosterCache:
+    """依儲存層簽章 (檔案修改時間或資料庫版本號) 失效的名冊快取"""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self._lock = threading.Lock()
+        self._signature = object()
+        self._index = None
+
+    def get(self):
+        """取得最新的 RosterIndex，名冊沒變動時不會重新讀取 Excel"""
+        sig = self.storage.students_signature()
+        hit = sig == self._signature
+        if not hit:
+            with self._lock:
+                if sig != self._signature:
+                    df = self.storage.load_students().reset_index(drop=True)
+                    metrics.inc("rows_read_total", len(df), source="roster")
+                    self._index = RosterIndex(df)
+                    self._signature = sig
+        metrics.cache("roster", hit)
+        return self._index
+
+
+# ------------------------------------------
+# [核心 6] 儲存層 (CSV/XLSX 或 SQLite)
+# ------------------------------------------
+class CsvXlsxStorage:
+    """原始檔案格式：報名存 club_registrations.csv，名冊存 students.xlsx，志願存 club_preferences.csv
+
+    除了「附加一筆報名」之外，其他異動都必須整檔改寫。
+    """
+
+    kind = "csv"
+
+    def __init__(self, reg_path, student_path, pref_path=None):
+        self.reg_path = reg_path
+        self.student_path = student_path
+        self.pref_path = pref_path
+        self._pref_index = (None, {})  # (檔案簽章, {(班級, 座號): 志願紀錄})
+
+    # --- 報名資料 ---
+    def load_registrations(self):
+        return read_registrations_csv(self.reg_path)
+
+    def registrations_signature(self):
+        return file_signature(self.reg_path)
+
+    def change_registrations(self, remove_keys=(), add_records=()):
+        """刪除指定 (班級, 座號) 並新增報名資料，一次寫入"""
+        remove_keys = list(remove_keys)
+        if not remove_keys:
+            if add_records:
+                append_registrations_csv(self.reg_path, list(add_records))
+            return
+        df = self.load_registrations().reindex(columns=REG_COLUMNS)
+        df = df[~key_mask(df, remove_keys)]
+        if add_records:
+            df = pd.concat([df, pd.DataFrame(list(add_records), columns=REG_COLUMNS)], ignore_index=True)
+        write_registrations_csv(self.reg_path, df)
+
+    def rekey_registration(self, old_key, new_key):
+        df = self.load_registrations()
+        mask = key_mask(df, [old_key])
+        if mask.any():
+            df.loc[mask, "班級"], df.loc[mask, "座號"] = new_key
+            write_registrations_csv(self.reg_path, df)
+
+    def clear_registrations(self):
+        write_registrations_csv(self.reg_path, pd.DataFrame(columns=REG_COLUMNS))
+
+    # --- 志願 (志願序分發模式) ---
+    def load_preferences(self):
+        return read_preferences_csv(self.pref_path)
+
+    def preferences_signature(self):
+        return file_signature(self.pref_path)
+
+    def find_preference(self, cls, seat):
+        """查一位學生的志願紀錄 (dict)，沒有填過回傳 None；檔案沒變動時直接查快取索引"""
+        signature = file_signature(self.pref_path)
+        if signature != self._pref_index[0]:
+            df = self.load_preferences()
+            self._pref_index = (signature, {(c, s): rec for c, s, rec in zip(df["班級"], df["座號"], df.to_dict("records"))})
+        return self._pref_index[1].get((str(cls), str(seat)))
+
+    def save_preference(self, record):
+        """新增或覆蓋一位學生的志願 (附加一列，讀取時以最後一列為準；呼叫端需持有報名鎖)"""
+        exists = os.path.exists(self.pref_path) and os.path.getsize(self.pref_path) > 0
+        pd.DataFrame([record], columns=PREF_COLUMNS).to_csv(
+            self.pref_path, mode="a", index=False, header=not exists, encoding="utf-8-sig")
+
+    def clear_preferences(self):
+        write_registrations_csv(self.pref_path, pd.DataFrame(columns=PREF_COLUMNS))
+
+    # --- 學生名冊 ---
+    def load_students(self):
+        if not os.path.exists(self.student_path):
+            return pd.DataFrame(columns=STUDENT_COLUMNS)
+        df = pd.read_excel(self.student_path, dtype={"班級": str, "座號": str, "學號": str, "鎖定社團": str})
+        return normalize_students(df)[0]
+
+    def students_signature(self):
+        return file_signature(self.student_path)
+
+    def add_students(self, records):
+        df = pd.concat([self.load_students(), pd.DataFrame(list(records))], ignore_index=True)
+        try: df = df.sort_values(by=["班級", "座號"])
+        except Exception: pass
+        df.to_excel(self.student_path, index=False)
+
+    def remove_students(self, keys):
+        df = self.load_students()
+        df[~key_mask(df, keys)].to_excel(self.student_path, index=False)
+
+    def update_students(self, keys, values):
+        """更新指定學生的欄位，回傳更新人數"""
+        df = self.load_students()
+        mask = key_mask(df, keys)
+        if mask.any():
+            for col, val in values.items():
+                df.loc[mask, col] = val
+            df.to_excel(self.student_path, index=False)
+        return int(mask.sum())
+
+    def rekey_student(self, old_key, new_key):
+        df = self.load_students()
+        mask = key_mask(df, [old_key])
+        df.loc[mask, "班級"], df.loc[mask, "座號"] = new_key
+        df.to_excel(self.student_path, index=False)
+
+    def replace_students(self, df):
+        """整份名冊換新：先寫暫存檔再替換，讀取端不會讀到寫一半的 Excel"""
+        root, ext = os.path.splitext(self.student_path)
+        tmp_path = f"{root}.{os.getpid()}.{threading.get_ident()}.tmp{ext}"
+        df.to_excel(tmp_path, index=False)
+        os.replace(tmp_path, self.student_path)
+
+    def clear_students(self):
+        if os.path.exists(self.student_path):
+            os.remove(self.student_path)
+
+    def export_students_xlsx(self):
+        with open(self.student_path, "rb") as fh:
+            return fh.read()
+
+
+REG_INSERT = f"INSERT INTO registrations ({', '.join(REG_COLUMNS)}) VALUES ({', '.join('?' * len(REG_COLUMNS))})"
+
+
+class SQLiteStorage:
+    """嵌入式 SQLite (WAL 模式)：單筆報名或單一學生異動只寫一列
+
+    第一次建立資料庫時，會自動匯入既有的 CSV 與 XLSX；
+    CSV/XLSX 仍可作為匯入、匯出格式使用。
+    """
+
+    kind = "sqlite"
+
+    def __init__(self, db_path, reg_path=None, student_path=None):
+        self.db_path = db_path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(db_path, timeout=10, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS registrations (
+                班級 TEXT NOT NULL, 座號 TEXT NOT NULL, 姓名 TEXT, 社團 TEXT, 報名時間 TEXT, 狀態 TEXT,
+                順位 TEXT DEFAULT '', PRIMARY KEY (班級, 座號));
+            CREATE INDEX IF NOT EXISTS idx_reg_club ON registrations (社團);
+            CREATE INDEX IF NOT EXISTS idx_reg_name ON registrations (姓名);
+            CREATE TABLE IF NOT EXISTS students (
+                班級 TEXT NOT NULL, 座號 TEXT NOT NULL, 姓名 TEXT, 學號 TEXT, 身分 TEXT, 鎖定社團 TEXT, extra TEXT,
+                PRIMARY KEY (班級, 座號));
+            CREATE INDEX IF NOT EXISTS idx_std_name ON students (姓名);
+            CREATE TABLE IF NOT EXISTS preferences (
+                班級 TEXT NOT NULL, 座號 TEXT NOT NULL, 姓名 TEXT, 志願 TEXT, 填寫時間 TEXT,
+                PRIMARY KEY (班級, 座號));
+            INSERT OR IGNORE INTO meta VALUES ('registrations', 0), ('students', 0), ('imported', 0), ('preferences', 0);
+        """)
+        # 舊版資料庫沒有「順位」欄
+        if "順位" not in [r[1] for r in self._conn.execute("PRAGMA table_info(registrations)")]:
+            self._conn.execute("ALTER TABLE registrations ADD COLUMN 順位 TEXT DEFAULT ''")
+        # 舊版匯入時把缺少班級或座號的列 (表尾) 也寫成了學生
+        if self._conn.execute("SELECT 1 FROM students WHERE 班級 = '' OR 座號 = '' LIMIT 1").fetchone():
+            with self._write("students") as conn:
+                conn.execute("DELETE FROM students WHERE 班級 = '' OR 座號 = ''")
+        if not self._meta("imported"):
+            self.import_files(reg_path, student_path)
+
+    def _meta(self, key):
+        with self._lock:
+            return self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()[0]
+
+    @contextmanager
+    def _write(self, table):
+        """單一交易寫入，成功後遞增該資料表的版本號"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+                self._conn.execute("UPDATE meta SET value = value + 1 WHERE key = ?", (table,))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def import_files(self, reg_path=None, student_path=None):
+        """從 CSV/XLSX 匯入 (覆蓋資料庫內容)"""
+        if reg_path and os.path.exists(reg_path):
+            records = read_registrations_csv(reg_path).reindex(columns=REG_COLUMNS).fillna("").to_dict("records")
+            with self._write("registrations") as conn:
+                conn.execute("DELETE FROM registrations")
+                conn.executemany(REG_INSERT.replace("INSERT", "INSERT OR REPLACE", 1),
+                                 [tuple(str(r[c]) for c in REG_COLUMNS) for r in records])
+        if student_path and os.path.exists(student_path):
+            self.replace_students(CsvXlsxStorage(None, student_path).load_students())
+        with self._lock:
+            self._conn.execute("UPDATE meta SET value = 1 WHERE key = 'imported'")
+
+    # --- 報名資料 ---
+    def load_registrations(self):
+        with self._lock:
+            return pd.read_sql_query(
+                "SELECT 班級, 座號, 姓名, 社團, 報名時間, 狀態, 順位 FROM registrations ORDER BY rowid", self._conn)
+
+    def registrations_signature(self):
+        return self._meta("registrations")
+
+    def change_registrations(self, remove_keys=(), add_records=()):
+        with self._write("registrations") as conn:
+            conn.executemany("DELETE FROM registrations WHERE 班級 = ? AND 座號 = ?",
+                             [(str(c), str(s)) for c, s in remove_keys])
+            conn.executemany(REG_INSERT, [tuple(str(r.get(c, "")) for c in REG_COLUMNS) for r in add_records])
+
+    def rekey_registration(self, old_key, new_key):
+        with self._write("registrations") as conn:
+            conn.execute("UPDATE registrations SET 班級 = ?, 座號 = ? WHERE 班級 = ? AND 座號 = ?", (*new_key, *old_key))
+
+    def clear_registrations(self):
+        with self._write("registrations") as conn:
+            conn.execute("DELETE FROM registrations")
+
+    # --- 志願 (志願序分發模式) ---
+    def load_preferences(self):
+        with self._lock:
+            return pd.read_sql_query("SELECT 班級, 座號, 姓名, 志願, 填寫時間 FROM preferences ORDER BY rowid", self._conn)
+
+    def preferences_signature(self):
+        return self._meta("preferences")
+
+    def find_preference(self, cls, seat):
+        with self._lock:
+            row = self._conn.execute("SELECT 班級, 座號, 姓名, 志願, 填寫時間 FROM preferences WHERE 班級 = ? AND 座號 = ?",
+                                     (str(cls), str(seat))).fetchone()
+        return dict(zip(PREF_COLUMNS, row)) if row else None
+
+    def save_preference(self, record):
+        with self._write("preferences") as conn:
+            conn.execute("INSERT OR REPLACE INTO preferences VALUES (?, ?, ?, ?, ?)",
+                         tuple(str(record[c]) for c in PREF_COLUMNS))
+
+    def clear_preferences(self):
+        with self._write("preferences") as conn:
+            conn.execute("DELETE FROM preferences")
+
+    # --- 學生名冊 ---
+    def load_students(self):
+        with self._lock:
+            df = pd.read_sql_query(
+                "SELECT 班級, 座號, 姓名, 學號, 身分, 鎖定社團, extra FROM students ORDER BY 班級, 座號", self._conn)
+        extra = df.pop("extra")
+        if extra.notna().any():
+            df = df.join(pd.DataFrame([json.loads(x) if isinstance(x, str) else {} for x in extra], index=df.index))
+        return df
+
+    def students_signature(self):
+        return self._meta("students")
+
+    def _student_rows(self, df):
+        """名冊轉成資料表列；缺少班級或座號的列 (例如表尾的匯出日期) 不算學生，不寫入"""
+        extra_cols = [c for c in df.columns if c not in STUDENT_COLUMNS]
+        df = df.reindex(columns=STUDENT_COLUMNS + extra_cols)
+        df = df[df["班級"].notna() & df["座號"].notna()]
+        base = df[STUDENT_COLUMNS].fillna("").astype(str).itertuples(index=False, name=None)
+        if not extra_cols:
+            return [row + (None,) for row in base]
+        extras = df[extra_cols].astype(object).where(df[extra_cols].notna(), None).to_dict("records")
+        return [row + (json.dumps(e, ensure_ascii=False, default=str),) for row, e in zip(base, extras)]
+
+    def add_students(self, records):
+        df, _ = normalize_students(pd.DataFrame(list(records)))
+        with self._write("students") as conn:
+            conn.executemany("INSERT INTO students VALUES (?, ?, ?, ?, ?, ?, ?)", self._student_rows(df))
+
+    def remove_students(self, keys):
+        with self._write("students") as conn:
+            conn.executemany("DELETE FROM students WHERE 班級 = ? AND 座號 = ?", [(str(c), str(s)) for c, s in keys])
+
+    def update_students(self, keys, values):
+        cols = [c for c in values if c in STUDENT_COLUMNS]
+        sql = "UPDATE students SET " + ", ".join(f"{c} = ?" for c in cols) + " WHERE 班級 = ? AND 座號 = ?"
+        with self._write("students") as conn:
+            before = conn.total_changes
+            conn.executemany(sql, [tuple(values[c] for c in cols) + (str(k[0]), str(k[1])) for k in keys])
+            return conn.total_changes - before
+
+    def rekey_student(self, old_key, new_key):
+        with self._write("students") as conn:
+            conn.execute("UPDATE students SET 班級 = ?, 座號 = ? WHERE 班級 = ? AND 座號 = ?", (*new_key, *old_key))
+
+    def replace_students(self, df):
+        df, _ = normalize_students(df.copy())
+        with self._write("students") as conn:
+            conn.execute("DELETE FROM students")
+            conn.executemany("INSERT OR REPLACE INTO students VALUES (?, ?, ?, ?, ?, ?, ?)", self._student_rows(df))
+
+    def clear_students(self):
+        with self._write("students") as conn:
+            conn.execute("DELETE FROM students")
+
+    def export_students_xlsx(self):
+        buffer = io.BytesIO()
+        self.load_students().to_excel(buffer, index=False)
+        return buffer.getvalue()
+
+
+def open_storage(kind, reg_path, student_path, db_path):
+    """依設定建立儲存層："csv" (預設) 或 "sqlite"；CSV 模式的志願檔放在報名 CSV 旁"""
+    if kind == "sqlite":
+        return SQLiteStorage(db_path, reg_path, student_path)
+    return CsvXlsxStorage(reg_path, student_path, os.path.join(os.path.dirname(reg_path), "club_preferences.csv"))
+
+
+def plan_promotions(ledger, limits, delta=None, exclude=()):
+    """計算遞補：各社團 (名額 - 正取 - 本次異動) 空出的位置，依備取順序改為正取，回傳改寫後的報名資料"""
+    delta, exclude = delta or {}, set(exclude)
+    promoted = []
+    for club in ledger.waitlisted_clubs():
+        free = limits.get(club, 0) - ledger.count(club) - delta.get(club, 0)
+        if free <= 0:
+            continue
+        for key in ledger.waitlist(club, free + len(exclude)):
+            if free <= 0:
+                break
+            if key not in exclude:
+                promoted.append({**ledger.lookup(*key), "狀態": "正取"})
+                free -= 1
+    return promoted
+
+
+def _write_changes(ledger, removed, added, promoted):
+    """把異動與遞補一起寫入 (遞補 = 刪除備取列再寫入正取列)，回傳遞補人數"""
+    removed = list(removed) + [(p["班級"], p["座號"]) for p in promoted]
+    added = list(added) + promoted
+    if removed or added:
+        ledger.storage.change_registrations(remove_keys=removed, add_records=added)
+        ledger.apply_changes(removed, added)
+    if promoted:
+        metrics.inc("waitlist_promotions_total", len(promoted))
+    return len(promoted)
+
+
+def reserve_seat(ledger, lock, record, limit, waitlist=False):
+    """原子化報名：在鎖內重新確認重複與名額後才寫入
+
+    回傳 "ok"、"duplicate" (已報名過) 或 "full" (額滿)；waitlist=True 時額滿改列備取並回傳 "waitlisted"。
+    名額若因設定調高而空出，會先讓備取依序遞補，新報名排在備取之後。
+    """
+    club = record["社團"]
+    with lock.hold():
+        ledger.refresh()
+        if ledger.lookup(record["班級"], record["座號"]) is not None:
+            return "duplicate"
+        promoted = plan_promotions(ledger, {club: limit})
+        result, added = "ok", [record]
+        if ledger.count(club) + len(promoted) >= limit:
+            result = "waitlisted" if waitlist else "full"
+            added = [{**record, "狀態": "備取"}] if waitlist else []
+        _write_changes(ledger, [], added, promoted)
+    return result
+
+
+def leave_waitlist(ledger, lock, cls, seat):
+    """學生退出備取 (已遞補為正取的不會被刪除)，回傳是否有刪除"""
+    with lock.hold():
+        ledger.refresh()
+        rec = ledger.lookup(cls, seat)
+        if rec is None or rec["狀態"] != "備取":
+            return False
+        _write_changes(ledger, [(str(cls), str(seat))], [], [])
+    return True
+
+
+def promote_waitlist(ledger, lock, limits):
+    """名額調整後，把所有社團空出的位置依備取順序遞補，回傳遞補人數"""
+    with lock.hold():
+        ledger.refresh()
+        return _write_changes(ledger, [], [], plan_promotions(ledger, limits))
+
+
+# ------------------------------------------
+# [核心 7] 批次異動引擎
+# ------------------------------------------
+class CapacityError(Exception):
+    """批次異動會讓社團超過名額"""
+
+
+ROSTER_OPS = {
+    "set_identity": lambda target: {"身分": target},
+    "lock": lambda target: {"鎖定社團": target},
+    "unlock": lambda target: {"鎖定社團": ""},
+}
+
+
+def bulk_mutate(ledger, lock, roster, op, keys, target=None, limits=None, timestamp=""):
+    """批次異動：所有 (班級, 座號) 經由索引一次解析、一次檢查容量、一次寫入
+
+    op 可為 delete / move / add (報名資料) 或 set_identity / lock / unlock / remove_student (名冊)。
+    roster 為 RosterIndex；回傳 (實際異動人數, 備取遞補人數)，會超收時丟出 CapacityError (不寫入任何資料)。
+    踢除或轉出空出的名額，會在同一次寫入中由該社團的備取依序遞補。
+    """
+    keys = list(dict.fromkeys((str(c), str(s)) for c, s in keys))
+    storage = ledger.storage
+
+    if op in ROSTER_OPS or op == "remove_student":
+        # 名冊異動與報名異動共用同一把鎖，避免學生在改名冊的途中送出報名
+        with lock.hold():
+            found = [k for k in keys if roster.get(*k) is not None]
+            if found:
+                if op == "remove_student":
+                    storage.remove_students(found)
+                else:
+                    storage.update_students(found, ROSTER_OPS[op](target))
+        return len(found), 0
+
+    if op not in ("delete", "move", "add"):
+        raise ValueError(f"unknown bulk operation: {op}")
+    limits = limits or {}
+    with lock.hold():
+        ledger.refresh()
+        current = {k: ledger.lookup(*k) for k in keys}
+        removed, added, delta = [], [], Counter()
+        if op == "delete":
+            for k, rec in current.items():
+                if rec is not None:
+                    removed.append(k)
+                    delta[rec["社團"]] -= 1 if rec["狀態"] == "正取" else 0
+        elif op == "move":
+            # 目標社團的備取也要轉成正取，只略過已是目標社團正取的人
+            for k, rec in current.items():
+                if rec is None or (rec["社團"] == target and rec["狀態"] == "正取"):
+                    continue
+                removed.append(k)
+                delta[rec["社團"]] -= 1 if rec["狀態"] == "正取" else 0
+                added.append({**rec, "社團": target, "報名時間": timestamp, "狀態": "正取", "順位": ""})
+        else:
+            for k, rec in current.items():
+                if rec is not None:
+                    continue
+                student = roster.get(*k) or {}
+                added.append({"班級": k[0], "座號": k[1], "姓名": student.get("姓名", ""),
+                              "社團": target, "報名時間": timestamp, "狀態": "正取", "順位": ""})
+        delta[target] += len(added)
+        full = [c for c, d in delta.items() if d > 0 and ledger.count(c) + d > limits.get(c, 0)]
+        if full:
+            raise CapacityError("、".join(full))
+        promoted = plan_promotions(ledger, limits, delta, exclude=removed + [(a["班級"], a["座號"]) for a in added])
+        n_promoted = _write_changes(ledger, removed, added, promoted)
+    return (len(removed) if op == "delete" else len(added)), n_promoted
+
+
+# ------------------------------------------
+# [核心 9] 虛擬等候室
+# ------------------------------------------
+class AdmissionGate:
+    """開放報名時的排隊閘門：先到先排 (FIFO)，以 token bucket 控制每秒放行人數，並限制同時在報名頁的人數
+
+    放行後只要持續有操作 (整頁重跑) 就保留名額，閒置超過 active_ttl 秒自動讓出；
+    排隊中超過 waiting_ttl 秒沒有輪詢 (關掉分頁) 的人輪到時直接略過。
+    限流只在本程序內有效，多程序部署時每個程序各自計算。
+    """
+
+    def __init__(self, rate=5, max_active=200, active_ttl=300, waiting_ttl=30):
+        self.active_ttl = active_ttl
+        self.waiting_ttl = waiting_ttl
+        self._lock = threading.Lock()
+        self._queue = OrderedDict()   # ticket -> [序號, 最後輪詢時間]
+        self._active = {}             # ticket -> 最後操作時間
+        self._next_seq = 0
+        self._served_seq = 0
+        self._expired_at = 0.0
+        self.admitted_total = 0
+        self.configure(rate, max_active)
+        self._tokens = self.burst
+        self._refill_at = time.monotonic()
+
+    def configure(self, rate, max_active):
+        """套用設定 (每秒放行人數、同時在線上限)，可隨時呼叫"""
+        self.rate = max(0.1, float(rate))
+        self.max_active = max(1, int(max_active))
+        self.burst = max(1.0, self.rate)
+
+    def poll(self, ticket, interact=True):
+        """排隊 / 查詢，回傳 (是否放行, 前面約幾人, 預估等待秒數)；interact=False 表示只是輪詢，不延長名額"""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            if ticket in self._active:
+                if interact:
+                    self._active[ticket] = now
+                return True, 0, 0.0
+            entry = self._queue.get(ticket)
+            if entry is None:
+                self._next_seq += 1
+                entry = self._queue[ticket] = [self._next_seq, now]
+            entry[1] = now
+            self._admit(now)
+            if ticket in self._active:
+                return True, 0, 0.0
+            ahead = max(0, entry[0] - self._served_seq - 1)
+            if len(self._active) >= self.max_active:
+                ahead = max(ahead, 1)
+            return False, ahead, (ahead + 1) / self.rate
+
+    def release(self, ticket):
+        """報名完成或離開時讓出名額"""
+        with self._lock:
+            self._active.pop(ticket, None)
+            self._queue.pop(ticket, None)
+
+    def _admit(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._refill_at) * self.rate)
+        self._refill_at = now
+        while self._queue and self._tokens >= 1 and len(self._active) < self.max_active:
+            ticket, (seq, last_poll) = self._queue.popitem(last=False)
+            self._served_seq = seq
+            if now - last_poll > self.waiting_ttl:
+                continue
+            self._active[ticket] = now
+            self._tokens -= 1
+            self.admitted_total += 1
+
+    def _expire(self, now):
+        if now - self._expired_at < 1:
+            return
+        self._expired_at = now
+        for ticket in [t for t, seen in self._active.items() if now - seen > self.active_ttl]:
+            del self._active[ticket]
+
+    def stats(self):
+        with self._lock:
+            return {"waiting": len(self._queue), "active": len(self._active), "admitted": self.admitted_total,
+                    "rate": self.rate, "max_active": self.max_active}
+
+
+# ------------------------------------------
+# [核心 10] 志願序分發
+# ------------------------------------------
+def lottery_number(seed, cls, seat):
+    """以種子 + (班級, 座號) 雜湊出的抽籤號碼：同一種子每次分發結果都相同"""
+    return int(hashlib.sha256(f"{seed}|{cls}|{seat}".encode("utf-8")).hexdigest()[:16], 16)
+
+
+def submit_preferences(ledger, lock, row, choices, clubs, max_choices, timestamp, identity=None):
+    """檢查並儲存學生志願 (在鎖內重新確認沒有報名資料)，回傳 "ok"、"empty"、"too_many"、"not_eligible" 或 "duplicate" (已有報名資料)"""
+    choices = list(dict.fromkeys(str(c) for c in choices if str(c).strip()))
+    if not choices:
+        return "empty"
+    if len(choices) > int(max_choices):
+        return "too_many"
+    allowed = set(eligible_clubs(row, clubs, identity))
+    if any(c not in allowed for c in choices):
+        return "not_eligible"
+    record = {"班級": str(row["班級"]), "座號": str(row["座號"]), "姓名": str(row["姓名"]),
+              "志願": json.dumps(choices, ensure_ascii=False), "填寫時間": timestamp}
+    with lock.hold():
+        ledger.refresh()
+        if ledger.lookup(record["班級"], record["座號"]) is not None:
+            return "duplicate"
+        ledger.storage.save_preference(record)
+    return "ok"
+
+
+def allocate_preferences(prefs, roster, clubs, seed=0, taken=None, skip=(), timestamp=""):
+    """依志願一次分發所有學生，回傳 (報名資料, 統計)
+
+    先依抽籤號碼排出全體順位 (號碼相同再比班級、座號)，鎖定社團的學生優先分到綁定社團，
+    其餘學生依順位逐一分到第一個還有名額、且符合資格 (eligible_clubs) 的志願；
+    等同以「鎖定學生優先、其餘依抽籤序」為各社團優先序的學生提議延遲接受 (deferred acceptance)，
+    結果穩定且學生照實填寫志願不會吃虧。沒分到的學生列為第一個可報名志願的備取，「順位」欄即備取順序。
+    taken 為已佔用的名額 {社團: 人數}，skip 為不參與分發 (已有報名資料) 的 (班級, 座號)。
+    """
+    skip = {(str(c), str(s)) for c, s in skip}
+    remaining = {c: int(cfg["limit"]) - (taken or {}).get(c, 0) for c, cfg in clubs.items()}
+    wanted = {}
+    for rec in prefs:
+        key = (str(rec["班級"]), str(rec["座號"]))
+        if key not in skip and roster.get(*key) is not None:
+            wanted[key] = preference_choices(rec["志願"])
+    locked = {}
+    df = roster.df
+    for cls, seat, club in zip(df["班級"], df["座號"], df["鎖定社團"]):
+        key = (str(cls), str(seat))
+        club = locked_club_of({"鎖定社團": club}, clubs)
+        if club and key not in skip:
+            locked[key] = club
+    order = sorted(set(wanted) | set(locked), key=lambda k: (lottery_number(seed, *k), k))
+    rank = {k: i for i, k in enumerate(order, 1)}
+
+    records, stats = [], Counter()
+    for key in [k for k in order if k in locked] + [k for k in order if k not in locked]:
+        row = roster.get(*key)
+        if key in locked:
+            choices = [locked[key]]
+        else:
+            allowed = set(eligible_clubs(row, clubs))
+            choices = [c for c in wanted[key] if c in allowed]
+        if not choices:
+            stats["未分發"] += 1
+            continue
+        club, status = choices[0], "備取"
+        for i, c in enumerate(choices, 1):
+            if remaining[c] > 0:
+                remaining[c] -= 1
+                club, status = c, "正取"
+                stats[f"第 {i} 志願"] += 1
+                break
+        stats[status] += 1
+        records.append({"班級": key[0], "座號": key[1], "姓名": str(row["姓名"]), "社團": club,
+                        "報名時間": timestamp, "狀態": status, "順位": str(rank[key])})
+    stats["參與人數"] = len(order)
+    return records, dict(stats)
+
+
+def run_allocation(ledger, lock, roster, clubs, seed=0, timestamp=""):
+    """執行志願序分發並寫入報名資料，回傳統計
+
+    上一次分發的結果 (「順位」欄有值的報名資料) 會整批重算；手動加入或先搶先贏的報名保留並佔用名額。
+    整個過程在報名鎖內一次寫入。
+    """
+    with lock.hold():
+        ledger.refresh()
+        previous, taken, skip = [], Counter(), []
+        for rec in ledger.records():
+            key = (str(rec["班級"]), str(rec["座號"]))
+            if str(rec.get("順位", "")).strip():
+                previous.append(key)
+                continue
+            skip.append(key)
+            if rec["狀態"] == "正取":
+                taken[rec["社團"]] += 1
+        prefs = ledger.storage.load_preferences().to_dict("records")
+        records, stats = allocate_preferences(prefs, roster, clubs, seed, taken, skip, timestamp)
+        if previous or records:
+            ledger.storage.change_registrations(remove_keys=previous, add_records=records)
+            ledger.apply_changes(previous, records)
+    metrics.inc("allocations_total")
+    return stats
+
+
+# ------------------------------------------
+# [核心 11] 名冊匯入
+# ------------------------------------------
+def _cell_text(value):
+    """Excel 儲存格轉文字：整數不帶小數點，空白回傳 None (之後由 normalize_students 補預設值)"""
+    if value is None:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    text = str(value).strip()
+    return text or None
+
+
+def read_roster_xlsx(data):
+    """以唯讀串流模式逐列讀取名冊 Excel (bytes)，只保留欄位陣列，不建立整份儲存格物件"""
+    from openpyxl import load_workbook
+    wb = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        rows = wb.active.iter_rows(values_only=True)
+        header = [_cell_text(h) for h in next(rows, ())]
+        cols = [(i, h) for i, h in enumerate(header) if h]
+        data_cols, row_numbers = {h: [] for _, h in cols}, []
+        for n, row in enumerate(rows, start=2):
+            values = [_cell_text(row[i]) if i < len(row) else None for i, _ in cols]
+            if not any(values):
+                continue
+            row_numbers.append(n)
+            for (_, h), v in zip(cols, values):
+                data_cols[h].append(v)
+    finally:
+        wb.close()
+    return pd.DataFrame(data_cols, index=pd.Index(row_numbers, name="列"))
+
+
+def _row_list(rows, limit=10):
+    rows = [str(n) for n in rows]
+    return "、".join(rows[:limit]) + (f" 等 {len(rows)} 列" if len(rows) > limit else "")
+
+
+def validate_roster(df):
+    """向量化檢查名冊，回傳 (可匯入的名冊, 錯誤訊息, 提醒訊息)；有錯誤時不可匯入
+
+    缺少班級或座號的列 (例如表尾的輸出日期) 略過並提醒；學號空白、班級座號重複、學號重複為錯誤。
+    """
+    missing = [c for c in ("班級", "座號", "姓名", "學號") if c not in df.columns]
+    if missing:
+        return df, [f"缺少欄位：{'、'.join(missing)}"], []
+    errors, warnings = [], []
+    no_key = df["班級"].isna() | df["座號"].isna()
+    if no_key.any():
+        warnings.append(f"第 {_row_list(df.index[no_key])} 缺少班級或座號，已略過")
+    df, _ = normalize_students(df[~no_key].copy())
+    no_id = df["學號"].isna()
+    if no_id.any():
+        errors.append(f"第 {_row_list(df.index[no_id])} 學號空白")
+    for cols, label in ((["班級", "座號"], "班級座號重複"), (["學號"], "學號重複")):
+        dup = df[df.duplicated(cols, keep=False) & df[cols[-1]].notna()]
+        groups = list(dup.groupby(cols, sort=True))
+        for values, group in groups[:10]:
+            values = values if isinstance(values, tuple) else (values,)
+            errors.append(f"{label}：{'-'.join(values)} (第 {_row_list(group.index)})")
+        if len(groups) > 10:
+            errors.append(f"{label}：共 {len(groups)} 組，只列出前 10 組")
+    return df.reset_index(drop=True), errors, warnings
+
+
+def diff_rosters(old_df, new_df):
+    """比對新舊名冊 (班級, 座號)：回傳新增、移除、資料變更三組 key (各自依班級、座號排序)
+
+    缺少班級或座號的列不算學生 (與 RosterIndex 相同)，不列入比對；上傳檔讀取時已去掉前後空白，
+    目前名冊 (pd.read_excel 讀入) 沒有，比對前兩邊都去掉。
+    目前名冊若有重複的 (班級, 座號)，與 RosterIndex 一樣以最後一列為準，重複的 key 放在 duplicates。
+    """
+    def keyed(df):
+        df = df[df["班級"].notna() & df["座號"].notna()]
+        df = df.reindex(columns=STUDENT_COLUMNS).fillna("").astype(str).apply(lambda s: s.str.strip())
+        return df.set_index(["班級", "座號"]).sort_index()
+    old, new = keyed(old_df), keyed(new_df)
+    dup = old.index.duplicated(keep="last")
+    duplicates = list(old.index[dup].unique())
+    old = old[~dup]
+    common = new.index.intersection(old.index)
+    differs = (new.loc[common].to_numpy() != old.loc[common].to_numpy()).any(axis=1)
+    return {"added": list(new.index.difference(old.index)), "removed": list(old.index.difference(new.index)),
+            "changed": list(common[differs]), "duplicates": duplicates}
+
+
+def plan_roster_import(data, current_df, ledger=None):
+    """名冊匯入前置作業：串流讀檔 → 驗證 → 與目前名冊比對，不寫入任何資料
+
+    回傳 dict：df (可匯入的名冊)、errors、warnings、
+    added / removed / changed (key 清單)、orphaned (已報名但不在新名冊的 key)。
+    """
+    plan = {"added": [], "removed": [], "changed": [], "orphaned": []}
+    with metrics.timer("roster_import_plan"):
+        df = read_roster_xlsx(data)
+        metrics.inc("rows_read_total", len(df), source="roster_import")
+        plan["df"], plan["errors"], plan["warnings"] = validate_roster(df)
+        if not plan["errors"]:
+            plan.update(diff_rosters(current_df, plan["df"]))
+            duplicates = plan.pop("duplicates")
+            if duplicates:
+                shown = "、".join(f"{c}-{s}" for c, s in duplicates[:10])
+                plan["warnings"].append(f"目前名冊有 {len(duplicates)} 組重複的班級座號 ({shown}{' 等' if len(duplicates) > 10 else ''})，比對時以最後一列為準")
+            if ledger is not None:
+                plan["orphaned"] = [k for k in plan["removed"] if ledger.lookup(*k) is not None]
+    return plan
+
+
+# ------------------------------------------
+# [核心 12] 社團簡章匯入
+# ------------------------------------------
+# 簡章表格的欄位名稱 (同義字)：只要表頭有「社團」欄就視為社團清單
+BROCHURE_HEADERS = {
+    "社團": ("社團", "社團名稱", "社團名", "名稱"),
+    "類別": ("類別", "類型", "分類", "性質"),
+    "名額": ("名額", "人數", "人數上限", "上限", "招收人數"),
+}
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+def _brochure_columns(header):
+    """表頭 → {欄位: 第幾欄}；沒有社團欄回傳 None"""
+    header = [re.sub(r"\s+", "", str(h or "")) for h in header]
+    cols = {}
+    for field, names in BROCHURE_HEADERS.items():
+        for i, h in enumerate(header):
+            if h in names and field not in cols:
+                cols[field] = i
+    return cols if "社團" in cols else None
+
+
+def _brochure_rows(tables):
+    """把 (來源, 列的串流) 轉成社團資料：每個表格先找表頭 (前 10 列內)，找不到就略過整個表格"""
+    for source, rows in tables:
+        cols = None
+        for n, row in enumerate(rows, start=1):
+            if cols is None:
+                cols = _brochure_columns(row)
+                if cols is None and n >= 10:
+                    break
+                continue
+            cell = lambda field: _cell_text(row[cols[field]]) if field in cols and cols[field] < len(row) else None
+            if any(cell(f) for f in cols):
+                yield {"來源": f"{source} 第 {n} 列", "社團": cell("社團"), "類別": cell("類別"), "名額": cell("名額")}
+
+
+def _xlsx_tables(data):
+    from openpyxl import load_workbook
+    wb = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        for ws in wb.worksheets:
+            yield f"工作表「{ws.title}」", ws.iter_rows(values_only=True)
+    finally:
+        wb.close()
+
+
+def _docx_tables(data):
+    """逐段解析 word/document.xml (iterparse)，每讀完一列就釋放，巢狀表格只取最外層"""
+    import xml.etree.ElementTree as ET
+    with zipfile.ZipFile(io.BytesIO(data)) as zf, zf.open("word/document.xml") as fh:
+        tbl, tr, tc, t, p = (_W + tag for tag in ("tbl", "tr", "tc", "t", "p"))
+        depth, n_table, rows, row, texts = 0, 0, [], [], []
+        for event, elem in ET.iterparse(fh, events=("start", "end")):
+            tag = elem.tag
+            if tag == tbl:
+                depth += 1 if event == "start" else -1
+                if event == "end" and depth == 0:
+                    n_table += 1
+                    yield f"表格 {n_table}", iter(rows)
+                    rows = []
+            elif event == "start":
+                continue
+            elif depth == 0:
+                if tag == p:
+                    elem.clear()  # 表格外的段落用不到
+            elif depth == 1:
+                if tag == t:
+                    texts.append(elem.text or "")
+                elif tag == tc:
+                    row.append("".join(texts)); texts = []
+                elif tag == tr:
+                    rows.append(row); row = []
+                    elem.clear()
+
+
+def read_brochure(data, kind):
+    """讀取社團簡章 (xlsx 每個工作表 / docx 每個表格)，回傳 [{來源, 社團, 類別, 名額}]"""
+    tables = _xlsx_tables(data) if kind == "xlsx" else _docx_tables(data)
+    return list(_brochure_rows(tables))
+
+
+def merge_brochure(clubs, entries, counts=None, default_limit=30, default_category="綜合"):
+    """把簡章內容合併進現有社團設定 (不修改傳入的 clubs)，回傳 (新社團設定, 報告)
+
+    簡章沒列出的社團保留不動；已存在的社團更新名額與類別 (類別空白沿用原本的)。
+    報告 dict：added / updated / unchanged (社團名稱)、errors (有錯誤時不可寫入)、warnings。
+    """
+    counts = counts or {}
+    merged = copy.deepcopy(clubs)
+    report = {"added": [], "updated": [], "unchanged": [], "errors": [], "warnings": []}
+    seen = {}
+    for e in entries:
+        name = e["社團"]
+        if not name:
+            report["warnings"].append(f"{e['來源']}：社團名稱空白，已略過"); continue
+        if name in seen:
+            report["errors"].append(f"「{name}」重複出現 ({seen[name]}、{e['來源']})"); continue
+        seen[name] = e["來源"]
+        old = clubs.get(name)
+        limit = re.fullmatch(r"\s*(\d+)\s*人?\s*", e["名額"] or "")
+        if e["名額"] and (limit is None or int(limit.group(1)) <= 0):
+            report["errors"].append(f"{e['來源']}：「{name}」名額「{e['名額']}」不是正整數"); continue
+        limit = int(limit.group(1)) if limit else (old["limit"] if old else default_limit)
+        category = e["類別"] or (old.get("category", default_category) if old else default_category)
+        cfg = {"limit": limit, "category": category}
+        if old is None:
+            report["added"].append(name)
+        elif old.get("limit") == limit and old.get("category", default_category) == category:
+            report["unchanged"].append(name); continue
+        else:
+            report["updated"].append(name)
+            if limit < counts.get(name, 0):
+                report["warnings"].append(f"「{name}」名額 {limit} 少於目前正取 {counts[name]} 人")
+        merged[name] = dict(old or {}, **cfg)
+    if not seen and not report["errors"]:
+        report["errors"].append("找不到社團清單：表格需要有「社團」或「社團名稱」欄")
+    return merged, report
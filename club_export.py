@@ -0,0 +1,419 @@
+"""報表輸出 (不依賴 Streamlit，可在背景執行緒或子程序中呼叫)"""
+import hashlib
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, BrokenExecutor, ThreadPoolExecutor, wait
+from xml.sax.saxutils import escape
+
+# ------------------------------------------
+# [輸出 1] Word 名單：直接產生 WordprocessingML
+# ------------------------------------------
+# 字型、字級、置中與標題列底色全部放在共用樣式裡，
+# 每個儲存格只輸出一段引用樣式的 <w:p>，不再逐格設定格式。
+W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+DOCX_FONT = "標楷體"
+
+_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/word/document.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+    '<Override PartName="/word/styles.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.styles+xml"/>'
+    '</Types>'
+)
+
+_ROOT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="word/document.xml"/>'
+    '</Relationships>'
+)
+
+_DOCUMENT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" '
+    'Target="styles.xml"/>'
+    '</Relationships>'
+)
+
+
+def _run_fonts(size_half_points, bold=False):
+    return (f'<w:rPr><w:rFonts w:ascii="{DOCX_FONT}" w:hAnsi="{DOCX_FONT}" w:eastAsia="{DOCX_FONT}"/>'
+            f'{"<w:b/>" if bold else ""}<w:sz w:val="{size_half_points}"/>'
+            f'<w:szCs w:val="{size_half_points}"/></w:rPr>')
+
+
+_STYLES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    f'<w:styles xmlns:w="{W_NS}">'
+    f'<w:docDefaults><w:rPrDefault>{_run_fonts(24)}</w:rPrDefault>'
+    '<w:pPrDefault><w:pPr><w:spacing w:after="0"/></w:pPr></w:pPrDefault></w:docDefaults>'
+    '<w:style w:type="paragraph" w:default="1" w:styleId="Normal"><w:name w:val="Normal"/>'
+    '<w:qFormat/></w:style>'
+    '<w:style w:type="paragraph" w:customStyle="1" w:styleId="RosterTitle"><w:name w:val="Roster Title"/>'
+    '<w:basedOn w:val="Normal"/><w:pPr><w:jc w:val="center"/></w:pPr>'
+    f'{_run_fonts(36, bold=True)}</w:style>'
+    '<w:style w:type="paragraph" w:customStyle="1" w:styleId="RosterTime"><w:name w:val="Roster Time"/>'
+    f'<w:basedOn w:val="Normal"/>{_run_fonts(20)}</w:style>'
+    '<w:style w:type="paragraph" w:customStyle="1" w:styleId="RosterCell"><w:name w:val="Roster Cell"/>'
+    '<w:basedOn w:val="Normal"/><w:pPr><w:jc w:val="center"/></w:pPr>'
+    f'{_run_fonts(22)}</w:style>'
+    '<w:style w:type="paragraph" w:customStyle="1" w:styleId="RosterHeader"><w:name w:val="Roster Header"/>'
+    '<w:basedOn w:val="RosterCell"/><w:rPr><w:b/></w:rPr></w:style>'
+    '<w:style w:type="table" w:styleId="TableGrid"><w:name w:val="Table Grid"/><w:tblPr><w:tblBorders>'
+    '<w:top w:val="single" w:sz="4" w:space="0" w:color="auto"/>'
+    '<w:left w:val="single" w:sz="4" w:space="0" w:color="auto"/>'
+    '<w:bottom w:val="single" w:sz="4" w:space="0" w:color="auto"/>'
+    '<w:right w:val="single" w:sz="4" w:space="0" w:color="auto"/>'
+    '<w:insideH w:val="single" w:sz="4" w:space="0" w:color="auto"/>'
+    '<w:insideV w:val="single" w:sz="4" w:space="0" w:color="auto"/>'
+    '</w:tblBorders><w:tblCellMar><w:left w:w="108" w:type="dxa"/><w:right w:w="108" w:type="dxa"/>'
+    '</w:tblCellMar></w:tblPr></w:style>'
+    '</w:styles>'
+)
+
+# Letter 紙張，與 python-docx 預設範本相同
+_SECTION = ('<w:sectPr><w:pgSz w:w="12240" w:h="15840"/>'
+            '<w:pgMar w:top="1440" w:right="1800" w:bottom="1440" w:left="1800" '
+            'w:header="720" w:footer="720" w:gutter="0"/></w:sectPr>')
+_TEXT_WIDTH = 12240 - 1800 * 2
+_PAGE_BREAK = '<w:p><w:r><w:br w:type="page"/></w:r></w:p>'
+_INVALID_XML = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+def _text(value):
+    return escape(_INVALID_XML.sub("", str(value)))
+
+
+def _para(style, text):
+    return f'<w:p><w:pPr><w:pStyle w:val="{style}"/></w:pPr><w:r><w:t xml:space="preserve">{_text(text)}</w:t></w:r></w:p>'
+
+
+def _table_rows(df):
+    """逐列產生表格 XML；標題列加灰底，其餘儲存格只引用樣式"""
+    width = _TEXT_WIDTH // max(len(df.columns), 1)
+    yield ('<w:tbl><w:tblPr><w:tblStyle w:val="TableGrid"/><w:tblW w:w="0" w:type="auto"/>'
+           '<w:jc w:val="center"/><w:tblLook w:val="04A0"/></w:tblPr><w:tblGrid>'
+           + f'<w:gridCol w:w="{width}"/>' * len(df.columns) + '</w:tblGrid>')
+    header_cell = ('<w:tc><w:tcPr><w:tcW w:w="{w}" w:type="dxa"/>'
+                   '<w:shd w:val="clear" w:color="auto" w:fill="D9D9D9"/></w:tcPr>{p}</w:tc>')
+    yield '<w:tr>' + "".join(header_cell.format(w=width, p=_para("RosterHeader", c)) for c in df.columns) + '</w:tr>'
+    cell_open = f'<w:tc><w:tcPr><w:tcW w:w="{width}" w:type="dxa"/></w:tcPr><w:p><w:pPr><w:pStyle w:val="RosterCell"/></w:pPr><w:r><w:t xml:space="preserve">'
+    cell_close = '</w:t></w:r></w:p></w:tc>'
+    for row in df.itertuples(index=False, name=None):
+        yield '<w:tr>' + "".join(cell_open + _text(v) + cell_close for v in row) + '</w:tr>'
+    yield '</w:tbl>'
+
+
+def write_roster_docx(data_dict, out, printed_at):
+    """把 {標題: DataFrame} 寫成 Word 檔 (每個標題一頁)，直接串流寫入 out"""
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("[Content_Types].xml", _CONTENT_TYPES)
+        zf.writestr("_rels/.rels", _ROOT_RELS)
+        zf.writestr("word/_rels/document.xml.rels", _DOCUMENT_RELS)
+        zf.writestr("word/styles.xml", _STYLES)
+        with zf.open("word/document.xml", "w") as fh:
+            fh.write(f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?><w:document xmlns:w="{W_NS}"><w:body>'.encode("utf-8"))
+            titles = list(data_dict.keys())
+            for i, title in enumerate(titles):
+                df = data_dict[title]
+                chunks = [_para("RosterTitle", title), _para("RosterTime", f"列印時間: {printed_at}")]
+                chunks.extend(_table_rows(df))
+                if i < len(titles) - 1:
+                    chunks.append(_PAGE_BREAK)
+                fh.write("".join(chunks).encode("utf-8"))
+            fh.write(f'{_SECTION}</w:body></w:document>'.encode("utf-8"))
+
+
+# ------------------------------------------
+# [輸出 2] Excel 批次壓縮檔：背景執行緒產生 + 串流寫入 ZIP
+# ------------------------------------------
+def make_export_pool(workers=None):
+    """建立報表用的執行緒池
+
+    伺服器本身是多執行緒，fork 子程序可能複製到別的執行緒持有中的鎖而卡死；
+    Streamlit 又把 __main__ 換成 club_app.py，spawn/forkserver 的子程序會重新執行整個介面，所以不用子程序。
+    openpyxl、fpdf2 是純 Python，受 GIL 限制，多開執行緒並不會讓檔案本身產生得更快；
+    執行緒池的用處是讓 ZIP 壓縮 (zlib 會釋放 GIL) 與下一份檔案的產生重疊，並限制同時在記憶體裡的份數。
+    """
+    workers = workers or max(1, min(4, (os.cpu_count() or 2) - 1))
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="export-pool")
+
+
+def build_xlsx(name, columns, rows):
+    """單一 Excel (openpyxl write-only 模式)，回傳 (名稱, 檔案內容)"""
+    import openpyxl
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("Sheet1")
+    ws.append(columns)
+    for row in rows:
+        ws.append(row)
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    return name, buffer.getvalue()
+
+
+def _xlsx_job(name, df):
+    return name, [str(c) for c in df.columns], df.astype(object).where(df.notna(), None).values.tolist()
+
+
+def write_batch_zip(data_dict, out, executor=None, progress=None):
+    """把 {檔名: DataFrame} 各自轉成 Excel 後寫入 ZIP
+
+    有 executor 時交給它產生 (寫入 ZIP 的壓縮與下一份的產生可以重疊)，同時最多只排入 2 倍工作數，
+    完成一份就寫入一份，記憶體用量不會隨份數增加。progress(完成數, 總數) 可用來更新進度條。
+    回傳 executor 是否仍可用 (False 表示已損壞，呼叫端應換一個新的)。
+    """
+    return _write_zip([_xlsx_job(name, df) for name, df in data_dict.items()], build_xlsx, "xlsx", out, executor, progress)
+
+
+def _write_zip(jobs, build, ext, out, executor=None, progress=None):
+    """jobs 的每一項以 build(*job) 產生 (名稱, 檔案內容)，依完成順序寫入 ZIP；回傳 executor 是否仍可用"""
+    total = len(jobs)
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as zf:
+        def emit(result):
+            zf.writestr(f"{result[0]}.{ext}", result[1])
+            if progress: progress(len(zf.namelist()), total)
+
+        pending_jobs = iter(jobs)
+        if executor is not None:
+            window = 2 * getattr(executor, "_max_workers", 2)
+            running = set()
+            try:
+                for job in pending_jobs:
+                    running.add(executor.submit(build, *job))
+                    if len(running) >= window:
+                        done, running = wait(running, return_when=FIRST_COMPLETED)
+                        for fut in done: emit(fut.result())
+                for fut in running:
+                    emit(fut.result())
+            except BrokenExecutor:
+                # 工作池已損壞：剩下的改在目前執行緒完成
+                written = set(zf.namelist())
+                pending_jobs = (j for j in jobs if f"{j[0]}.{ext}" not in written)
+                for job in pending_jobs:
+                    emit(build(*job))
+                return False
+        for job in pending_jobs:
+            emit(build(*job))
+    return True
+
+
+# ------------------------------------------
+# [輸出 3] 報表背景工作與結果快取
+# ------------------------------------------
+def export_job_key(data_version, kind, selection, fmt):
+    """以 (報名資料版本, 列印方式, 選取項目, 格式) 計算內容位址"""
+    raw = json.dumps([str(data_version), kind, list(selection), fmt], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ExportJobs:
+    """報表背景工作佇列：同一個 key 只產生一次，完成的檔案依總大小上限淘汰最久沒用的
+
+    檔案寫在 SpooledTemporaryFile (超過 spool_bytes 就改存暫存檔)，按下載時才讀出來。
+    產生檔案用的工作池由 make_pool 建立並傳給 build，背景執行緒不需要再向 Streamlit 查詢。
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, workers=2, make_pool=make_export_pool, spool_bytes=8 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.spool_bytes = spool_bytes
+        self._make_pool = make_pool
+        self._pool = make_pool() if make_pool else None
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="export")
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+
+    def submit(self, key, build):
+        """排入工作；build(out, progress, pool) 把檔案寫入 out，回傳 False 表示 pool 已損壞。已有相同 key 時直接沿用"""
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and job["status"] != "error":
+                self._jobs.move_to_end(key)
+                return job
+            job = {"status": "running", "progress": (0, 0), "result": None, "size": 0, "error": None,
+                   "lock": threading.Lock()}
+            self._jobs[key] = job
+            pool = self._pool
+
+        def progress(done, total):
+            job["progress"] = (done, total)
+
+        def run():
+            out = tempfile.SpooledTemporaryFile(max_size=self.spool_bytes)
+            try:
+                pool_ok = build(out, progress, pool)
+            except Exception as e:
+                out.close()
+                job.update(status="error", error=str(e))
+            else:
+                with self._lock:
+                    # 工作池損壞：換一個新的 (其他工作可能還拿著舊的，不主動關閉)
+                    if pool_ok is False and self._pool is pool:
+                        self._pool = self._make_pool()
+                    job.update(status="done", result=out, size=out.tell())
+                    self._evict(keep=key)
+        self._executor.submit(run)
+        return job
+
+    def get(self, key):
+        """取得工作狀態 dict (status: running / done / error)，沒有時回傳 None"""
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None:
+                self._jobs.move_to_end(key)
+            return job
+
+    @staticmethod
+    def read(job):
+        """讀出完成的檔案內容 (st.download_button 在按下時才呼叫)；被淘汰的檔案在沒人使用後才關閉"""
+        with job["lock"]:
+            job["result"].seek(0)
+            return job["result"].read()
+
+    def cached_bytes(self):
+        return sum(j["size"] for j in self._jobs.values() if j["result"] is not None)
+
+    def _evict(self, keep=None):
+        total = self.cached_bytes()
+        for key in list(self._jobs):
+            if total <= self.max_bytes:
+                break
+            job = self._jobs[key]
+            if job["status"] == "done" and key != keep:
+                total -= job["size"]
+                del self._jobs[key]
+
+
+# ------------------------------------------
+# [輸出 4] PDF 名單 / 簽到表：中文字型子集快取 + 每份一檔串流寫入 ZIP
+# ------------------------------------------
+# 中文字型動輒 10~20 MB，fpdf2 每份 PDF 都要解析整個字型再裁切。
+# 先用 fontTools 裁成只含名單用字的小字型並存檔，之後用到的字都在快取裡就直接沿用。
+PDF_SIGN_IN_COLUMNS = 6
+_PDF_LABELS = "".join(chr(c) for c in range(32, 127)) + "列印時間第次頁"
+_FONT_LOCK = threading.Lock()
+
+
+def subset_font(font_path, text, cache_dir):
+    """裁出只含 text 用字的字型子集 (存在 cache_dir)，回傳子集字型路徑
+
+    快取依原字型 (路徑、大小、修改時間) 區分；要用的字都已在子集裡就直接沿用，
+    有新字才以「舊字集 + 新字」重新裁一次，同一學期通常只會裁一次。
+    """
+    stat = os.stat(font_path)
+    base = hashlib.sha1(f"{os.path.abspath(font_path)}|{stat.st_size}|{stat.st_mtime_ns}".encode("utf-8")).hexdigest()[:16]
+    ttf_path = os.path.join(cache_dir, f"pdf_font_{base}.ttf")
+    chars_path = os.path.join(cache_dir, f"pdf_font_{base}.json")
+    wanted = set(text) | set(_PDF_LABELS)
+    with _FONT_LOCK:
+        try:
+            with open(chars_path, encoding="utf-8") as fh:
+                cached = set(json.load(fh))
+        except (OSError, ValueError):
+            cached = set()
+        if wanted <= cached and os.path.exists(ttf_path):
+            return ttf_path
+        from fontTools import subset
+        from fontTools.ttLib import TTFont
+        wanted |= cached
+        font = TTFont(font_path, fontNumber=0)  # .ttc 取第一個字型
+        options = subset.Options()
+        options.hinting, options.layout_features, options.notdef_outline = False, [], True
+        subsetter = subset.Subsetter(options)
+        subsetter.populate(unicodes=[ord(c) for c in wanted])
+        subsetter.subset(font)
+        os.makedirs(cache_dir, exist_ok=True)
+        # 先換字型檔再換字集：其他程序看到新字集時，字型檔一定已經是新的
+        tmp_path = f"{ttf_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        font.save(tmp_path)
+        os.replace(tmp_path, ttf_path)
+        with open(tmp_path, "w", encoding="utf-8") as fh:
+            json.dump("".join(sorted(wanted)), fh, ensure_ascii=False)
+        os.replace(tmp_path, chars_path)
+    return ttf_path
+
+
+def _pdf_groups(data_dict, sign_in):
+    """{標題: DataFrame} → [(標題, 欄位, 資料列)]；簽到表在後面加上空白簽名欄"""
+    extra = [f"第 {i} 次" for i in range(1, PDF_SIGN_IN_COLUMNS + 1)] if sign_in else []
+    groups = []
+    for title, df in data_dict.items():
+        rows = df.astype(object).where(df.notna(), "").astype(str).values.tolist()
+        groups.append((str(title), [str(c) for c in df.columns] + extra, [row + [""] * len(extra) for row in rows]))
+    return groups
+
+
+def _pdf_text(groups, printed_at):
+    return "".join(title + "".join(columns) + "".join("".join(row) for row in rows) for title, columns, rows in groups) + printed_at
+
+
+def build_pdf(name, groups, font_path, printed_at, sign_in=False):
+    """把多組名單畫成一份 PDF，回傳 (名稱, 檔案內容)
+
+    每組從新的一頁開始，加上書籤與「標題-頁次」頁碼標籤；表格跨頁時每頁重複表頭。
+    表格直接以固定列高的 cell 繪製 (不經過 fpdf2 的 table 排版)，每格不必逐字斷行計算。
+    """
+    from fpdf import FPDF
+    pdf = FPDF(orientation="L" if sign_in else "P", format="A4")
+    pdf.set_auto_page_break(False)
+    pdf.add_font("CJK", fname=font_path)
+    pdf.set_fill_color(220, 230, 241)
+    row_h, bottom = (10 if sign_in else 7), pdf.h - 12
+
+    def header(widths, columns):
+        for w, text in zip(widths, columns):
+            pdf.cell(w, row_h, text, border=1, align="C", fill=True)
+        pdf.ln(row_h)
+
+    for title, columns, rows in groups:
+        # 欄寬依各欄最長文字分配 (簽名欄固定較寬)，總寬等於版面寬度
+        n_data = len(columns) - (PDF_SIGN_IN_COLUMNS if sign_in else 0)
+        weights = [min(10, max(3, len(columns[i]), *(len(row[i]) for row in rows))) for i in range(n_data)]
+        weights += [4] * (len(columns) - n_data)
+        widths = [pdf.epw * w / sum(weights) for w in weights]
+        pdf.add_page()
+        pdf.set_page_label(label_style="D", label_prefix=f"{title}-", label_start=1)
+        pdf.start_section(title)
+        pdf.set_font("CJK", size=18)
+        pdf.cell(0, 11, title, align="C", new_x="LMARGIN", new_y="NEXT")
+        pdf.set_font("CJK", size=10)
+        pdf.cell(0, 7, f"列印時間: {printed_at}", align="R", new_x="LMARGIN", new_y="NEXT")
+        pdf.set_font("CJK", size=12)
+        header(widths, columns)
+        for row in rows:
+            if pdf.get_y() + row_h > bottom:
+                pdf.add_page()
+                header(widths, columns)
+            for w, text in zip(widths, row):
+                pdf.cell(w, row_h, text, border=1, align="C")
+            pdf.ln(row_h)
+    return name, bytes(pdf.output())
+
+
+def write_roster_pdf(data_dict, out, printed_at, font_path, cache_dir, sign_in=False):
+    """把 {標題: DataFrame} 寫成一份 PDF (每個標題一組頁面)"""
+    groups = _pdf_groups(data_dict, sign_in)
+    font = subset_font(font_path, _pdf_text(groups, printed_at), cache_dir)
+    out.write(build_pdf("", groups, font, printed_at, sign_in)[1])
+
+
+def write_pdf_zip(data_dict, out, printed_at, font_path, cache_dir, sign_in=False, executor=None, progress=None):
+    """每個標題各一份 PDF 寫入 ZIP；字型子集只裁一次，各份 PDF 交給 executor 產生 (與壓縮重疊)；回傳 executor 是否仍可用"""
+    groups = _pdf_groups(data_dict, sign_in)
+    font = subset_font(font_path, _pdf_text(groups, printed_at), cache_dir)
+    jobs = [(group[0], [group], font, printed_at, sign_in) for group in groups]
+    return _write_zip(jobs, build_pdf, "pdf", out, executor, progress)
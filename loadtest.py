@@ -0,0 +1,440 @@
+"""報名尖峰壓力測試 (離線執行，不需要網路)
+
+模擬大量學生在開放時間同時進入「📝 學生報名」：選班級座號 → 學號驗證 → 看社團名額 → 開啟確認視窗 → 送出報名。
+所有測試都在暫存目錄的複本上進行，不會動到正式的報名資料。
+
+    python loadtest.py --students 300 --curve burst                  # 全部在 start_time 同一瞬間湧入
+    python loadtest.py --students 300 --curve poisson --duration 30  # 30 秒內隨機抵達
+    python loadtest.py --processes 4 --storage sqlite                # 模擬 4 個 Streamlit 程序共用資料
+    python loadtest.py --driver apptest --students 40                # 以 streamlit.testing 真的跑頁面
+
+driver：
+    core     直接呼叫 club_core (與 confirm_submission 相同的 reserve_seat 路徑)，可壓到數千人
+    apptest  每位學生一個 AppTest session，實際執行 club_app.py 的頁面、表單與報名按鈕；
+             AppTest 無法在對話框內重跑 fragment，最後的「確認送出」改由同一條 reserve_seat 路徑完成；
+             會經過虛擬等候室，可用 --admit-rate / --max-active 調整放行速度
+"""
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytz
+
+from club_core import ConfigStore, RegistrationLedger, RegistrationLock, RosterCache, open_storage, reserve_seat
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROSTER_CANDIDATES = ["students.xlsx", "Student.xlsx", "STUDENTS.xlsx"]
+
+
+# ==========================================
+# 1. 測試環境
+# ==========================================
+def prepare_workdir(roster_path, config_path, storage_kind):
+    """建立暫存工作目錄：程式、設定與名冊的複本，報名資料從空白開始"""
+    workdir = tempfile.mkdtemp(prefix="club_loadtest_")
+    for name in os.listdir(BASE_DIR):
+        if name.endswith(".py"):
+            shutil.copy(os.path.join(BASE_DIR, name), workdir)
+    shutil.copy(roster_path, os.path.join(workdir, "students.xlsx"))
+    if config_path and os.path.exists(config_path):
+        shutil.copy(config_path, os.path.join(workdir, "club_config.json"))
+    paths = {
+        "dir": workdir,
+        "reg": os.path.join(workdir, "club_registrations.csv"),
+        "students": os.path.join(workdir, "students.xlsx"),
+        "db": os.path.join(workdir, "club_data.db"),
+        "lock": os.path.join(workdir, "club_registrations.lock"),
+        "config": os.path.join(workdir, "club_config.json"),
+        "storage": storage_kind,
+    }
+    open_storage(storage_kind, paths["reg"], paths["students"], paths["db"])  # SQLite 首次建立時匯入名冊
+    return paths
+
+
+def prepare_config(paths, args):
+    """改寫工作目錄的設定檔：報名時段設為現在開放，套用測試社團 / 名額 / 排隊參數，回傳社團設定"""
+    store = ConfigStore(paths["config"])
+    config = store.get()
+    if args.clubs > 0:
+        config["clubs"] = {f"測試社團{i + 1:02d}": {"limit": 30, "category": "校隊" if i == 0 else "綜合"}
+                           for i in range(args.clubs)}
+    if args.limit is not None:
+        for cfg in config["clubs"].values():
+            cfg["limit"] = args.limit
+    now = datetime.now(pytz.timezone("Asia/Taipei")).replace(tzinfo=None)
+    config["start_time"] = (now - timedelta(minutes=1)).strftime("%Y-%m-%d %H:%M:%S")
+    config["end_time"] = (now + timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S")
+    config["admit_rate"], config["max_active"] = args.admit_rate, args.max_active
+    store.save(config)
+    return config["clubs"]
+
+
+def open_server(paths):
+    """一個「伺服器程序」持有的共用資源 (對應 club_app 的 cache_resource)"""
+    storage = open_storage(paths["storage"], paths["reg"], paths["students"], paths["db"])
+    return {
+        "roster": RosterCache(storage),
+        "ledger": RegistrationLedger(storage),
+        "lock": RegistrationLock(paths["lock"]),
+    }
+
+
+# ==========================================
+# 2. 學生與抵達曲線
+# ==========================================
+def arrival_offsets(n, curve, duration, rng):
+    """每位學生相對於 start_time 的抵達秒數"""
+    if curve == "burst" or duration <= 0:
+        return [0.0] * n
+    if curve == "uniform":
+        return [duration * i / n for i in range(n)]
+    if curve == "ramp":  # 人潮線性增加
+        return [duration * ((i + 1) / n) ** 0.5 for i in range(n)]
+    if curve == "poisson":
+        rate, t, out = n / duration, 0.0, []
+        for _ in range(n):
+            t += rng.expovariate(rate)
+            out.append(t)
+        return out
+    raise ValueError(f"未知的抵達曲線：{curve}")
+
+
+def pick_club(row, clubs, rng, skew):
+    """依 鎖定社團 / 校隊 規則挑選社團；skew 越大越集中在前幾個熱門社團"""
+    locked = str(row.get("鎖定社團", "")).strip()
+    if locked and locked.lower() != "nan" and locked in clubs:
+        return locked
+    names = list(clubs)
+    if row.get("身分") == "校隊學生":
+        names = [c for c in names if "校隊" in str(clubs[c].get("category", ""))] or names
+    weights = [1 / (i + 1) ** skew for i in range(len(names))]
+    return rng.choices(names, weights)[0]
+
+
+def build_plan(roster, clubs, args, rng):
+    """產生模擬學生清單：(抵達秒數, 班級, 座號, 學號, 姓名, 社團, 是否重複送出)"""
+    rows = [r for r in roster.df.to_dict("records") if isinstance(r["姓名"], str) and r["姓名"]]  # 略過表尾備註列
+    rng.shuffle(rows)
+    rows = rows[:args.students]
+    offsets = arrival_offsets(len(rows), args.curve, args.duration, rng)
+    return [
+        {
+            "at": at, "班級": r["班級"], "座號": r["座號"], "學號": str(r["學號"]), "姓名": r["姓名"],
+            "社團": pick_club(r, clubs, rng, args.skew), "double_submit": rng.random() < args.double_submit,
+        }
+        for at, r in zip(offsets, rows)
+    ]
+
+
+# ==========================================
+# 3. 模擬學生
+# ==========================================
+# AppTest 每次 run() 都會替換再清空全域的 Runtime 單例，同一程序內的 run() 必須排隊；
+# session 之間仍會在步驟與步驟之間交錯，要真正平行請加 --processes
+_APPTEST_RUN_LOCK = threading.Lock()
+
+
+def now_str():
+    return time.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def make_record(student):
+    return {"班級": student["班級"], "座號": student["座號"], "姓名": student["姓名"],
+            "社團": student["社團"], "報名時間": now_str(), "狀態": "正取"}
+
+
+def submit(server, clubs, student, timing):
+    """與 confirm_submission 相同的送出路徑；double_submit 模擬連點兩下，第二次必須被擋下"""
+    record, limit = make_record(student), clubs[student["社團"]]["limit"]
+    t = time.perf_counter()
+    result = reserve_seat(server["ledger"], server["lock"], record, limit)
+    timing["submit"] = time.perf_counter() - t
+    if student["double_submit"]:
+        second = reserve_seat(server["ledger"], server["lock"], record, limit)
+        if second not in ("duplicate", "full"):
+            result = f"{result}+{second}"
+    return result
+
+
+def simulate_core(server, clubs, student, t0, args):
+    """core driver：直接呼叫頁面背後的同一組函式"""
+    timing = {}
+    time.sleep(max(0.0, t0 + student["at"] - time.perf_counter()))
+    arrived = t0 + student["at"]
+
+    t = time.perf_counter()
+    row = server["roster"].get().get(student["班級"], student["座號"])
+    if row is None or str(row["學號"]) != student["學號"]:
+        return {"result": "verify_failed", "timing": timing}
+    timing["verify"] = time.perf_counter() - t
+
+    ledger = server["ledger"]
+    for _ in range(args.views):  # 頁面 fragment 每秒刷新一次社團名額
+        t = time.perf_counter()
+        ledger.refresh()
+        ledger.lookup(student["班級"], student["座號"])
+        [ledger.count(c) for c in clubs]
+        timing["view"] = timing.get("view", 0.0) + time.perf_counter() - t
+
+    result = submit(server, clubs, student, timing)
+    timing["total"] = time.perf_counter() - arrived
+    return {"result": result, "timing": timing}
+
+
+def simulate_apptest(server, clubs, student, t0, args):
+    """apptest driver：實際跑 club_app.py，開頁 → 選班級座號 → 學號驗證 → 按「報名」開啟確認視窗 → 送出
+
+    AppTest 無法在對話框內重跑 fragment，最後的「確認送出」改走同一條 reserve_seat 路徑。
+    """
+    from streamlit.testing.v1 import AppTest
+
+    def step(name, action):
+        t = time.perf_counter()
+        action()
+        with _APPTEST_RUN_LOCK:
+            at.run(timeout=args.timeout)
+        timing[name] = timing.get(name, 0.0) + time.perf_counter() - t
+        if at.exception:
+            raise RuntimeError(f"{name}: {at.exception[0].message}")
+
+    timing = {}
+    time.sleep(max(0.0, t0 + student["at"] - time.perf_counter()))
+    arrived = t0 + student["at"]
+    at = AppTest.from_file(server["app_file"], default_timeout=args.timeout)
+    try:
+        step("page", lambda: None)
+        while not at.selectbox:  # 虛擬等候室：排隊中就照頁面上的 fragment 間隔輪詢
+            if time.perf_counter() - arrived > args.timeout:
+                return {"result": "queue_timeout", "timing": timing}
+            time.sleep(2)
+            step("queue", lambda: None)
+        grade = {"7": "七年級", "8": "八年級", "9": "九年級"}[student["班級"][0]]
+        step("select", lambda: at.selectbox[0].set_value(grade))
+        step("select", lambda: at.selectbox[1].set_value(student["班級"]))
+        step("select", lambda: at.selectbox[2].set_value(student["座號"]))
+        at.text_input[0].set_value(student["學號"])
+        step("verify", lambda: next(b for b in at.button if b.label == "驗證").click())
+        btn = next((b for b in at.button if b.key == f"btn_{student['社團']}"), None)
+        if btn is None or btn.label != "報名":
+            return {"result": "full" if btn is not None else "no_button", "timing": timing}
+        step("view", btn.click)
+        if not any(b.label.startswith("✅ 我確認") for b in at.button):
+            return {"result": "no_dialog", "timing": timing}
+    except Exception as e:
+        return {"result": "error", "error": str(e), "timing": timing}
+    result = submit(server, clubs, student, timing)
+    timing["total"] = time.perf_counter() - arrived
+    try:
+        step("done", lambda: None)  # 報名後頁面重跑一次，讓出等候室名額
+    except Exception as e:
+        return {"result": "error", "error": str(e), "timing": timing}
+    return {"result": result, "timing": timing}
+
+
+# ==========================================
+# 4. 伺服器程序
+# ==========================================
+def run_server(paths, clubs, plan, t0, args):
+    """一個伺服器程序：sessions 條執行緒同時服務學生 (對應 Streamlit 的 script thread)"""
+    server = open_server(paths)
+    server["app_file"] = os.path.join(paths["dir"], "club_app.py")
+    simulate = simulate_apptest if args.driver == "apptest" else simulate_core
+    wall_t0 = time.time() + (t0 - time.perf_counter())
+
+    def serve(student):
+        out = simulate(server, clubs, student, t0, args)
+        out["done"] = time.time()
+        return out
+
+    with ThreadPoolExecutor(max_workers=args.sessions) as pool:
+        results = list(pool.map(serve, plan))
+    results.append({"lock": server["lock"].stats(), "t0": wall_t0})
+    return results
+
+
+def _fork_server(paths, clubs, plan, t0_wall, args):
+    """子程序進入點：以 wall clock 對齊開始時間"""
+    t0 = time.perf_counter() + (t0_wall - time.time())
+    return run_server(paths, clubs, plan, t0, args)
+
+
+def drive(paths, clubs, plan, args):
+    """processes 個程序 × sessions 條執行緒，學生平均分給各程序"""
+    os.environ["CLUB_STORAGE"] = paths["storage"]  # apptest 執行的 club_app.py 依此選擇儲存層
+    if args.processes <= 1:
+        return run_server(paths, clubs, plan, time.perf_counter() + 0.5, args)
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    # 只用 fork：spawn 會在子程序重新匯入主程式，Windows 上請改用 --processes 1
+    ctx = multiprocessing.get_context("fork")
+    t0_wall = time.time() + 1.0
+    with ProcessPoolExecutor(max_workers=args.processes, mp_context=ctx) as pool:
+        parts = [pool.submit(_fork_server, paths, clubs, plan[i::args.processes], t0_wall, args)
+                 for i in range(args.processes)]
+        return [r for p in parts for r in p.result()]
+
+
+# ==========================================
+# 5. 結果統計
+# ==========================================
+def percentile(values, p):
+    """nearest-rank 百分位數"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[max(1, math.ceil(p / 100 * len(values))) - 1]
+
+
+def resource_usage():
+    """本程序 + 已結束子程序的 CPU 秒數與最大 RSS (MB)"""
+    if resource is None:
+        t = os.times()
+        return {"cpu_s": t.user + t.system + t.children_user + t.children_system, "rss_mb": None}
+    me, kids = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024  # macOS 回傳 bytes，Linux 回傳 KB
+    return {
+        "cpu_s": me.ru_utime + me.ru_stime + kids.ru_utime + kids.ru_stime,
+        "rss_mb": max(me.ru_maxrss, kids.ru_maxrss) / scale,
+    }
+
+
+def check_integrity(paths, clubs):
+    """測試結束後重新讀取儲存層：檢查超賣與重複報名"""
+    storage = open_storage(paths["storage"], paths["reg"], paths["students"], paths["db"])
+    df = storage.load_registrations()
+    counts = df.loc[df["狀態"] == "正取", "社團"].value_counts().to_dict() if not df.empty else {}  # 備取不佔名額
+    oversold = {c: n - clubs[c]["limit"] for c, n in counts.items() if c in clubs and n > clubs[c]["limit"]}
+    duplicates = int(df.duplicated(subset=["班級", "座號"]).sum()) if not df.empty else 0
+    return {"rows": len(df), "oversold": oversold, "duplicates": duplicates,
+            "full_clubs": sum(1 for c, cfg in clubs.items() if counts.get(c, 0) >= cfg["limit"])}
+
+
+def summarize(results, integrity, usage, elapsed):
+    """整理成報告用的 dict"""
+    students = [r for r in results if "result" in r]
+    servers = [r for r in results if "lock" in r]
+    outcomes = Counter(r["result"] for r in students)
+    steps = {}
+    for r in students:
+        for name, sec in r["timing"].items():
+            steps.setdefault(name, []).append(sec * 1000)
+    span = max((r["done"] for r in students), default=0) - min((s["t0"] for s in servers), default=0)
+    # 連點兩下的 "ok+ok" 等組合也算送出，只看第一次的結果
+    submitted = sum(n for k, n in outcomes.items() if k.split("+")[0] in ("ok", "full", "duplicate"))
+    return {
+        "students": len(students),
+        "outcomes": dict(outcomes),
+        "latency_ms": {
+            name: {"p50": percentile(v, 50), "p95": percentile(v, 95), "p99": percentile(v, 99), "max": max(v)}
+            for name, v in steps.items()
+        },
+        "span_s": span,
+        "throughput_per_s": submitted / span if span > 0 else 0.0,
+        "lock": [s["lock"] for s in servers],
+        "integrity": integrity,
+        "ok_matches_rows": outcomes.get("ok", 0) == integrity["rows"],
+        "cpu_s": usage["cpu_s"],
+        "cpu_util": usage["cpu_s"] / elapsed if elapsed > 0 else 0.0,
+        "rss_mb": usage["rss_mb"],
+        "errors": [r["error"] for r in students if "error" in r][:5],
+    }
+
+
+def print_report(report, args):
+    print(f"== 報名壓力測試：driver={args.driver} storage={args.storage} curve={args.curve} "
+          f"學生={report['students']} 程序={args.processes} session={args.sessions}")
+    print("結果：" + "、".join(f"{k} {v}" for k, v in sorted(report["outcomes"].items())))
+    print(f"{'步驟':<8}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}  (ms)")
+    for name, v in report["latency_ms"].items():
+        print(f"{name:<8}{v['p50']:>10.2f}{v['p95']:>10.2f}{v['p99']:>10.2f}{v['max']:>10.2f}")
+    print(f"吞吐量：{report['throughput_per_s']:.1f} 筆/秒 (歷時 {report['span_s']:.2f} 秒)")
+    for i, lock in enumerate(report["lock"]):
+        print(f"程序 {i} 搶鎖：{lock['count']} 次，平均 {lock['avg_ms']:.2f} ms，p95 {lock['p95_ms']:.2f} ms，最長 {lock['max_ms']:.2f} ms")
+    integ = report["integrity"]
+    print(f"資料檢查：{integ['rows']} 筆報名，額滿社團 {integ['full_clubs']}，"
+          f"超賣 {sum(integ['oversold'].values())}{' ' + str(integ['oversold']) if integ['oversold'] else ''}，重複 {integ['duplicates']}，"
+          f"成功數與資料筆數{'一致' if report['ok_matches_rows'] else '不一致'}")
+    rss = f"{report['rss_mb']:.0f} MB" if report["rss_mb"] is not None else "N/A"
+    print(f"資源：CPU {report['cpu_s']:.2f} 秒 (平均 {report['cpu_util']:.0%} 單核)，最大 RSS {rss}")
+    for err in report["errors"]:
+        print("錯誤：", err)
+
+
+# ==========================================
+# 6. 主程式
+# ==========================================
+def main(argv=None):
+    default_roster = next((os.path.join(BASE_DIR, f) for f in ROSTER_CANDIDATES
+                           if os.path.exists(os.path.join(BASE_DIR, f))), None)
+    ap = argparse.ArgumentParser(description="社團報名尖峰壓力測試 (在暫存複本上執行)")
+    ap.add_argument("--driver", choices=["core", "apptest"], default="core")
+    ap.add_argument("--storage", choices=["csv", "sqlite"], default=os.environ.get("CLUB_STORAGE", "csv").lower())
+    ap.add_argument("--students", type=int, default=300, help="模擬學生人數 (上限為名冊人數)")
+    ap.add_argument("--curve", choices=["burst", "uniform", "ramp", "poisson"], default="burst",
+                    help="抵達曲線；burst = 全部在 start_time 同時湧入")
+    ap.add_argument("--duration", type=float, default=10.0, help="非 burst 曲線的抵達時間長度 (秒)")
+    ap.add_argument("--sessions", type=int, default=32, help="每個程序同時服務的 session 數")
+    ap.add_argument("--processes", type=int, default=1, help="模擬的 Streamlit 程序數")
+    ap.add_argument("--views", type=int, default=3, help="送出前看社團名額的次數 (fragment 刷新)")
+    ap.add_argument("--skew", type=float, default=1.2, help="熱門社團集中度，0 = 平均分散")
+    ap.add_argument("--clubs", type=int, default=0, help="改用 N 個測試社團 (0 = 使用 club_config.json)")
+    ap.add_argument("--limit", type=int, default=None, help="覆寫所有社團名額 (製造搶位)")
+    ap.add_argument("--admit-rate", type=int, default=5, help="虛擬等候室每秒放行人數 (apptest)")
+    ap.add_argument("--max-active", type=int, default=200, help="虛擬等候室同時報名人數上限 (apptest)")
+    ap.add_argument("--double-submit", type=float, default=0.05, help="連點兩次送出的學生比例")
+    ap.add_argument("--roster", default=default_roster, help="名冊 xlsx")
+    ap.add_argument("--config", default=os.path.join(BASE_DIR, "club_config.json"), help="社團設定 json")
+    ap.add_argument("--timeout", type=float, default=60.0, help="apptest 每次重跑的逾時秒數")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--json", dest="json_path", help="另存 JSON 報告")
+    ap.add_argument("--keep", action="store_true", help="保留暫存工作目錄")
+    args = ap.parse_args(argv)
+    if not args.roster:
+        ap.error("找不到名冊，請以 --roster 指定")
+
+    rng = random.Random(args.seed)
+    paths = prepare_workdir(args.roster, args.config, args.storage)
+    report = None
+    try:
+        clubs = prepare_config(paths, args)
+        roster = open_server(paths)["roster"].get()
+        plan = build_plan(roster, clubs, args, rng)
+        usage0 = resource_usage()
+        t = time.perf_counter()
+        results = drive(paths, clubs, plan, args)
+        elapsed = time.perf_counter() - t
+        usage = resource_usage()
+        usage = {"cpu_s": usage["cpu_s"] - usage0["cpu_s"], "rss_mb": usage["rss_mb"]}
+        report = summarize(results, check_integrity(paths, clubs), usage, elapsed)
+        print_report(report, args)
+        if args.json_path:
+            with open(args.json_path, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+    finally:
+        if args.keep:
+            print("工作目錄：", paths["dir"])
+        else:
+            shutil.rmtree(paths["dir"], ignore_errors=True)
+    if report is None:
+        return 1
+    integ = report["integrity"]
+    return 1 if integ["oversold"] or integ["duplicates"] or not report["ok_matches_rows"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
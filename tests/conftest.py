@@ -0,0 +1,26 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from club_core import open_storage  # noqa: E402
+
+STUDENT_XLSX = os.path.join(ROOT, "Student.xlsx")
+
+
+@pytest.fixture
+def app_dir(tmp_path):
+    """暫存的程式資料夾：複製範例名冊 (含表尾的匯出日期列)"""
+    shutil.copy(STUDENT_XLSX, tmp_path / "students.xlsx")
+    return tmp_path
+
+
+@pytest.fixture(params=["csv", "sqlite"])
+def storage(request, app_dir):
+    """兩種儲存層各跑一次"""
+    return open_storage(request.param, str(app_dir / "club_registrations.csv"), str(app_dir / "students.xlsx"),
+                        str(app_dir / "club_data.db"))
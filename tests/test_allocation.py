@@ -0,0 +1,56 @@
+import pytest
+
+from club_core import (RegistrationLedger, RegistrationLock, RosterCache, bulk_mutate, reserve_seat, run_allocation,
+                       submit_preferences)
+
+CLUBS = {"A": {"limit": 1, "category": "綜合"}, "B": {"limit": 2, "category": "綜合"},
+         "T": {"limit": 5, "category": "校隊"}}
+
+
+@pytest.fixture
+def env(storage, app_dir):
+    ledger = RegistrationLedger(storage)
+    lock = RegistrationLock(str(app_dir / "club_registrations.lock"))
+    return ledger, lock, RosterCache(storage)
+
+
+def _submit(ledger, lock, roster, seat, choices, max_choices=3):
+    return submit_preferences(ledger, lock, roster.get().get("701", seat), choices, CLUBS, max_choices, "t")
+
+
+def _result(ledger, seats):
+    return {s: (r["社團"], r["狀態"]) for s in seats if (r := ledger.lookup("701", s))}
+
+
+def test_submit_preferences_checks(env):
+    ledger, lock, roster = env
+    assert _submit(ledger, lock, roster, "01", [" ", ""]) == "empty"
+    assert _submit(ledger, lock, roster, "01", ["A", "B", "T"], max_choices=2) == "too_many"
+    assert _submit(ledger, lock, roster, "01", ["A", "A", "B"], max_choices=2) == "ok"  # 重複志願只算一次
+    bulk_mutate(ledger, lock, roster.get(), "set_identity", [("701", "02")], "校隊學生")
+    assert _submit(ledger, lock, roster, "02", ["A"]) == "not_eligible"
+    reserve_seat(ledger, lock, {"班級": "701", "座號": "03", "姓名": "", "社團": "B", "報名時間": "t",
+                                "狀態": "正取"}, 2)
+    assert _submit(ledger, lock, roster, "03", ["A"]) == "duplicate"
+
+
+def test_allocation_respects_locks_manual_seats_and_is_repeatable(env):
+    ledger, lock, roster = env
+    seats = ["01", "02", "03", "04", "05", "06"]
+    for seat in seats[:4]:
+        assert _submit(ledger, lock, roster, seat, ["A", "B"]) == "ok"
+    bulk_mutate(ledger, lock, roster.get(), "lock", [("701", "05")], "A")
+    reserve_seat(ledger, lock, {"班級": "701", "座號": "06", "姓名": "", "社團": "B", "報名時間": "t",
+                                "狀態": "正取"}, 2)
+
+    stats = run_allocation(ledger, lock, roster.get(), CLUBS, seed=7, timestamp="t")
+    first = _result(ledger, seats)
+    assert first["05"] == ("A", "正取")  # 鎖定社團優先
+    assert first["06"] == ("B", "正取")  # 手動報名保留並佔用名額
+    got = [s for s in seats[:4] if first[s] == ("B", "正取")]
+    assert len(got) == 1 and sum(first[s] == ("A", "備取") for s in seats[:4]) == 3
+    assert stats["正取"] == 2 and stats["備取"] == 3 and stats["參與人數"] == 5
+
+    run_allocation(ledger, lock, roster.get(), CLUBS, seed=7, timestamp="t")
+    assert _result(ledger, seats) == first  # 同一種子重算結果相同
+    assert len(ledger.records()) == 6
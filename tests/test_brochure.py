@@ -0,0 +1,60 @@
+import io
+import zipfile
+
+from openpyxl import Workbook
+
+from club_core import merge_brochure, read_brochure
+
+W = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+
+
+def _xlsx(rows):
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "簡章"
+    for row in rows:
+        ws.append(row)
+    buf = io.BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
+
+
+def _docx(tables):
+    cell = lambda text: f"<w:tc><w:p><w:r><w:t>{text}</w:t></w:r></w:p></w:tc>"
+    body = "".join("<w:tbl>" + "".join("<w:tr>" + "".join(cell(c) for c in row) + "</w:tr>" for row in rows)
+                   + "</w:tbl>" for rows in tables)
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf:
+        zf.writestr("word/document.xml", f'<w:document xmlns:w="{W}"><w:body><w:p><w:r><w:t>說明</w:t></w:r></w:p>'
+                                         f"{body}</w:body></w:document>")
+    return buf.getvalue()
+
+
+def test_read_brochure_finds_header_in_xlsx_and_docx():
+    xlsx = read_brochure(_xlsx([["115 學年度社團簡章"], ["社團 名稱", "性質", "人數"], ["籃球社", "校隊", 20],
+                                ["桌遊社", None, "25 人"], [None, None, None]]), "xlsx")
+    assert [(e["社團"], e["類別"], e["名額"]) for e in xlsx] == [("籃球社", "校隊", "20"), ("桌遊社", None, "25 人")]
+    assert xlsx[0]["來源"] == "工作表「簡章」 第 3 列"
+    docx = read_brochure(_docx([[["時間", "地點"], ["週五", "禮堂"]], [["社團", "名額"], ["熱舞社", "30"]]]), "docx")
+    assert [(e["來源"], e["社團"], e["名額"]) for e in docx] == [("表格 2 第 2 列", "熱舞社", "30")]
+
+
+def test_merge_brochure_reports_changes_and_rejects_bad_limits():
+    clubs = {"籃球社": {"limit": 20, "category": "校隊"}, "熱舞社": {"limit": 30, "category": "綜合", "note": "x"},
+             "圍棋社": {"limit": 10, "category": "綜合"}}
+    entries = [{"來源": f"第 {i} 列", "社團": name, "類別": cat, "名額": limit}
+               for i, (name, cat, limit) in enumerate([("籃球社", None, "20"), ("熱舞社", None, "12 人"),
+                                                        ("桌遊社", "學藝", None), (None, None, "5")], 2)]
+    merged, report = merge_brochure(clubs, entries, counts={"熱舞社": 15})
+    assert (report["added"], report["updated"], report["unchanged"]) == (["桌遊社"], ["熱舞社"], ["籃球社"])
+    assert merged["熱舞社"] == {"limit": 12, "category": "綜合", "note": "x"} and clubs["熱舞社"]["limit"] == 30
+    assert merged["桌遊社"] == {"limit": 30, "category": "學藝"} and merged["圍棋社"] == clubs["圍棋社"]
+    assert len(report["warnings"]) == 2 and not report["errors"]  # 名額少於正取人數、社團名稱空白
+
+    for bad in ("1.5", "0", "20-30", "二十"):
+        _, report = merge_brochure(clubs, [{"來源": "第 2 列", "社團": "桌遊社", "類別": None, "名額": bad}])
+        assert report["errors"], bad
+    _, report = merge_brochure(clubs, entries[:1] * 2)
+    assert "重複出現" in report["errors"][0]
+    _, report = merge_brochure(clubs, [])
+    assert report["errors"] == ["找不到社團清單：表格需要有「社團」或「社團名稱」欄"]
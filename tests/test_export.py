@@ -0,0 +1,67 @@
+import io
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from club_export import ExportJobs, write_batch_zip
+
+
+def _wait(jobs, key, timeout=10):
+    deadline = time.time() + timeout
+    while jobs.get(key)["status"] == "running" and time.time() < deadline:
+        time.sleep(0.01)
+    return jobs.get(key)
+
+
+def _frames(n):
+    return {f"{700 + i}班": pd.DataFrame({"班級": [str(700 + i)], "座號": ["01"], "姓名": ["甲"]}) for i in range(n)}
+
+
+def test_batch_zip_contains_every_sheet():
+    buf = io.BytesIO()
+    with ThreadPoolExecutor(2) as pool:
+        assert write_batch_zip(_frames(5), buf, executor=pool) is True
+    assert sorted(zipfile.ZipFile(buf).namelist()) == sorted(f"{n}.xlsx" for n in _frames(5))
+
+
+def test_broken_pool_falls_back_and_reports():
+    def fail():
+        raise OSError("boom")
+    buf = io.BytesIO()
+    assert write_batch_zip(_frames(3), buf, executor=ThreadPoolExecutor(1, initializer=fail)) is False
+    assert len(zipfile.ZipFile(buf).namelist()) == 3
+
+
+def test_jobs_spool_result_and_pass_pool():
+    seen = []
+    jobs = ExportJobs(make_pool=lambda: "pool", spool_bytes=16)
+    def build(out, progress, pool):
+        seen.append((pool, threading.current_thread().name))
+        out.write(b"x" * 100)
+    jobs.submit("k", build)
+    job = _wait(jobs, "k")
+    assert job["status"] == "done" and job["size"] == 100
+    assert job["result"]._rolled  # 超過 spool_bytes 已改存暫存檔
+    assert jobs.read(job) == b"x" * 100
+    assert seen[0][0] == "pool"
+    assert jobs.submit("k", build) is job and len(seen) == 1
+
+
+def test_jobs_replace_broken_pool_and_evict():
+    made = []
+    jobs = ExportJobs(max_bytes=150, make_pool=lambda: made.append(1) or len(made))
+    jobs.submit("a", lambda out, progress, pool: out.write(b"a" * 100) and False)
+    _wait(jobs, "a")
+    assert len(made) == 2
+    jobs.submit("b", lambda out, progress, pool: out.write(b"b" * 100))
+    _wait(jobs, "b")
+    assert jobs.get("a") is None and jobs.cached_bytes() == 100
+
+
+def test_jobs_report_errors():
+    jobs = ExportJobs(make_pool=None)
+    jobs.submit("e", lambda out, progress, pool: 1 / 0)
+    assert _wait(jobs, "e")["status"] == "error"
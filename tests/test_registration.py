@@ -0,0 +1,83 @@
+import threading
+
+import pytest
+
+from club_core import (CapacityError, RegistrationLedger, RegistrationLock, RosterCache, bulk_mutate, leave_waitlist,
+                       promote_waitlist, reserve_seat)
+
+
+@pytest.fixture
+def env(storage, app_dir):
+    ledger = RegistrationLedger(storage)
+    lock = RegistrationLock(str(app_dir / "club_registrations.lock"))
+    return ledger, lock, RosterCache(storage).get()
+
+
+def _rec(cls, seat, club):
+    return {"班級": cls, "座號": seat, "姓名": "", "社團": club, "報名時間": "t", "狀態": "正取"}
+
+
+def _status(ledger, *keys):
+    return [(r["社團"], r["狀態"]) if (r := ledger.lookup(*k)) else None for k in keys]
+
+
+def test_reserve_ok_duplicate_full_waitlisted(env):
+    ledger, lock, _ = env
+    assert reserve_seat(ledger, lock, _rec("701", "01", "A"), 1) == "ok"
+    assert reserve_seat(ledger, lock, _rec("701", "01", "B"), 5) == "duplicate"
+    assert reserve_seat(ledger, lock, _rec("701", "02", "A"), 1) == "full"
+    assert reserve_seat(ledger, lock, _rec("701", "02", "A"), 1, waitlist=True) == "waitlisted"
+    assert _status(ledger, ("701", "01"), ("701", "02")) == [("A", "正取"), ("A", "備取")]
+    assert ledger.waitlist_position("701", "02") == 1
+
+
+def test_concurrent_reserve_never_oversells(env, storage):
+    ledger, lock, roster = env
+    keys = [("701", s) for s in roster.seats("701")]
+    results = []
+
+    def worker(key):
+        results.append(reserve_seat(ledger, lock, _rec(*key, "A"), 5))
+    threads = [threading.Thread(target=worker, args=(k,)) for k in keys]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert results.count("ok") == 5
+    assert RegistrationLedger(storage).count("A") == 5
+
+
+def test_leaving_and_delete_promote_in_order(env):
+    ledger, lock, roster = env
+    reserve_seat(ledger, lock, _rec("701", "01", "A"), 1)
+    for seat in ("02", "03", "04"):
+        reserve_seat(ledger, lock, _rec("701", seat, "A"), 1, waitlist=True)
+    assert leave_waitlist(ledger, lock, "701", "02")
+    changed, promoted = bulk_mutate(ledger, lock, roster, "delete", [("701", "01")], limits={"A": 1})
+    assert (changed, promoted) == (1, 1)
+    assert _status(ledger, ("701", "03"), ("701", "04")) == [("A", "正取"), ("A", "備取")]
+    assert promote_waitlist(ledger, lock, {"A": 2}) == 1
+    assert ledger.count("A") == 2
+
+
+def test_bulk_move_checks_capacity_and_promotes_target_waitlist(env):
+    ledger, lock, roster = env
+    reserve_seat(ledger, lock, _rec("701", "01", "A"), 1)
+    reserve_seat(ledger, lock, _rec("701", "02", "B"), 1)
+    reserve_seat(ledger, lock, _rec("701", "03", "B"), 1, waitlist=True)
+    with pytest.raises(CapacityError):
+        bulk_mutate(ledger, lock, roster, "move", [("701", "01")], "B", {"A": 1, "B": 1})
+    assert _status(ledger, ("701", "01")) == [("A", "正取")]
+    # 目標社團的備取可以直接轉正取
+    assert bulk_mutate(ledger, lock, roster, "move", [("701", "03")], "B", {"A": 1, "B": 2}) == (1, 0)
+    assert _status(ledger, ("701", "03")) == [("B", "正取")]
+    assert bulk_mutate(ledger, lock, roster, "move", [("701", "02")], "B", {"B": 2}) == (0, 0)
+
+
+def test_bulk_add_skips_registered_and_roster_ops(env, storage):
+    ledger, lock, roster = env
+    reserve_seat(ledger, lock, _rec("701", "01", "A"), 5)
+    assert bulk_mutate(ledger, lock, roster, "add", [("701", "01"), ("701", "02")], "B", {"B": 5}) == (1, 0)
+    assert ledger.lookup("701", "02")["姓名"] == roster.get("701", "02")["姓名"]
+    held = lock.stats()["count"]
+    assert bulk_mutate(ledger, lock, roster, "set_identity", [("701", "03"), ("999", "01")], "校隊學生") == (1, 0)
+    assert lock.stats()["count"] == held + 1  # 名冊異動也要在報名鎖內
+    assert RosterCache(storage).get().get("701", "03")["身分"] == "校隊學生"
@@ -0,0 +1,48 @@
+import io
+
+import pandas as pd
+
+from club_core import STUDENT_COLUMNS, diff_rosters, plan_roster_import, validate_roster
+from conftest import STUDENT_XLSX
+
+
+def _row(cls, seat, name, sid):
+    return dict(zip(STUDENT_COLUMNS, [cls, seat, name, sid, "一般生", ""]))
+
+
+def test_reupload_of_stored_roster_reports_nothing(storage):
+    """同一份名冊 (目前名冊是從磁碟讀回來的) 重新上傳不應有任何異動"""
+    with open(STUDENT_XLSX, "rb") as fh:
+        plan = plan_roster_import(fh.read(), storage.load_students())
+    assert plan["errors"] == []
+    assert (plan["added"], plan["removed"], plan["changed"]) == ([], [], [])
+
+
+def test_diff_ignores_surrounding_whitespace():
+    old = pd.DataFrame([_row("802", "05", "盧韋仲 ", "1"), _row("802", "06", "乙", "2")])
+    new = pd.DataFrame([_row("802", "05", "盧韋仲", "1"), _row("802", "06", "乙", "2")])
+    assert diff_rosters(old, new) == {"added": [], "removed": [], "changed": [], "duplicates": []}
+
+
+def test_diff_reports_added_removed_changed():
+    old = pd.DataFrame([_row("701", "01", "甲", "1"), _row("701", "02", "乙", "2")])
+    new = pd.DataFrame([_row("701", "01", "甲甲", "1"), _row("701", "03", "丙", "3")])
+    diff = diff_rosters(old, new)
+    assert diff["added"] == [("701", "03")]
+    assert diff["removed"] == [("701", "02")]
+    assert diff["changed"] == [("701", "01")]
+
+
+def test_duplicate_keys_in_current_roster_keep_last():
+    old = pd.DataFrame([_row("701", "01", "甲", "1"), _row("701", "01", "乙", "2")])
+    new = pd.DataFrame([_row("701", "01", "乙", "2")])
+    diff = diff_rosters(old, new)
+    assert diff["changed"] == [] and diff["duplicates"] == [("701", "01")]
+
+
+def test_validate_rejects_duplicate_seats_and_ids():
+    buf = io.BytesIO()
+    pd.DataFrame([_row("701", "01", "甲", "1"), _row("701", "01", "乙", "1")]).to_excel(buf, index=False)
+    plan = plan_roster_import(buf.getvalue(), pd.DataFrame(columns=STUDENT_COLUMNS))
+    assert len(plan["errors"]) == 2
+    assert validate_roster(pd.DataFrame([_row("701", "01", "甲", "1")]))[1] == []
@@ -0,0 +1,26 @@
+def test_footer_row_is_not_a_student(storage):
+    """表尾的匯出日期列缺少座號，兩種儲存層都不能把它當成學生"""
+    df = storage.load_students()
+    keyed = df[df["班級"].notna() & df["座號"].notna()]
+    assert len(keyed) == 382
+    assert not (keyed["座號"].astype(str) == "").any()
+
+
+def test_backends_agree_on_roster(app_dir):
+    from club_core import open_storage
+    keys = []
+    for kind in ("csv", "sqlite"):
+        st = open_storage(kind, str(app_dir / "r.csv"), str(app_dir / "students.xlsx"), str(app_dir / "x.db"))
+        df = st.load_students()
+        df = df[df["班級"].notna() & df["座號"].notna()]
+        keys.append(sorted(zip(df["班級"].astype(str), df["座號"].astype(str))))
+    assert keys[0] == keys[1]
+
+
+def test_registrations_round_trip(storage):
+    rec = {"班級": "701", "座號": "01", "姓名": "甲", "社團": "A", "報名時間": "t", "狀態": "正取"}
+    storage.change_registrations(add_records=[rec])
+    df = storage.load_registrations()
+    assert list(zip(df["班級"].astype(str), df["座號"].astype(str))) == [("701", "01")]
+    storage.change_registrations(remove_keys=[("701", "01")])
+    assert storage.load_registrations().empty